@@ -0,0 +1,189 @@
+"""
+gargoyle.aio
+~~~~~~~~~~~~
+
+asyncio support for ``SwitchManager.ais_active``, which requires Python 3.5+.
+
+Switches are checked against a snapshot of the manager, which is refreshed
+by a background task rather than on the event loop. Only loading the first
+snapshot waits on the cache or database.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import asyncio
+import functools
+import logging
+
+from django.db import close_old_connections
+from django.db.models.signals import post_delete, post_save
+from django.http import HttpRequest
+from django.utils.functional import LazyObject, empty
+
+from gargoyle.compat import sync_to_async
+from gargoyle.constants import SELECTIVE
+
+logger = logging.getLogger('gargoyle.aio')
+
+
+def _call_in_thread(func, *args):
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_sync(func, *args):
+    """
+    Runs ``func`` in a thread, with ``asgiref``'s ``sync_to_async`` if it is
+    installed.
+    """
+    if sync_to_async is not None:
+        return await sync_to_async(func)(*args)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(_call_in_thread, func, *args))
+
+
+class AsyncSnapshotLoader(object):
+    """
+    Keeps a snapshot of the switches of ``manager`` for checks from asyncio
+    code, refreshing it every ``interval`` seconds, which defaults to the
+    manager's timeout. Switches saved in this process are picked up
+    immediately.
+    """
+    def __init__(self, manager, interval=None):
+        self.manager = manager
+        self.interval = manager.timeout if interval is None else interval
+        self.snapshot = None
+        self._loading = None
+        self._refresh_task = None
+        self._creating = set()
+        post_save.connect(self._reload, sender=manager.model)
+        post_delete.connect(self._reload, sender=manager.model)
+
+    def __repr__(self):
+        return '<%s: %r>' % (self.__class__.__name__, self.manager)
+
+    async def get_snapshot(self):
+        """
+        Returns the current snapshot, only waiting for it on a cold start.
+        """
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = await self._load()
+        self._ensure_refreshing()
+        return snapshot
+
+    async def refresh(self):
+        """
+        Reloads the snapshot from the manager, in a thread.
+        """
+        self.snapshot = await run_sync(self.manager.get_snapshot)
+        return self.snapshot
+
+    def stop(self):
+        """
+        Stops refreshing in the background, until the next check.
+        """
+        if self._refresh_task is not None:
+            self._refresh_task[1].cancel()
+            self._refresh_task = None
+
+    async def is_active(self, key, *instances, **kwargs):
+        return (await self.is_active_many([key], *instances, **kwargs))[key]
+
+    async def is_active_many(self, keys, *instances, **kwargs):
+        switches = SnapshotSwitches(self, await self.get_snapshot())
+        if any(switches.needs_instances(key) for key in keys):
+            for instance in instances:
+                if isinstance(instance, HttpRequest):
+                    await self._resolve_user(instance)
+
+        is_active_in = self.manager.is_active_in
+        return dict((key, is_active_in(switches, key, *instances, **kwargs)) for key in keys)
+
+    async def _load(self):
+        loop = asyncio.get_event_loop()
+        if self._loading is None or self._loading[0] is not loop or self._loading[1].done():
+            manager = self.manager
+            if manager._local_last_updated is not None:
+                # Already loaded by synchronous code, so share it rather than wait
+                self.snapshot = manager._snapshot
+                return self.snapshot
+            self._loading = (loop, asyncio.ensure_future(self.refresh()))
+        return await self._loading[1]
+
+    def _ensure_refreshing(self):
+        # Tasks belong to the loop that started them, which may have closed
+        loop = asyncio.get_event_loop()
+        if self._refresh_task is None or self._refresh_task[0] is not loop or self._refresh_task[1].done():
+            self._refresh_task = (loop, asyncio.ensure_future(self._refresh_forever()))
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception('Could not refresh the switch snapshot')
+
+    def _reload(self, **kwargs):
+        # Runs after the manager has reloaded its own cache
+        if self.snapshot is not None:
+            self.snapshot = self.manager._snapshot
+
+    def _create(self, key):
+        """
+        Creates a missing switch in the background, as the manager does on
+        access when ``auto_create`` is set.
+        """
+        if not self.manager.auto_create or key in self._creating:
+            return
+        self._creating.add(key)
+
+        async def create():
+            try:
+                await run_sync(self.manager.__getitem__, key)
+                await self.refresh()
+            except Exception:
+                logger.exception('Could not create switch %r', key)
+            finally:
+                self._creating.discard(key)
+        asyncio.ensure_future(create())
+
+    async def _resolve_user(self, request):
+        # request.user is loaded lazily from the session, which is synchronous
+        user = getattr(request, 'user', None)
+        if isinstance(user, LazyObject) and user._wrapped is empty:
+            await run_sync(user._setup)
+
+
+class SnapshotSwitches(object):
+    """
+    The mapping of switches ``is_active_in`` reads, over a ``SwitchSnapshot``.
+    """
+    __slots__ = ('loader', 'snapshot')
+
+    def __init__(self, loader, snapshot):
+        self.loader = loader
+        self.snapshot = snapshot
+
+    def __getitem__(self, key):
+        try:
+            return self.snapshot[key]
+        except KeyError:
+            self.loader._create(key)
+            raise
+
+    def needs_instances(self, key):
+        """
+        Returns ``True`` if ``key``, or one of its parents, has conditions.
+        """
+        parts = key.split(':')
+        for index in range(1, len(parts) + 1):
+            switch = self.snapshot.get(':'.join(parts[:index]))
+            if switch is not None and switch.status == SELECTIVE and switch.value:
+                return True
+        return False
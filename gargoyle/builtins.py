@@ -7,21 +7,26 @@ gargoyle.builtins
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import calendar
+import re
 import socket
 import struct
-from datetime import datetime
+from datetime import datetime, time
+from time import mktime
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
-from django.core.validators import validate_ipv4_address
-from django.utils import timezone
+from django.core.validators import ValidationError, validate_ipv4_address
+from django.utils import six, timezone
 
 from gargoyle import gargoyle
 from gargoyle.conditions import (
-    BeforeDate, Boolean, ConditionSet, ModelConditionSet, OnOrAfterDate, Percent, RequestConditionSet, String,
+    BeforeDate, Boolean, ConditionSet, KeyValue, ModelConditionSet, OnOrAfterDate, Percent, Prefix, Regex,
+    RequestConditionSet, String, Suffix,
 )
-from gargoyle.constants import FEATURE
+from gargoyle.context import EvaluationContext, get_meta_key
+from gargoyle.geoip import get_database
 
 User = get_user_model()
 
@@ -34,20 +39,63 @@ class UserConditionSet(ModelConditionSet):
     is_staff = Boolean(label='Staff')
     is_superuser = Boolean(label='Superuser')
     date_joined = OnOrAfterDate(label='Joined on or after')
+    username_prefix = Prefix(label='Username starts with')
+    email_suffix = Suffix(label='Email ends with', help_text='e.g. @example.com')
+    email_regex = Regex(label='Email matches')
+
+    is_pure = True
+
+    # Pattern fields match against the column they are named after
+    pattern_fields = {
+        'username_prefix': 'username',
+        'email_suffix': 'email',
+        'email_regex': 'email',
+    }
 
     def can_execute(self, instance):
+        if isinstance(instance, EvaluationContext):
+            return instance.user_id is not None
         return isinstance(instance, (User, AnonymousUser))
 
-    def is_active(self, instance, conditions, switch_type=FEATURE):
+    def get_field_value(self, instance, field_name):
+        field_name = self.pattern_fields.get(field_name, field_name)
+        if isinstance(instance, EvaluationContext):
+            if field_name == 'percent':
+                return instance.user_id
+            return instance.attributes.get(field_name)
+        return super(UserConditionSet, self).get_field_value(instance, field_name)
+
+    def get_fingerprint(self, instance, compiled):
+        if not isinstance(instance, (User, EvaluationContext)):
+            # Anonymous users only check is_anonymous
+            return None
+        return super(UserConditionSet, self).get_fingerprint(instance, compiled)
+
+    def get_field_lookup(self, field_name):
+        field_name = self.pattern_fields.get(field_name, field_name)
+        return super(UserConditionSet, self).get_field_lookup(field_name)
+
+    def get_field_q(self, model, field_name, field, conditions):
+        if field_name == 'is_anonymous':
+            # Users loaded from the database are never anonymous
+            return False
+        return super(UserConditionSet, self).get_field_q(model, field_name, field, conditions)
+
+    def get_field_mask(self, columns, field_name, field, conditions):
+        if field_name == 'is_anonymous':
+            return False
+        return super(UserConditionSet, self).get_field_mask(columns, field_name, field, conditions)
+
+    def is_active_compiled(self, instance, compiled):
         """
-        value is the current value of the switch
+        compiled holds the conditions of the switch
         instance is the instance of our type
         """
-        if isinstance(instance, User):
-            return super(UserConditionSet, self).is_active(instance, conditions, switch_type)
+        if isinstance(instance, (User, EvaluationContext)):
+            return super(UserConditionSet, self).is_active_compiled(instance, compiled)
 
         # HACK: allow is_authenticated to work on AnonymousUser
-        condition = conditions.get(self.get_namespace(), {}).get('is_anonymous')
+        condition = compiled.conditions.get('is_anonymous')
         if condition is not None:
             return bool(condition)
         return None
@@ -68,18 +116,30 @@ class IPAddressConditionSet(RequestConditionSet):
     ip_address = IPAddress(label='IP Address')
     internal_ip = Boolean(label='Internal IPs')
 
+    is_pure = True
+
     def get_namespace(self):
         return 'ip'
 
+    def can_execute(self, instance):
+        if isinstance(instance, EvaluationContext):
+            return instance.ip is not None
+        return super(IPAddressConditionSet, self).can_execute(instance)
+
     def get_field_value(self, instance, field_name):
+        if isinstance(instance, EvaluationContext):
+            address = instance.ip
+        else:
+            address = instance.META['REMOTE_ADDR']
+
         # XXX: can we come up w/ a better API?
         # Ensure we map ``percent`` to the ``id`` column
         if field_name == 'percent':
-            return self._ip_to_int(instance.META['REMOTE_ADDR'])
+            return self._ip_to_int(address)
         elif field_name == 'ip_address':
-            return instance.META['REMOTE_ADDR']
+            return address
         elif field_name == 'internal_ip':
-            return instance.META['REMOTE_ADDR'] in settings.INTERNAL_IPS
+            return address in settings.INTERNAL_IPS
         return super(IPAddressConditionSet, self).get_field_value(instance, field_name)
 
     def _ip_to_int(self, ip):
@@ -96,10 +156,138 @@ class IPAddressConditionSet(RequestConditionSet):
         return 'IP Address'
 
 
+class Header(KeyValue):
+    """
+    Matches headers by their ``request.META`` key, e.g. ``X-Canary=1`` checks
+    ``HTTP_X_CANARY``.
+    """
+    def normalize_name(self, name):
+        return get_meta_key(name)
+
+
+@gargoyle.register
+class HTTPConditionSet(RequestConditionSet):
+    """
+    Checks conditions against the headers, cookies and query parameters of a
+    request, without needing its user.
+    """
+    header = Header(label='Header', help_text='e.g. X-Canary=1, or X-Canary for any value')
+    cookie = KeyValue(label='Cookie', help_text='e.g. beta=1, or beta for any value')
+    query_param = KeyValue(label='Query parameter', help_text='e.g. preview=1, or preview for any value')
+    user_agent = Regex(label='User agent matches', help_text='e.g. Firefox/|Chrome/')
+
+    def get_namespace(self):
+        return 'http'
+
+    def can_execute(self, instance):
+        if isinstance(instance, EvaluationContext):
+            # Only contexts made from a request have any of it
+            return instance.ip is not None or bool(instance.headers)
+        return super(HTTPConditionSet, self).can_execute(instance)
+
+    def get_field_value(self, instance, field_name):
+        if isinstance(instance, EvaluationContext):
+            if field_name == 'header':
+                return instance.headers
+            elif field_name == 'user_agent':
+                return instance.headers.get('HTTP_USER_AGENT', '')
+            # Cookies and query parameters are unknown
+            return None
+
+        # Django parses these once per request, so they're passed as they are
+        if field_name == 'header':
+            return instance.META
+        elif field_name == 'cookie':
+            return instance.COOKIES
+        elif field_name == 'query_param':
+            return instance.GET
+        elif field_name == 'user_agent':
+            return instance.META.get('HTTP_USER_AGENT', '')
+        return super(HTTPConditionSet, self).get_field_value(instance, field_name)
+
+    def get_group_label(self):
+        return 'HTTP Request'
+
+
+class CountryCode(String):
+    def clean(self, value):
+        value = value.strip().upper()
+        if not re.match(r'^[A-Z]{2}$', value):
+            raise ValidationError("You must enter a two letter ISO 3166-1 country code.")
+        return value
+
+
+class RegionCode(String):
+    def clean(self, value):
+        value = value.strip().upper()
+        if not re.match(r'^[A-Z]{2}-[A-Z0-9]{1,3}$', value):
+            raise ValidationError("You must enter an ISO 3166-2 region code, e.g. US-CA.")
+        return value
+
+
+class GeoIPConditionSet(RequestConditionSet):
+    """
+    Checks conditions against the location of ``REMOTE_ADDR``, as found in the
+    database file at ``settings.GARGOYLE_GEOIP_DATABASE``. Registered only if
+    that setting is present.
+
+    Database files are written with ``gargoyle.geoip.write_database()``.
+    """
+    country = CountryCode(label='Country')
+    region = RegionCode(label='Region')
+
+    def get_namespace(self):
+        return 'geoip'
+
+    def get_database(self):
+        return get_database(settings.GARGOYLE_GEOIP_DATABASE)
+
+    def can_execute(self, instance):
+        if isinstance(instance, EvaluationContext):
+            return instance.ip is not None
+        return super(GeoIPConditionSet, self).can_execute(instance)
+
+    def get_location(self, request):
+        """
+        Returns the ``gargoyle.geoip.Location`` of the request, looking it up
+        once per request.
+        """
+        if isinstance(request, EvaluationContext):
+            return self.get_database().lookup(request.ip)
+
+        address = request.META.get('REMOTE_ADDR')
+        cached = getattr(request, '_gargoyle_geoip_location', None)
+        if cached is not None and cached[0] == address:
+            return cached[1]
+
+        location = self.get_database().lookup(address)
+        request._gargoyle_geoip_location = (address, location)
+        return location
+
+    def get_field_value(self, instance, field_name):
+        location = self.get_location(instance)
+        if location is None:
+            return None
+        if field_name == 'country':
+            return location.country
+        elif field_name == 'region':
+            return location.region
+        return super(GeoIPConditionSet, self).get_field_value(instance, field_name)
+
+    def get_group_label(self):
+        return 'Location'
+
+
+if getattr(settings, 'GARGOYLE_GEOIP_DATABASE', None):
+    gargoyle.register(GeoIPConditionSet)
+
+
 @gargoyle.register
 class HostConditionSet(ConditionSet):
     hostname = String()
 
+    is_static = True
+
     def get_namespace(self):
         return 'host'
 
@@ -114,29 +302,74 @@ class HostConditionSet(ConditionSet):
         return 'Host'
 
 
+class AbstractTodayConditionSet(ConditionSet):
+    """
+    Base for condition sets checking today's date in some timezone.
+
+    Unless the timezone can change between checks, the result only changes
+    at midnight before one of the condition dates. Subclasses that implement
+    ``date_to_timestamp`` are therefore static, and a compiled switch only
+    re-evaluates them once that time has passed.
+    """
+    def can_execute(self, instance):
+        return instance is None
+
+    def get_next_transition(self, compiled):
+        today = self.get_field_value(None, None).date()
+        upcoming = set()
+        for name, field in six.iteritems(self.fields):
+            for field_condition in compiled.conditions.get(name, []):
+                try:
+                    date = field.str_to_date(field_condition[1])
+                except (TypeError, ValueError):
+                    continue
+                if date > today:
+                    upcoming.add(date)
+        if not upcoming:
+            return None
+        return self.date_to_timestamp(min(upcoming))
+
+    def date_to_timestamp(self, date):
+        """
+        Returns the Unix timestamp of the start of ``date`` in this condition
+        set's timezone.
+        """
+        raise NotImplementedError
+
+    def get_group_label(self):
+        return 'Today'
+
+
+def _midnight_timestamp(date, tz):
+    midnight = datetime.combine(date, time())
+    if hasattr(tz, 'localize'):
+        # pytz; the earliest reading if midnight is ambiguous
+        return min(calendar.timegm(tz.localize(midnight, is_dst=is_dst).utctimetuple()) for is_dst in (True, False))
+    return calendar.timegm(midnight.replace(tzinfo=tz).utctimetuple())
+
+
 @gargoyle.register
-class UTCTodayConditionSet(ConditionSet):
+class UTCTodayConditionSet(AbstractTodayConditionSet):
     """
     Checks conditions against current time in UTC
     """
     today_is_on_or_after = OnOrAfterDate('in UTC on or after')
     today_is_before = BeforeDate('in UTC before')
 
+    is_static = True
+
     def get_namespace(self):
         return 'now_utc'
 
-    def can_execute(self, instance):
-        return instance is None
-
     def get_field_value(self, instance, field_name):
         return datetime.utcnow()
 
-    def get_group_label(self):
-        return 'Today'
+    def date_to_timestamp(self, date):
+        return calendar.timegm(date.timetuple())
 
 
 @gargoyle.register
-class AppTodayConditionSet(ConditionSet):
+class AppTodayConditionSet(AbstractTodayConditionSet):
     """
     Checks conditions against current app timezone time or
     against current server time if Django timezone support disabled (USE_TZ=False)
@@ -144,24 +377,25 @@ class AppTodayConditionSet(ConditionSet):
     today_is_on_or_after = OnOrAfterDate('in default timezone on or after')
     today_is_before = BeforeDate('in default timezone before')
 
+    is_static = True
+
     def get_namespace(self):
         return 'now_app_tz'
 
-    def can_execute(self, instance):
-        return instance is None
-
     def get_field_value(self, instance, field_name):
         now_dt = timezone.now()
         if timezone.is_aware(now_dt):
             now_dt = timezone.make_naive(now_dt, timezone.get_default_timezone())
         return now_dt
 
-    def get_group_label(self):
-        return 'Today'
+    def date_to_timestamp(self, date):
+        if settings.USE_TZ:
+            return _midnight_timestamp(date, timezone.get_default_timezone())
+        return mktime(date.timetuple())
 
 
 @gargoyle.register
-class ActiveTimezoneTodayConditionSet(ConditionSet):
+class ActiveTimezoneTodayConditionSet(AbstractTodayConditionSet):
     """
     Checks conditions against current time of active timezone or
     against current server time if Django timezone support disabled (USE_TZ=False)
@@ -169,17 +403,13 @@ class ActiveTimezoneTodayConditionSet(ConditionSet):
     today_is_on_or_after = OnOrAfterDate('in active timezone on or after')
     today_is_before = BeforeDate('in active timezone before')
 
+    # Not static, the active timezone can differ between requests
+
     def get_namespace(self):
         return 'now_active_tz'
 
-    def can_execute(self, instance):
-        return instance is None
-
     def get_field_value(self, instance, field_name):
         now_dt = timezone.now()
         if timezone.is_aware(now_dt):
             now_dt = timezone.make_naive(now_dt)
         return now_dt
-
-    def get_group_label(self):
-        return 'Today'
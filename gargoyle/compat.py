@@ -8,6 +8,41 @@ try:
 except ImportError:
     from contextdecorator import ContextDecorator
 
+# Python 3.11 deprecated sre_parse as a public module
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse  # noqa
+
+# NumPy is optional, for evaluating switches in batches
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# asgiref ships with Django 3.0+, for running sync code from asyncio
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+# OpenTelemetry is optional, for writing evaluation hooks as spans
+
+try:
+    from opentelemetry import trace as opentelemetry_trace
+except ImportError:
+    opentelemetry_trace = None
+
+# tracemalloc is Python 3.4+, for measuring the memory the switch table takes
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
 # Django 1.9
 
 # url(prefix, include(urls, namespace, name)) -> url(prefix, (urls, namespace, name))
@@ -17,6 +52,13 @@ if django.VERSION[:2] >= (1, 9):
 else:
     from django.conf.urls import include as subinclude
 
+# Django 1.10
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:  # pragma: no cover
+    MiddlewareMixin = object
+
 # Django 2.0
 
 try:
@@ -25,4 +67,7 @@ except ImportError:
     from django.core.urlresolvers import reverse  # noqa pragma: no cover
 
 
-__all__ = ['ContextDecorator', 'subinclude']
+__all__ = [
+    'ContextDecorator', 'MiddlewareMixin', 'numpy', 'opentelemetry_trace', 'sre_parse', 'subinclude', 'sync_to_async',
+    'tracemalloc',
+]
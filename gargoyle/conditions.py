@@ -8,22 +8,79 @@ gargoyle.conditions
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import bisect
 import datetime
 import itertools
+import re
 
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
 from django.core.validators import ValidationError
+from django.db.models import DateTimeField, F, Q
 from django.http import HttpRequest
-from django.utils import six
+from django.utils import six, timezone
 from django.utils.html import format_html
 
-from gargoyle.constants import FEATURE
-from gargoyle.models import EXCLUDE
+from gargoyle.compat import numpy, sre_parse
+from gargoyle.constants import EXCLUDE, FEATURE
 
 
 def titlize(s):
     return s.title().replace('_', ' ')
 
 
+class QueryNotSupported(ValueError):
+    """
+    Raised when the conditions of a switch can't be expressed as a database
+    query, or evaluated over arrays of values.
+    """
+
+
+# Queries are built from ``Q`` objects, or ``True`` and ``False`` to match
+# every row or none, which are simplified away as they're combined.
+
+def q_not(term):
+    if isinstance(term, bool):
+        return not term
+    return ~term
+
+
+def q_or(*terms):
+    result = False
+    for term in terms:
+        if term is True:
+            return True
+        elif term is not False:
+            result = term if result is False else result | term
+    return result
+
+
+def q_and(*terms):
+    result = True
+    for term in terms:
+        if term is False:
+            return False
+        elif term is not True:
+            result = term if result is True else result & term
+    return result
+
+
+def overrides_is_active(field, klass):
+    """
+    Returns ``True`` if ``field`` has an ``is_active`` of its own, rather than
+    that of ``klass``, whose indexes then wouldn't match it.
+    """
+    return six.get_unbound_function(type(field).is_active) is not six.get_unbound_function(klass.is_active)
+
+
+def each_mask(matcher, values):
+    """
+    Returns a boolean NumPy array of ``matcher`` applied to each of
+    ``values``, as the Python objects ``compile``d matchers expect.
+    """
+    return numpy.fromiter((bool(matcher(value)) for value in values.tolist()), dtype=bool, count=len(values))
+
+
 class Field(object):
     default_help_text = None
 
@@ -40,6 +97,43 @@ class Field(object):
     def is_active(self, condition, value):
         return condition == value
 
+    def compile(self, conditions):
+        """
+        Given the list of conditions stored for this field, returns a callable
+        which takes a value and returns ``True`` if any of the conditions are
+        active for it.
+        """
+        conditions = tuple(conditions)
+        is_active = self.is_active
+        return lambda value: any(is_active(condition, value) for condition in conditions)
+
+    def get_q(self, lookup, conditions, model):
+        """
+        Given the list of conditions stored for this field, returns a ``Q``
+        matching the rows of ``model`` for which any of the conditions are
+        active, where ``lookup`` names the column holding the value. Raises
+        ``QueryNotSupported`` if the conditions can't be expressed in SQL.
+        """
+        if six.get_unbound_function(type(self).is_active) is not six.get_unbound_function(Field.is_active):
+            raise QueryNotSupported('%s conditions cannot be expressed in SQL' % (self.__class__.__name__,))
+        return Q(**{lookup + '__in': list(conditions)})
+
+    def get_mask(self, conditions, values):
+        """
+        Given the list of conditions stored for this field, and a NumPy array
+        of values, returns a boolean array which is ``True`` where any of the
+        conditions are active. Values which can't be compared as a whole array
+        are checked one at a time, with the matcher from ``compile``.
+        """
+        if six.get_unbound_function(type(self).is_active) is six.get_unbound_function(Field.is_active):
+            kind = values.dtype.kind
+            if kind == 'U':
+                return numpy.isin(values, numpy.array(list(conditions), dtype='U'))
+            elif kind in 'biufcmM':
+                # Numbers and dates never equal the strings conditions are stored as
+                return numpy.zeros(len(values), dtype=bool)
+        return each_mask(self.compile(conditions), values)
+
     def validate(self, data):
         value = data.get(self.name)
         if value:
@@ -62,6 +156,14 @@ class Boolean(Field):
     def is_active(self, condition, value):
         return bool(value)
 
+    def get_q(self, lookup, conditions, model):
+        return Q(**{lookup: True})
+
+    def get_mask(self, conditions, values):
+        if values.dtype.kind in 'biufc':
+            return values != 0
+        return super(Boolean, self).get_mask(conditions, values)
+
     def render(self, value):
         return format_html('<input type="hidden" value="1" name="{name}"/>', name=self.name)
 
@@ -77,12 +179,61 @@ class Choice(Field):
     def is_active(self, condition, value):
         return value in self.choices
 
+    def get_q(self, lookup, conditions, model):
+        return Q(**{lookup + '__in': list(self.choices)})
+
     def clean(self, value):
         if value not in self.choices:
             raise ValidationError
         return value
 
 
+class IntervalIndex(object):
+    """
+    A sorted list of non-overlapping closed intervals, searched with ``bisect``.
+
+    >>> 7 in IntervalIndex([(0, 5), (3, 10)])
+    True
+    """
+    __slots__ = ('lowers', 'uppers')
+
+    def __init__(self, intervals):
+        merged = []
+        for lower, upper in sorted(intervals):
+            if lower > upper:
+                # Matches nothing
+                continue
+            if merged and lower <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], upper)
+            else:
+                merged.append([lower, upper])
+        self.lowers = [interval[0] for interval in merged]
+        self.uppers = [interval[1] for interval in merged]
+
+    def __contains__(self, value):
+        index = bisect.bisect_right(self.lowers, value) - 1
+        return index >= 0 and value <= self.uppers[index]
+
+    def __len__(self):
+        return len(self.lowers)
+
+    def __repr__(self):
+        return '<%s: %s>' % (
+            self.__class__.__name__,
+            ', '.join('%s-%s' % bounds for bounds in zip(self.lowers, self.uppers)),
+        )
+
+    def get_mask(self, values):
+        """
+        Returns a boolean NumPy array which is ``True`` for the numeric
+        ``values`` in the index.
+        """
+        if not self.lowers:
+            return numpy.zeros(len(values), dtype=bool)
+        index = numpy.searchsorted(self.lowers, values, side='right') - 1
+        return (index >= 0) & (values <= numpy.array(self.uppers)[numpy.maximum(index, 0)])
+
+
 class Range(Field):
     # Only Python 3 catches str being incomparable with int, do this whilst we support Python 2
     integer_comparable_types = six.integer_types + (float,)
@@ -93,6 +244,43 @@ class Range(Field):
         bounds = list(map(int, condition.split('-')))
         return value >= bounds[0] and value <= bounds[1]
 
+    def compile(self, conditions):
+        if overrides_is_active(self, Range):
+            return super(Range, self).compile(conditions)
+        try:
+            index = self.compile_index(conditions)
+        except (AttributeError, IndexError, TypeError, ValueError):
+            # Leave malformed conditions to fail in is_active(), as they always have
+            return super(Range, self).compile(conditions)
+
+        integer_comparable_types = self.integer_comparable_types
+        return lambda value: isinstance(value, integer_comparable_types) and value in index
+
+    def compile_index(self, conditions):
+        """
+        Returns an ``IntervalIndex`` merging all of the given ``min-max`` conditions.
+        """
+        intervals = []
+        for condition in conditions:
+            bounds = list(map(int, condition.split('-')))
+            intervals.append((bounds[0], bounds[1]))
+        return IntervalIndex(intervals)
+
+    def get_q(self, lookup, conditions, model):
+        if overrides_is_active(self, Range):
+            return super(Range, self).get_q(lookup, conditions, model)
+        index = self.compile_index(conditions)
+        return q_or(*(Q(**{lookup + '__range': bounds}) for bounds in zip(index.lowers, index.uppers)))
+
+    def get_mask(self, conditions, values):
+        # Booleans are integers to is_active(), so leave them to it
+        if values.dtype.kind in 'iuf' and not overrides_is_active(self, Range):
+            try:
+                return self.compile_index(conditions).get_mask(values)
+            except (AttributeError, IndexError, TypeError, ValueError):
+                pass
+        return super(Range, self).get_mask(conditions, values)
+
     def validate(self, data):
         minimum = data.get(self.name + '[min]', '')
         maximum = data.get(self.name + '[max]', '')
@@ -145,6 +333,35 @@ class Percent(Range):
         mod = value % 100
         return mod >= condition[0] and mod <= condition[1]
 
+    def compile(self, conditions):
+        if overrides_is_active(self, Percent):
+            return Field.compile(self, conditions)
+        try:
+            index = self.compile_index(conditions)
+        except (AttributeError, IndexError, TypeError, ValueError):
+            return Field.compile(self, conditions)
+
+        return lambda value: value % 100 in index
+
+    def get_q(self, lookup, conditions, model):
+        if overrides_is_active(self, Percent):
+            return Field.get_q(self, lookup, conditions, model)
+        index = self.compile_index(conditions)
+        buckets = q_or(*(Q(gargoyle_percent__range=bounds) for bounds in zip(index.lowers, index.uppers)))
+        if buckets is False:
+            return False
+        # Q objects can't filter on expressions, so select the matching rows in a subquery
+        matching = model._base_manager.annotate(gargoyle_percent=F(lookup) % 100).filter(buckets)
+        return Q(pk__in=matching.values('pk'))
+
+    def get_mask(self, conditions, values):
+        if values.dtype.kind in 'iuf' and not overrides_is_active(self, Percent):
+            try:
+                return self.compile_index(conditions).get_mask(values % 100)
+            except (AttributeError, IndexError, TypeError, ValueError):
+                pass
+        return Field.get_mask(self, conditions, values)
+
     def display(self, value):
         value = value.split('-')
         return '%s: %s%% (%s-%s)' % (self.label, int(value[1]) - int(value[0]), value[0], value[1])
@@ -167,6 +384,288 @@ class String(Field):
     pass
 
 
+class Pattern(Field):
+    """
+    Base class for fields matching string values against patterns. All the
+    conditions of a switch compile into a single matcher.
+    """
+    def is_active(self, condition, value):
+        if not isinstance(value, six.string_types):
+            return False
+        return self.pattern_is_active(condition, value)
+
+    def pattern_is_active(self, condition, value):
+        raise NotImplementedError
+
+    def clean(self, value):
+        if not value:
+            raise ValidationError("You must enter a pattern.")
+        return value
+
+    def display(self, value):
+        return '%s: %s' % (self.label, value)
+
+
+class Prefix(Pattern):
+    def pattern_is_active(self, condition, value):
+        return value.startswith(condition)
+
+    def compile(self, conditions):
+        prefixes = tuple(conditions)
+        return lambda value: isinstance(value, six.string_types) and value.startswith(prefixes)
+
+    def get_q(self, lookup, conditions, model):
+        return q_or(*(Q(**{lookup + '__startswith': condition}) for condition in conditions))
+
+    def get_mask(self, conditions, values):
+        if values.dtype.kind == 'U':
+            return q_or(*(numpy.char.startswith(values, condition) for condition in conditions))
+        return super(Prefix, self).get_mask(conditions, values)
+
+
+class Suffix(Pattern):
+    def pattern_is_active(self, condition, value):
+        return value.endswith(condition)
+
+    def compile(self, conditions):
+        suffixes = tuple(conditions)
+        return lambda value: isinstance(value, six.string_types) and value.endswith(suffixes)
+
+    def get_q(self, lookup, conditions, model):
+        return q_or(*(Q(**{lookup + '__endswith': condition}) for condition in conditions))
+
+    def get_mask(self, conditions, values):
+        if values.dtype.kind == 'U':
+            return q_or(*(numpy.char.endswith(values, condition) for condition in conditions))
+        return super(Suffix, self).get_mask(conditions, values)
+
+
+def _subpatterns(av):
+    if isinstance(av, sre_parse.SubPattern):
+        yield av
+    elif isinstance(av, (list, tuple)):
+        for item in av:
+            for subpattern in _subpatterns(item):
+                yield subpattern
+
+
+#: Repeats of more than this many are checked as if they were unbounded
+REPEAT_LIMIT = 10
+
+_REPEATS = tuple(
+    getattr(sre_parse, name) for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT') if hasattr(sre_parse, name)
+)
+
+
+# Character classes with a known, small set of characters
+_CATEGORY_CHARACTERS = {
+    sre_parse.CATEGORY_DIGIT: frozenset(range(ord('0'), ord('9') + 1)),
+    sre_parse.CATEGORY_SPACE: frozenset(ord(character) for character in ' \t\n\r\f\v'),
+}
+
+
+def _first_characters(pattern):
+    """
+    Returns ``(characters, nullable)``: the set of the codes of the characters
+    a match of the parsed ``pattern`` can start with, or ``None`` if they
+    can't be listed, and whether it can match the empty string.
+    """
+    characters = set()
+    for op, av in pattern:
+        if op == sre_parse.LITERAL:
+            characters.add(av)
+            return characters, False
+        elif op == sre_parse.IN:
+            for item_op, item_av in av:
+                if item_op == sre_parse.LITERAL:
+                    characters.add(item_av)
+                elif item_op == sre_parse.RANGE and item_av[1] - item_av[0] < 256:
+                    characters.update(range(item_av[0], item_av[1] + 1))
+                elif item_op == sre_parse.CATEGORY and item_av in _CATEGORY_CHARACTERS:
+                    characters.update(_CATEGORY_CHARACTERS[item_av])
+                else:
+                    return None, False
+            return characters, False
+        elif op == sre_parse.SUBPATTERN:
+            first, nullable = _first_characters(av[-1])
+        elif op in _REPEATS:
+            first, nullable = _first_characters(av[2])
+            nullable = nullable or av[0] == 0
+        elif op == sre_parse.BRANCH:
+            first, nullable = set(), False
+            for branch in av[1]:
+                branch_first, branch_nullable = _first_characters(branch)
+                if branch_first is None:
+                    return None, False
+                first.update(branch_first)
+                nullable = nullable or branch_nullable
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            # Zero width
+            continue
+        else:
+            return None, False
+
+        if first is None:
+            return None, False
+        characters.update(first)
+        if not nullable:
+            return characters, False
+    return characters, True
+
+
+def _branches_overlap(branches):
+    """
+    Returns ``True`` if more than one of the parsed ``branches`` of an
+    alternation can match at the same position, e.g. the empty branches left
+    of ``(a|a)`` once the parser has factored out the common ``a``.
+    """
+    seen = set()
+    for branch in branches:
+        first, nullable = _first_characters(branch)
+        if first is None or nullable or seen & first:
+            return True
+        seen.update(first)
+    return False
+
+
+def _ends_ambiguously(repeated, following):
+    """
+    Returns ``True`` if, after a match of the parsed ``repeated``, the
+    ``following`` items could start with the same character as another
+    repetition, so the repeat could end in more than one place.
+    """
+    if not following:
+        # The next repetition of the enclosing repeat follows
+        return True
+    first, _ = _first_characters(repeated)
+    following_first, nullable = _first_characters(following)
+    return first is None or following_first is None or nullable or bool(first & following_first)
+
+
+def validate_pattern(pattern, in_repeat=False):
+    """
+    Raises ``ValidationError`` for the constructs which make regular
+    expressions backtrack catastrophically: backreferences, unbounded
+    repetition nested inside unbounded repetition, such as ``(a+)+``,
+    alternations inside unbounded repetition whose branches can match the
+    same text, such as ``(a|aa)+``, and repeats of a varying length inside
+    them which could end in more than one place, such as ``(a{1,3})+``.
+    Repeats of more than ``REPEAT_LIMIT`` count as unbounded, as in
+    ``(a?){30}``.
+    """
+    for index, (op, av) in enumerate(pattern):
+        if op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+            raise ValidationError("Backreferences are not allowed.")
+        if op == sre_parse.BRANCH and in_repeat and _branches_overlap(av[1]):
+            raise ValidationError(
+                "Repeated alternatives which can match the same text, such as (a|aa)+, are not allowed.",
+            )
+        if op in _REPEATS:
+            unbounded = av[1] == sre_parse.MAXREPEAT
+            if unbounded and in_repeat:
+                raise ValidationError("Nested repetition such as (a+)+ is not allowed.")
+            if in_repeat and av[0] != av[1] and _ends_ambiguously(av[2], pattern[index + 1:]):
+                raise ValidationError("Nested repetition such as (a{1,3})+ or (a?){30} is not allowed.")
+            validate_pattern(av[2], in_repeat or unbounded or av[1] > REPEAT_LIMIT)
+        else:
+            for subpattern in _subpatterns(av):
+                validate_pattern(subpattern, in_repeat)
+
+
+class Regex(Pattern):
+    """
+    Matches values where the regular expression is found anywhere, like
+    ``re.search()``; anchor it with ``^`` and ``$`` as needed.
+    """
+    def pattern_is_active(self, condition, value):
+        return re.search(condition, value) is not None
+
+    def clean(self, value):
+        value = super(Regex, self).clean(value)
+        try:
+            parsed = sre_parse.parse(value)
+        except (re.error, OverflowError) as e:
+            raise ValidationError("Invalid regular expression: %s" % six.text_type(e))
+        validate_pattern(parsed)
+        return value
+
+    def compile(self, conditions):
+        try:
+            # Group numbers shift once combined, so anything clean() would
+            # reject has to be matched separately
+            for condition in conditions:
+                validate_pattern(sre_parse.parse(condition))
+            combined = re.compile('|'.join('(?:%s)' % condition for condition in conditions))
+        except (re.error, OverflowError, ValidationError):
+            # e.g. inline flags, which are only valid at the start of a pattern
+            return super(Regex, self).compile(conditions)
+
+        search = combined.search
+        return lambda value: isinstance(value, six.string_types) and search(value) is not None
+
+    def get_q(self, lookup, conditions, model):
+        # Patterns are run by the database, in its own regular expression dialect
+        return q_or(*(Q(**{lookup + '__regex': condition}) for condition in conditions))
+
+
+class KeyValue(Field):
+    """
+    Matches conditions of the form ``name=value``, or just ``name`` to match
+    any value, against a mapping such as ``request.COOKIES``. All the
+    conditions of a switch compile into one set of values per name.
+    """
+    name_re = re.compile(r'^[A-Za-z0-9!#$%&\'*+.^_`|~-]+$')
+
+    def parse(self, condition):
+        name, sep, value = condition.partition('=')
+        return self.normalize_name(name.strip()), (value if sep else None)
+
+    def normalize_name(self, name):
+        return name
+
+    def is_active(self, condition, value):
+        if value is None:
+            return False
+        name, expected = self.parse(condition)
+        actual = value.get(name)
+        if actual is None:
+            return False
+        return expected is None or actual == expected
+
+    def compile(self, conditions):
+        present = set()
+        expected = {}
+        for condition in conditions:
+            name, value = self.parse(condition)
+            if value is None:
+                present.add(name)
+            else:
+                expected.setdefault(name, set()).add(value)
+        present = tuple(present)
+        expected = tuple((name, frozenset(values)) for name, values in six.iteritems(expected))
+
+        def matcher(mapping):
+            if mapping is None:
+                return False
+            for name in present:
+                if mapping.get(name) is not None:
+                    return True
+            for name, values in expected:
+                if mapping.get(name) in values:
+                    return True
+            return False
+        return matcher
+
+    def clean(self, value):
+        name = value.partition('=')[0].strip()
+        if not self.name_re.match(name):
+            raise ValidationError("You must enter a name, optionally followed by =value.")
+        return value.strip()
+
+    def display(self, value):
+        return '%s: %s' % (self.label, value)
+
+
 class AbstractDate(Field):
     DATE_FORMAT = "%Y-%m-%d"
     PRETTY_DATE_FORMAT = "%d %b %Y"
@@ -192,32 +691,122 @@ class AbstractDate(Field):
 
         return format_html('<input type="text" value="{value}" name="{name}"/>', value=value, name=self.name)
 
-    def is_active(self, condition, value):
+    def value_to_date(self, value):
         assert isinstance(value, datetime.date)
         if isinstance(value, datetime.datetime):
             # datetime.datetime cannot be compared to datetime.date with > and < operators
             value = value.date()
+        return value
 
+    def is_active(self, condition, value):
+        if value is None:
+            return False
+        value = self.value_to_date(value)
         condition_date = self.str_to_date(condition)
         return self.date_is_active(condition_date, value)
 
     def date_is_active(self, condition_date, value):
         raise NotImplementedError
 
+    def compile_threshold(self, conditions, choose):
+        """
+        Compiles conditions which reduce to a single date, such as the earliest
+        of several "on or after" dates. Returns ``None`` if a condition can't
+        be parsed, to leave it to fail in is_active().
+        """
+        try:
+            threshold = choose(self.str_to_date(condition) for condition in conditions)
+        except (TypeError, ValueError):
+            return None
+
+        value_to_date = self.value_to_date
+        date_is_active = self.date_is_active
+        return lambda value: value is not None and date_is_active(threshold, value_to_date(value))
+
+    def get_threshold_mask(self, conditions, values, choose):
+        """
+        Same as ``compile_threshold``, but for a NumPy array of values. Arrays
+        of ``datetime64`` are compared by day.
+        """
+        if values.dtype.kind == 'M':
+            try:
+                threshold = choose(self.str_to_date(condition) for condition in conditions)
+            except (TypeError, ValueError):
+                pass
+            else:
+                return self.date_is_active(numpy.datetime64(threshold, 'D'), values.astype('datetime64[D]'))
+        return super(AbstractDate, self).get_mask(conditions, values)
+
+    def date_to_column(self, date, lookup, model):
+        """
+        Returns the value a column is compared with to compare its date with
+        ``date``. Datetimes are compared by the date they fall on as loaded,
+        which is in UTC when ``USE_TZ`` is set.
+        """
+        if not isinstance(model._meta.get_field(lookup), DateTimeField):
+            return date
+        value = datetime.datetime.combine(date, datetime.time())
+        if settings.USE_TZ:
+            value = timezone.make_aware(value, timezone.utc)
+        return value
+
 
 class BeforeDate(AbstractDate):
     def date_is_active(self, before_this_date, value):
         return value < before_this_date
 
+    def compile(self, conditions):
+        # Before any of the dates is before the latest of them
+        return self.compile_threshold(conditions, max) or super(BeforeDate, self).compile(conditions)
+
+    def get_q(self, lookup, conditions, model):
+        threshold = max(self.str_to_date(condition) for condition in conditions)
+        return Q(**{lookup + '__lt': self.date_to_column(threshold, lookup, model)})
+
+    def get_mask(self, conditions, values):
+        return self.get_threshold_mask(conditions, values, max)
+
 
 class OnOrAfterDate(AbstractDate):
     def date_is_active(self, after_this_date, value):
         return value >= after_this_date
 
+    def compile(self, conditions):
+        # On or after any of the dates is on or after the earliest of them
+        return self.compile_threshold(conditions, min) or super(OnOrAfterDate, self).compile(conditions)
+
+    def get_q(self, lookup, conditions, model):
+        threshold = min(self.str_to_date(condition) for condition in conditions)
+        return Q(**{lookup + '__gte': self.date_to_column(threshold, lookup, model)})
+
+    def get_mask(self, conditions, values):
+        return self.get_threshold_mask(conditions, values, min)
+
+
+class CompiledConditions(object):
+    """
+    The conditions of one switch for one ConditionSet and switch type, as
+    returned by ``ConditionSet.compile``.
+
+    ``fields`` is a tuple of ``(field_name, include, exclude)``, where
+    ``include`` and ``exclude`` are the callables built by ``Field.compile``,
+    or ``None``. ``conditions`` holds the raw conditions of the namespace.
+    """
+    __slots__ = ('conditions', 'fields')
+
+    def __init__(self, conditions, fields):
+        self.conditions = conditions
+        self.fields = tuple(fields)
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, ', '.join(field[0] for field in self.fields))
+
 
 class ConditionSetBase(type):
     def __new__(cls, name, bases, attrs):
         attrs['fields'] = {}
+        # Not inherited, as subclasses may check more than their fields
+        attrs.setdefault('is_pure', False)
 
         # Inherit any fields from parent(s).
         parents = [b for b in bases if isinstance(b, ConditionSetBase)]
@@ -240,6 +829,19 @@ class ConditionSetBase(type):
 
 
 class ConditionSet(six.with_metaclass(ConditionSetBase)):
+    #: Set to ``True`` if the result of this ConditionSet never depends on
+    #: the instances checked, and doesn't change for the life of the process
+    #: other than at the times given by ``get_next_transition``, e.g. checks
+    #: on the hostname. Static ConditionSets are evaluated once when a switch
+    #: is compiled rather than on every check.
+    is_static = False
+
+    #: Set to ``True`` if the result of this ConditionSet only depends on
+    #: which instances it can execute and on what ``get_fingerprint`` returns
+    #: for them, e.g. checks on the fields of a user. The results of switches
+    #: whose conditions are all in pure ConditionSets are cached by
+    #: fingerprint. Unlike ``is_static``, it isn't inherited by subclasses.
+    is_pure = False
 
     def __repr__(self):
         return '<%s>' % (self.__class__.__name__,)
@@ -265,6 +867,14 @@ class ConditionSet(six.with_metaclass(ConditionSetBase)):
         """
         return self.__class__.__name__
 
+    def get_next_transition(self, compiled):
+        """
+        For static ConditionSets, given the ``CompiledConditions`` of a switch,
+        returns the Unix timestamp after which the result may have changed and
+        must be evaluated again, or ``None`` if it never changes.
+        """
+        return None
+
     def get_field_value(self, instance, field_name):
         """
         Given an instance, and the name of an attribute, returns the value
@@ -281,6 +891,16 @@ class ConditionSet(six.with_metaclass(ConditionSetBase)):
             value = value()
         return value
 
+    def get_fingerprint(self, instance, compiled):
+        """
+        For pure ConditionSets, given an instance and the ``CompiledConditions``
+        of a switch, returns a hashable value which is equal for any instances
+        ``is_active_compiled`` gives the same result for.
+
+        Default behavior returns the values of the fields with conditions.
+        """
+        return tuple(self.get_field_value(instance, field[0]) for field in compiled.fields)
+
     def has_active_condition(self, conditions, instances, switch_type=FEATURE):
         """
         Given a list of instances, and the conditions active for
@@ -307,6 +927,24 @@ class ConditionSet(six.with_metaclass(ConditionSetBase)):
                 return_value = True
         return return_value
 
+    def has_active_compiled_condition(self, compiled, instances):
+        """
+        Same as ``has_active_condition``, but takes the ``CompiledConditions``
+        returned by ``compile`` rather than the raw conditions of the switch.
+        """
+        return_value = None
+
+        for instance in itertools.chain(instances, [None]):
+            if not self.can_execute(instance):
+                continue
+
+            result = self.is_active_compiled(instance, compiled)
+            if result is False:
+                return False
+            elif result is True:
+                return_value = True
+        return return_value
+
     def is_active(self, instance, conditions, switch_type=FEATURE):
         """
         Given an instance, and the conditions active for this switch, returns
@@ -317,31 +955,102 @@ class ConditionSet(six.with_metaclass(ConditionSetBase)):
           We want to check if a ConditionSet has some condition active for AB_TEST.
           In this case all the conditions with type FEATURE are ignored.
         """
+        compiled = self.compile(conditions, switch_type)
+        if compiled is None:
+            return None
+        return self.is_active_compiled(instance, compiled)
+
+    def is_active_compiled(self, instance, compiled):
+        """
+        Given an instance, and the ``CompiledConditions`` for this switch,
+        returns a boolean representing if the feature is active.
+
+        An exclude condition that matches always wins. Otherwise the feature is
+        active if an include condition matches, or an exclude condition exists
+        but doesn't match.
+        """
         return_value = None
-        for name, field in six.iteritems(self.fields):
-            field_conditions = conditions.get(self.get_namespace(), {}).get(name)
-            if field_conditions:
-                value = self.get_field_value(instance, name)
-                for field_condition in field_conditions:
-                    status = field_condition[0]
-                    condition = field_condition[1]
-                    # Backwards compatibility: Conditions created before the AB_TEST feature was added
-                    # only have `status` and `condition`. In this case `condition_type` is default
-                    # to FEATURE which is the previous behaviour
-                    condition_type = FEATURE if len(field_condition) < 3 else field_condition[2]
-
-                    if switch_type != condition_type:  # Ignore condition with no switch type
-                        continue
-                    exclude = status == EXCLUDE
-                    if field.is_active(condition, value):
-                        if exclude:
-                            return False
-                        return_value = True
-                    else:
-                        if exclude:
-                            return_value = True
+        for name, include, exclude in compiled.fields:
+            value = self.get_field_value(instance, name)
+            if exclude is not None:
+                if exclude(value):
+                    return False
+                return_value = True
+            if include is not None and include(value):
+                return_value = True
         return return_value
 
+    def compile(self, conditions, switch_type=FEATURE):
+        """
+        Given the conditions active for a switch, returns a ``CompiledConditions``
+        holding an include and an exclude matcher for each field with conditions
+        of type ``switch_type``, or ``None`` if the switch has no conditions in
+        this ConditionSet's namespace.
+        """
+        namespace_conditions = conditions.get(self.get_namespace())
+        if not namespace_conditions:
+            return None
+
+        fields = []
+        for name, field, include, exclude in self.get_field_conditions(namespace_conditions, switch_type):
+            fields.append((
+                name,
+                field.compile(include) if include else None,
+                field.compile(exclude) if exclude else None,
+            ))
+
+        return CompiledConditions(namespace_conditions, fields)
+
+    def get_field_conditions(self, namespace_conditions, switch_type=FEATURE):
+        """
+        Given the conditions of a switch in this ConditionSet's namespace,
+        yields ``(field_name, field, include, exclude)`` for each field with
+        conditions of type ``switch_type``, where ``include`` and ``exclude``
+        are lists of the raw conditions.
+        """
+        for name, field in six.iteritems(self.fields):
+            field_conditions = namespace_conditions.get(name)
+            if not field_conditions:
+                continue
+
+            include = []
+            exclude = []
+            for field_condition in field_conditions:
+                # Backwards compatibility: Conditions created before the AB_TEST feature was added
+                # only have `status` and `condition`. In this case `condition_type` is default
+                # to FEATURE which is the previous behaviour
+                condition_type = FEATURE if len(field_condition) < 3 else field_condition[2]
+                if switch_type != condition_type:  # Ignore condition with no switch type
+                    continue
+                if field_condition[0] == EXCLUDE:
+                    exclude.append(field_condition[1])
+                else:
+                    include.append(field_condition[1])
+
+            if include or exclude:
+                yield name, field, include, exclude
+
+    def get_q(self, model, conditions, switch_type=FEATURE):
+        """
+        Given a model whose instances this ConditionSet can execute, and the
+        conditions active for a switch, returns a pair of ``Q`` objects
+        matching the rows for which ``is_active`` would return ``True`` and
+        ``False`` respectively. Either may be ``True`` or ``False`` instead,
+        to match every row or none.
+
+        Raises ``QueryNotSupported`` if the conditions can't be expressed in
+        SQL, which is the default.
+        """
+        raise QueryNotSupported('%s conditions cannot be expressed in SQL' % (self.__class__.__name__,))
+
+    def get_mask(self, columns, conditions, switch_type=FEATURE):
+        """
+        Same as ``get_q``, but returns boolean NumPy arrays for the rows of
+        ``columns``, a dict of equal length NumPy arrays keyed by model field
+        name, rather than ``Q`` objects.
+        """
+        raise QueryNotSupported('%s conditions cannot be evaluated in batches' % (self.__class__.__name__,))
+
     def get_group_label(self):
         """
         Returns a string representing a human readable version
@@ -375,6 +1084,74 @@ class ModelConditionSet(ConditionSet):
     def get_group_label(self):
         return self.model._meta.verbose_name.title()
 
+    def get_field_lookup(self, field_name):
+        """
+        Returns the name of the model field checked by ``field_name``.
+
+        Default behavior will map the ``percent`` attribute to ``id``. Subclasses
+        overriding ``get_field_value`` should override this to match.
+        """
+        if field_name == 'percent':
+            return 'id'
+        return field_name
+
+    def get_field_q(self, model, field_name, field, conditions):
+        """
+        Returns a ``Q`` matching the rows of ``model`` for which any of the
+        conditions of ``field_name`` are active.
+        """
+        lookup = self.get_field_lookup(field_name)
+        try:
+            model._meta.get_field(lookup)
+        except FieldDoesNotExist:
+            raise QueryNotSupported('%s is not a database field of %s' % (lookup, model.__name__))
+        return field.get_q(lookup, conditions, model)
+
+    def get_field_mask(self, columns, field_name, field, conditions):
+        """
+        Returns a boolean NumPy array which is ``True`` for the rows of
+        ``columns`` for which any of the conditions of ``field_name`` are
+        active.
+        """
+        lookup = self.get_field_lookup(field_name)
+        try:
+            values = columns[lookup]
+        except KeyError:
+            raise ValueError('No %s column was given' % (lookup,))
+        return field.get_mask(conditions, values)
+
+    def get_q(self, model, conditions, switch_type=FEATURE):
+        return self.combine_fields(
+            conditions, switch_type,
+            lambda name, field, field_conditions: self.get_field_q(model, name, field, field_conditions),
+        )
+
+    def get_mask(self, columns, conditions, switch_type=FEATURE):
+        return self.combine_fields(
+            conditions, switch_type,
+            lambda name, field, field_conditions: self.get_field_mask(columns, name, field, field_conditions),
+        )
+
+    def combine_fields(self, conditions, switch_type, get_field_rows):
+        """
+        Combines the rows matched by each field, as returned by
+        ``get_field_rows(field_name, field, conditions)``, into the rows
+        ``is_active`` would return ``True`` and ``False`` for.
+        """
+        # Mirrors is_active_compiled(): an exclude condition that matches always
+        # wins, and one that exists makes every other row active
+        excluded = False
+        included = False
+        for name, field, include, exclude in self.get_field_conditions(
+            conditions.get(self.get_namespace(), {}), switch_type,
+        ):
+            if exclude:
+                excluded = q_or(excluded, get_field_rows(name, field, exclude))
+                included = True
+            if include:
+                included = q_or(included, get_field_rows(name, field, include))
+        return q_and(q_not(excluded), included), excluded
+
 
 class RequestConditionSet(ConditionSet):
     def get_namespace(self):
@@ -0,0 +1,47 @@
+"""
+gargoyle.context
+~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from django.utils import six
+
+UNPREFIXED_HEADERS = ('CONTENT_LENGTH', 'CONTENT_TYPE')
+
+
+def get_meta_key(header):
+    """
+    Returns the ``request.META`` key of a header, e.g. ``HTTP_X_CANARY`` for
+    ``X-Canary``.
+    """
+    key = header.upper().replace('-', '_')
+    if key in UNPREFIXED_HEADERS:
+        return key
+    return 'HTTP_' + key
+
+
+class EvaluationContext(object):
+    """
+    What is known about the subject of a switch check, for code without a
+    request or model instance to hand, such as tasks and management commands.
+    The builtin condition sets read it in place of users and requests.
+
+    ``attributes`` holds user fields, such as ``is_staff``; checks on
+    anything else don't match. Headers are keyed as in ``request.META``.
+
+    >>> context = EvaluationContext(user_id=5, attributes={'is_staff': True}, ip='10.0.0.1')
+    >>> gargoyle.is_active('my_feature', context)
+    """
+    __slots__ = ('user_id', 'attributes', 'ip', 'headers')
+
+    def __init__(self, user_id=None, attributes=None, ip=None, headers=None):
+        self.user_id = user_id
+        self.attributes = attributes if attributes is not None else {}
+        self.ip = ip
+        self.headers = dict((get_meta_key(name), value) for name, value in six.iteritems(headers or {}))
+
+    def __repr__(self):
+        return '<%s: user_id=%r ip=%r>' % (self.__class__.__name__, self.user_id, self.ip)
@@ -0,0 +1,331 @@
+"""
+gargoyle.explain
+~~~~~~~~~~~~~~~~
+
+Structured traces of how a switch is evaluated, as returned by
+``SwitchManager.explain``.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import itertools
+
+from django.http import HttpRequest
+
+from gargoyle.stats import timer
+
+from .constants import DISABLED, FEATURE, GLOBAL, INHERIT, SELECTIVE
+
+STATUS_NAMES = {
+    DISABLED: 'disabled',
+    SELECTIVE: 'selective',
+    GLOBAL: 'global',
+    INHERIT: 'inherit',
+}
+
+
+class Explanation(object):
+    """
+    How ``is_active`` decided the ``result`` for ``key``: a ``SwitchStep``
+    for each switch consulted, outermost parent first, and the ``duration``
+    of the whole evaluation in seconds.
+    """
+    __slots__ = ('key', 'result', 'duration', 'switches')
+
+    def __init__(self, key, result, duration, switches):
+        self.key = key
+        self.result = result
+        self.duration = duration
+        self.switches = switches
+
+    def __repr__(self):
+        return '<%s: %s=%r>' % (self.__class__.__name__, self.key, self.result)
+
+    def as_dict(self):
+        return {
+            'key': self.key,
+            'result': self.result,
+            'duration': self.duration,
+            'switches': [step.as_dict() for step in self.switches],
+        }
+
+
+class SwitchStep(object):
+    """
+    The evaluation of one switch: its ``status`` name, or ``None`` if it's
+    missing, the ``reason`` for its ``result``, the result ``folded`` from its
+    static condition sets at compile time, and a ``ConditionSetStep`` for each
+    other condition set evaluated.
+
+    A ``result`` of ``None`` means the switch deferred to its parents, or to
+    the default.
+    """
+    __slots__ = ('key', 'status', 'reason', 'result', 'folded', 'condition_sets', 'duration')
+
+    def __init__(self, key, status=None):
+        self.key = key
+        self.status = status
+        self.reason = None
+        self.result = None
+        self.folded = None
+        self.condition_sets = []
+        self.duration = 0.0
+
+    def __repr__(self):
+        return '<%s: %s %s=%r>' % (self.__class__.__name__, self.key, self.reason, self.result)
+
+    def as_dict(self):
+        return {
+            'key': self.key,
+            'status': self.status,
+            'reason': self.reason,
+            'result': self.result,
+            'folded': self.folded,
+            'condition_sets': [step.as_dict() for step in self.condition_sets],
+            'duration': self.duration,
+        }
+
+
+class ConditionSetStep(object):
+    """
+    The evaluation of one condition set, with an ``InstanceStep`` for each
+    instance it could execute, including the final ``None``.
+    """
+    __slots__ = ('condition_set', 'result', 'instances', 'duration')
+
+    def __init__(self, condition_set):
+        self.condition_set = condition_set
+        self.result = None
+        self.instances = []
+        self.duration = 0.0
+
+    def __repr__(self):
+        return '<%s: %s=%r>' % (self.__class__.__name__, self.condition_set, self.result)
+
+    def as_dict(self):
+        return {
+            'condition_set': self.condition_set,
+            'result': self.result,
+            'instances': [step.as_dict() for step in self.instances],
+            'duration': self.duration,
+        }
+
+
+class InstanceStep(object):
+    """
+    The evaluation of one instance, with a ``FieldStep`` for each field value
+    the condition set read.
+    """
+    __slots__ = ('instance', 'result', 'fields', 'duration')
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.result = None
+        self.fields = []
+        self.duration = 0.0
+
+    def as_dict(self):
+        return {
+            'instance': None if self.instance is None else repr(self.instance),
+            'result': self.result,
+            'fields': [step.as_dict() for step in self.fields],
+            'duration': self.duration,
+        }
+
+
+class FieldStep(object):
+    """
+    A field value read with ``get_field_value``, the time that took, and the
+    ``include`` and ``exclude`` conditions of the switch matching it.
+    """
+    __slots__ = ('name', 'value', 'include', 'exclude', 'duration')
+
+    def __init__(self, name, value, duration):
+        self.name = name
+        self.value = value
+        self.include = []
+        self.exclude = []
+        self.duration = duration
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'value': self.value,
+            'include': self.include,
+            'exclude': self.exclude,
+            'duration': self.duration,
+        }
+
+
+_recording_classes = {}
+
+
+def _get_recording_class(klass):
+    """
+    Returns a subclass of the ConditionSet class ``klass`` which records the
+    field values read by ``get_field_value`` in ``_explain_fields``.
+    """
+    recording_class = _recording_classes.get(klass)
+    if recording_class is not None:
+        return recording_class
+
+    def get_field_value(self, instance, field_name):
+        started = timer()
+        value = klass.get_field_value(self, instance, field_name)
+        self._explain_fields.append(FieldStep(field_name, value, timer() - started))
+        return value
+
+    # The original id and namespace, which default to the class name
+    def get_id(self):
+        return self._explain_condition_set.get_id()
+
+    def get_namespace(self):
+        return self._explain_condition_set.get_namespace()
+
+    recording_class = type(klass)(str('Explain%s' % (klass.__name__,)), (klass,), {
+        '__module__': klass.__module__,
+        'get_field_value': get_field_value,
+        'get_id': get_id,
+        'get_namespace': get_namespace,
+    })
+    _recording_classes[klass] = recording_class
+    return recording_class
+
+
+def _get_recorder(condition_set):
+    recorder = object.__new__(_get_recording_class(type(condition_set)))
+    recorder.__dict__.update(condition_set.__dict__)
+    recorder._explain_condition_set = condition_set
+    recorder._explain_fields = []
+    return recorder
+
+
+def explain(manager, switches, key, instances, default=False, switch_type=FEATURE, snapshot=None):
+    """
+    Evaluates ``key`` like ``SwitchManager.is_active_in``, looking switches up
+    in ``switches`` and plans in ``snapshot``, but without using cached
+    results, and returns an ``Explanation``.
+    """
+    if instances:
+        # HACK: support request.user by swapping in User instance, as is_active_in does
+        instances = list(instances)
+        for v in instances:
+            if isinstance(v, HttpRequest) and hasattr(v, 'user'):
+                instances.append(v.user)
+
+    steps = []
+    started = timer()
+    result = _explain_switch(manager, switches, snapshot, key, instances, default, switch_type, steps)
+    return Explanation(key, result, timer() - started, steps)
+
+
+def _explain_switch(manager, switches, snapshot, key, instances, default, switch_type, steps):
+    # Check all parents for a disabled state
+    parts = key.split(':')
+    if len(parts) > 1:
+        parent = _explain_switch(manager, switches, snapshot, ':'.join(parts[:-1]), instances, None, switch_type, steps)
+        if parent is False:
+            step = SwitchStep(key)
+            step.reason = 'parent'
+            step.result = False
+            steps.append(step)
+            return False
+        elif parent is True:
+            default = True
+
+    started = timer()
+    try:
+        switch = switches[key]
+    except KeyError:
+        step = SwitchStep(key)
+        step.reason = 'missing'
+        steps.append(step)
+        return default
+
+    step = SwitchStep(key, STATUS_NAMES.get(switch.status))
+    steps.append(step)
+    result = _explain_status(manager, snapshot, switch, instances, default, switch_type, step)
+    step.duration = timer() - started
+    return result
+
+
+def _explain_status(manager, snapshot, switch, instances, default, switch_type, step):
+    if switch.status in (GLOBAL, DISABLED):
+        step.reason = 'status'
+        step.result = switch.status == GLOBAL
+        return step.result
+    elif switch.status == INHERIT:
+        step.reason = 'inherit'
+        return default
+
+    conditions = switch.value
+    if not conditions:
+        step.reason = 'no conditions'
+        return default
+
+    plan = manager.get_plan(switch, switch_type, snapshot=snapshot)
+    step.folded = plan.folded
+    if plan.folded is False:
+        step.reason = 'static conditions'
+        step.result = False
+        return False
+
+    step.reason = 'conditions'
+    return_value = plan.folded is True
+    for condition_set, compiled in plan.conditions:
+        condition_set_step = _explain_condition_set(condition_set, compiled, conditions, instances, switch_type)
+        step.condition_sets.append(condition_set_step)
+        if condition_set_step.result is False:
+            return_value = False
+            break
+        elif condition_set_step.result is True:
+            return_value = True
+    step.result = return_value
+    return return_value
+
+
+def _explain_condition_set(condition_set, compiled, conditions, instances, switch_type):
+    step = ConditionSetStep(condition_set.get_id())
+    recorder = _get_recorder(condition_set)
+    if compiled is not None:
+        field_conditions = dict(
+            (name, (field, include, exclude))
+            for name, field, include, exclude in condition_set.get_field_conditions(compiled.conditions, switch_type)
+        )
+
+    started = timer()
+    for instance in itertools.chain(instances, [None]):
+        if not condition_set.can_execute(instance):
+            continue
+
+        instance_step = InstanceStep(instance)
+        step.instances.append(instance_step)
+        recorder._explain_fields = instance_step.fields
+        instance_started = timer()
+        if compiled is not None:
+            result = recorder.is_active_compiled(instance, compiled)
+        elif switch_type == FEATURE:
+            result = recorder.is_active(instance, conditions)
+        else:
+            result = recorder.is_active(instance, conditions, switch_type)
+        instance_step.duration = timer() - instance_started
+        instance_step.result = result
+
+        if compiled is not None:
+            for field_step in instance_step.fields:
+                if field_step.name not in field_conditions:
+                    continue
+                field, include, exclude = field_conditions[field_step.name]
+                value = field_step.value
+                field_step.include = [condition for condition in include if field.is_active(condition, value)]
+                field_step.exclude = [condition for condition in exclude if field.is_active(condition, value)]
+
+        if result is False:
+            step.result = False
+            break
+        elif result is True:
+            step.result = True
+    step.duration = timer() - started
+    return step
@@ -0,0 +1,149 @@
+"""
+gargoyle.geoip
+~~~~~~~~~~~~~~
+
+A minimal reader and writer for GeoIP database files, used by
+``gargoyle.builtins.GeoIPConditionSet``.
+
+A database file is a header followed by fixed width records, sorted by their
+first address::
+
+    b'GGEOIP1\\n'    magic
+    !I              number of records
+    !16s16s2s6s     first address, last address, country, region
+
+Addresses are stored as 16 byte IPv6 addresses, with IPv4 addresses mapped
+into ``::ffff:0:0/96``. The file is memory-mapped and searched in place, so
+workers forked from the same parent share its pages rather than each holding
+a copy of the data.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import mmap
+import socket
+import struct
+import threading
+from collections import namedtuple
+
+MAGIC = b'GGEOIP1\n'
+HEADER = struct.Struct(str('!8sI'))
+RECORD = struct.Struct(str('!16s16s2s6s'))
+
+IPV4_PREFIX = b'\x00' * 10 + b'\xff' * 2
+
+Location = namedtuple('Location', ('country', 'region'))
+
+
+def pack_address(address):
+    """
+    Returns the 16 byte form of an IPv4 or IPv6 address, or ``None`` if it is
+    not a valid address.
+    """
+    try:
+        if ':' in address:
+            return socket.inet_pton(socket.AF_INET6, address)
+        return IPV4_PREFIX + socket.inet_pton(socket.AF_INET, address)
+    except (socket.error, TypeError, ValueError):
+        return None
+
+
+class GeoIPDatabase(object):
+    """
+    Looks up the location of IP addresses in a memory-mapped database file.
+
+    >>> GeoIPDatabase('/path/to/geoip.dat').lookup('81.2.69.160')
+    Location(country='GB', region='GB-ENG')
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < HEADER.size:
+            raise ValueError('%s is not a GeoIP database' % path)
+        magic, self.size = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or len(self._map) != HEADER.size + self.size * RECORD.size:
+            raise ValueError('%s is not a GeoIP database' % path)
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.path)
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        self._map.close()
+
+    def lookup(self, address):
+        """
+        Returns the ``Location`` of ``address``, or ``None`` if it isn't in
+        the database.
+        """
+        packed = pack_address(address)
+        if packed is None:
+            return None
+
+        data = self._map
+        lo, hi = 0, self.size
+        # Find the last record starting at or before the address
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = HEADER.size + mid * RECORD.size
+            if packed < data[offset:offset + 16]:
+                hi = mid
+            else:
+                lo = mid + 1
+        if lo == 0:
+            return None
+
+        first, last, country, region = RECORD.unpack_from(data, HEADER.size + (lo - 1) * RECORD.size)
+        if packed > last:
+            return None
+        return Location(country.decode('ascii'), region.rstrip(b'\x00').decode('ascii') or None)
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(path):
+    """
+    Returns the ``GeoIPDatabase`` for ``path``, mapping it on first use so
+    each process maps a file only once.
+    """
+    try:
+        return _databases[path]
+    except KeyError:
+        pass
+
+    with _databases_lock:
+        if path not in _databases:
+            _databases[path] = GeoIPDatabase(path)
+        return _databases[path]
+
+
+def write_database(path, ranges):
+    """
+    Writes a database file from an iterable of
+    ``(first_address, last_address, country, region)`` tuples, such as the
+    rows of a country CSV export. ``region`` may be ``None``.
+    """
+    records = []
+    for first, last, country, region in ranges:
+        packed_first, packed_last = pack_address(first), pack_address(last)
+        if packed_first is None or packed_last is None or packed_first > packed_last:
+            raise ValueError('Invalid address range %s-%s' % (first, last))
+        records.append((packed_first, packed_last, country.upper(), (region or '').upper()))
+    records.sort()
+
+    for previous, record in zip(records, records[1:]):
+        if record[0] <= previous[1]:
+            raise ValueError('Overlapping address ranges')
+
+    with open(path, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, len(records)))
+        for first, last, country, region in records:
+            fp.write(RECORD.pack(first, last, country.encode('ascii'), region.encode('ascii')))
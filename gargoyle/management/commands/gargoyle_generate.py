@@ -0,0 +1,80 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from argparse import ArgumentTypeError
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from gargoyle import gargoyle
+from gargoyle.models import Switch
+from gargoyle.synthetic import SwitchGenerator
+
+
+def condition_range(value):
+    """
+    Parses ``N`` or ``MIN-MAX`` into a ``(minimum, maximum)`` pair.
+    """
+    try:
+        bounds = [int(bound) for bound in value.split('-')]
+    except ValueError:
+        bounds = []
+    if len(bounds) == 1:
+        bounds *= 2
+    if len(bounds) != 2 or not 0 <= bounds[0] <= bounds[1]:
+        raise ArgumentTypeError('Expected a number, or a range such as 1-10, not %r.' % (value,))
+    return tuple(bounds)
+
+
+def ratio(value):
+    value = float(value)
+    if not 0 <= value <= 1:
+        raise ArgumentTypeError('Expected a ratio between 0 and 1, not %r.' % (value,))
+    return value
+
+
+class Command(BaseCommand):
+    help = (
+        'Creates synthetic switches, with nested keys and conditions for every registered condition set, for load '
+        'testing. The same seed always creates the same switches.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--switches', type=int, default=1000,
+                            help='The number of switches to create.')
+        parser.add_argument('--conditions-per-switch', type=condition_range, default=(1, 10),
+                            help='The number of conditions of each selective switch, or a range such as 1-10.')
+        parser.add_argument('--max-depth', type=int, default=3,
+                            help='How many levels deep keys can be nested.')
+        parser.add_argument('--exclude-ratio', type=ratio, default=0.2,
+                            help='The fraction of conditions which are excludes.')
+        parser.add_argument('--ab-test-ratio', type=ratio, default=0.1,
+                            help='The fraction of conditions which are for A/B tests.')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seeds the random choices.')
+        parser.add_argument('--prefix', default='synthetic',
+                            help='The prefix of the keys of the switches.')
+        parser.add_argument('--replace', action='store_true', default=False,
+                            help='Delete the switches generated with the prefix first.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='How many switches to insert per query.')
+
+    def handle(self, *args, **options):
+        generator = SwitchGenerator(
+            gargoyle,
+            seed=options['seed'],
+            conditions=options['conditions_per_switch'],
+            max_depth=options['max_depth'],
+            exclude_ratio=options['exclude_ratio'],
+            ab_test_ratio=options['ab_test_ratio'],
+            prefix=options['prefix'],
+        )
+        switches = list(generator.generate(options['switches']))
+
+        # bulk_create() doesn't send post_save, and deleting each switch would
+        # reload them all, so they're reloaded once at the end instead
+        with gargoyle.defer_reloads(), transaction.atomic():
+            if options['replace']:
+                Switch.objects.filter(key__startswith=generator.key_prefix).delete()
+            Switch.objects.bulk_create(switches, batch_size=options['batch_size'])
+
+        self.stdout.write('Created %d switches.' % (len(switches),))
@@ -0,0 +1,78 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+
+from django.core.management.base import BaseCommand
+
+from gargoyle import gargoyle
+from gargoyle.memory import format_size
+
+
+class Command(BaseCommand):
+    help = (
+        'Shows how much memory the loaded switches, their compiled plans and the conditions of each condition set '
+        'take in this process, largest first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=10,
+                            help='Show at most this many switches.')
+        parser.add_argument('--no-tracemalloc', action='store_false', dest='trace', default=True,
+                            help='Skip measuring allocations with tracemalloc.')
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='Print the whole report as JSON.')
+
+    def handle(self, *args, **options):
+        report = gargoyle.memory_report(trace=options['trace'])
+        if options['json']:
+            self.stdout.write(json.dumps(report.as_dict(), indent=2, sort_keys=True))
+            return
+
+        self.stdout.write('%d switches take %s.' % (len(report.switches), format_size(report.size)))
+        if report.allocated is not None:
+            self.stdout.write('tracemalloc: %s loading switches, %s compiling plans.' % (
+                format_size(report.allocated['switches']), format_size(report.allocated['plans']),
+            ))
+        if not report.switches:
+            return
+
+        self.stdout.write('')
+        rows = [('Switch', 'Conditions', 'Switch size', 'Plan size', 'Total', '%', 'Largest field')]
+        for footprint in report.largest(options['limit']):
+            largest_field = '-'
+            if footprint.largest_field is not None:
+                largest_field = '%s.%s (%d)' % footprint.largest_field
+            rows.append((
+                footprint.key,
+                str(footprint.conditions),
+                format_size(footprint.switch_size),
+                format_size(footprint.plan_size),
+                format_size(footprint.size),
+                '%.1f' % (100 * footprint.size / report.size,),
+                largest_field,
+            ))
+        self.write_table(rows)
+
+        if not report.condition_sets:
+            return
+
+        self.stdout.write('')
+        rows = [('Condition set', 'Switches', 'Conditions', 'Conditions size', 'Compiled size', 'Total')]
+        for footprint in report.condition_sets:
+            rows.append((
+                footprint.namespace,
+                str(footprint.switches),
+                str(footprint.conditions),
+                format_size(footprint.value_size),
+                format_size(footprint.compiled_size),
+                format_size(footprint.size),
+            ))
+        self.write_table(rows)
+
+    def write_table(self, rows):
+        widths = [max(len(row[index]) for row in rows) for index in range(len(rows[0]))]
+        for row in rows:
+            self.stdout.write('  '.join(
+                value.ljust(width) if index in (0, len(row) - 1) else value.rjust(width)
+                for index, (value, width) in enumerate(zip(row, widths))
+            ).rstrip())
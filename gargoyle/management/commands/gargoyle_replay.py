@@ -0,0 +1,96 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gargoyle import gargoyle
+from gargoyle.replay import load_capture, load_switches, replay
+
+
+def format_latency(seconds):
+    if seconds is None:
+        return '-'
+    return '%.3f' % (seconds * 1000,)
+
+
+class Command(BaseCommand):
+    help = (
+        'Replays calls to is_active captured with gargoyle.replay.CaptureSink against a snapshot of the switches, '
+        'and reports the throughput, latency in milliseconds, and results which differ from the captured ones.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('capture',
+                            help='A capture written by CaptureSink, one call per line.')
+        parser.add_argument('--snapshot', default=None,
+                            help='Switches to replay against, as written by "gargoyle_snapshot". By default, the '
+                                 'switches in the database.')
+        parser.add_argument('--repeat', type=int, default=1,
+                            help='Replay the capture this many times.')
+        parser.add_argument('--limit', type=int, default=10,
+                            help='Show the differences of at most this many switches.')
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='Print the whole report as JSON.')
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1.')
+        try:
+            with io.open(options['capture'], encoding='utf-8') as stream:
+                records = load_capture(stream)
+        except (IOError, ValueError) as e:
+            raise CommandError('Could not read capture %s: %s' % (options['capture'], e))
+
+        if options['snapshot'] is None:
+            switches = gargoyle.get_snapshot().switches
+        else:
+            try:
+                with io.open(options['snapshot'], encoding='utf-8') as stream:
+                    switches = load_switches(stream)
+            except (IOError, ValueError) as e:
+                raise CommandError('Could not read snapshot %s: %s' % (options['snapshot'], e))
+
+        report = replay(gargoyle, records, switches, repeat=options['repeat'])
+        if options['json']:
+            self.stdout.write(json.dumps(report.as_dict(), indent=2, sort_keys=True))
+            return
+
+        self.stdout.write('Replayed %d calls to %d switches in %.3fs: %s calls/s.' % (
+            report.calls,
+            len(report.keys),
+            report.duration,
+            '-' if report.throughput is None else '%d' % (report.throughput,),
+        ))
+        self.stdout.write('Latency (ms): %s.' % ', '.join(
+            'p%d %s' % (percent, format_latency(report.percentile(percent))) for percent in (50, 90, 99)
+        ) + ' max %s.' % (format_latency(report.percentile(100)),))
+
+        if report.errors:
+            line, error = report.errors[0]
+            self.stdout.write('%d calls raised errors, first on line %d: %r' % (len(report.errors), line, error))
+
+        if not report.differences:
+            self.stdout.write('No results differ.')
+            return
+
+        self.stdout.write('%d results differ:' % (len(report.differences),))
+        rows = [('Switch', 'Calls', 'Differ', 'True to False', 'False to True', 'Lines')]
+        for key, differences in list(report.get_differences_by_key().items())[:options['limit']]:
+            rows.append((
+                key,
+                str(report.keys[key]),
+                str(len(differences)),
+                str(sum(1 for difference in differences if difference.captured is True)),
+                str(sum(1 for difference in differences if difference.result is True)),
+                ', '.join(str(difference.line) for difference in differences[:5])
+                + (', ...' if len(differences) > 5 else ''),
+            ))
+
+        widths = [max(len(row[index]) for row in rows) for index in range(len(rows[0]))]
+        for row in rows:
+            self.stdout.write('  '.join(
+                value.ljust(width) if index in (0, len(row) - 1) else value.rjust(width)
+                for index, (value, width) in enumerate(zip(row, widths))
+            ).rstrip())
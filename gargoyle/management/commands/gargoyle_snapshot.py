@@ -0,0 +1,15 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from gargoyle.replay import dump_switches
+
+
+class Command(BaseCommand):
+    help = (
+        'Writes the switches in the database as a snapshot for "gargoyle_replay --snapshot": a JSON list of their '
+        'keys, statuses and values.'
+    )
+
+    def handle(self, *args, **options):
+        dump_switches(self.stdout)
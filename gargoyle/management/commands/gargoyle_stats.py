@@ -0,0 +1,58 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from gargoyle import gargoyle
+
+SORT_KEYS = {
+    'calls': lambda stats: stats.calls,
+    'mean': lambda stats: stats.mean or 0,
+    'p99': lambda stats: stats.percentile(99) or 0,
+}
+
+
+def format_latency(seconds):
+    if seconds is None:
+        return '-'
+    return '%.3f' % (seconds * 1000,)
+
+
+class Command(BaseCommand):
+    help = (
+        'Shows how often each switch was checked, and how long the checks took in milliseconds, as published by '
+        'processes with GARGOYLE_STATS enabled.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sort', choices=sorted(SORT_KEYS), default='calls',
+                            help='Sort switches by this column, highest first.')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Show at most this many switches.')
+
+    def handle(self, *args, **options):
+        stats = sorted(gargoyle.get_published_stats().values(), key=SORT_KEYS[options['sort']], reverse=True)
+        if options['limit'] is not None:
+            stats = stats[:options['limit']]
+        if not stats:
+            self.stdout.write('No stats have been published.')
+            return
+
+        rows = [('Switch', 'Calls', 'True', 'False', 'Defaults', 'Mean', 'p50', 'p99')]
+        for key_stats in stats:
+            rows.append((
+                key_stats.key,
+                str(key_stats.calls),
+                str(key_stats.true),
+                str(key_stats.false),
+                str(key_stats.defaults),
+                format_latency(key_stats.mean),
+                format_latency(key_stats.percentile(50)),
+                format_latency(key_stats.percentile(99)),
+            ))
+
+        widths = [max(len(row[index]) for row in rows) for index in range(len(rows[0]))]
+        for row in rows:
+            self.stdout.write('  '.join(
+                value.ljust(width) if index == 0 else value.rjust(width)
+                for index, (value, width) in enumerate(zip(row, widths))
+            ).rstrip())
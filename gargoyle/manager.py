@@ -1,16 +1,273 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import itertools
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
 from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.core.cache import caches
+from django.core.exceptions import FieldDoesNotExist
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.db.models import DateTimeField, Q, QuerySet
 from django.http import HttpRequest
-from django.utils import six
+from django.utils import six, timezone
 from django.utils.functional import SimpleLazyObject
 from modeldict import ModelDict
+from modeldict.base import NoValue
 
+from gargoyle.compat import numpy
+from gargoyle.conditions import ConditionSet, ModelConditionSet, QueryNotSupported, q_and, q_not, q_or
+from gargoyle.explain import explain
+from gargoyle.memory import memory_report
 from gargoyle.proxy import SwitchProxy
+from gargoyle.stats import ManagerMetrics, SwitchStats, merge_counters, timer
+from gargoyle.tracing import Evaluation, EvaluationTrace
 
 from .constants import DISABLED, EXCLUDE, FEATURE, GLOBAL, INCLUDE, INHERIT, SELECTIVE
 
+logger = logging.getLogger('gargoyle')
+
+
+def _method_function(method):
+    return getattr(method, '__func__', method)
+
+
+def _is_compilable(condition_set):
+    """
+    Condition sets overriding ``is_active`` or ``has_active_condition`` predate
+    compiled conditions, so they're still handed the raw conditions.
+    """
+    klass = type(condition_set)
+    return all(
+        _method_function(getattr(klass, name)) is _method_function(getattr(ConditionSet, name))
+        for name in ('is_active', 'has_active_condition')
+    )
+
+
+class SwitchPlan(object):
+    """
+    The compiled conditions of a switch, as built by ``SwitchManager.compile``.
+
+    ``conditions`` is a tuple of ``(condition_set, compiled)`` pairs left to
+    evaluate. ``folded`` is the combined result of the static condition sets,
+    which were evaluated at compile time: ``False`` means the switch is
+    inactive whatever the instances, ``True`` that it's active unless another
+    condition set says otherwise, and ``None`` that there were none.
+    ``expires_at`` is the Unix timestamp after which ``folded`` may be out of
+    date and the plan must be compiled again, or ``None``.
+
+    ``results`` is a ``ResultCache`` of the results for each fingerprint of
+    the instances if all of ``conditions`` are in pure condition sets, or
+    ``None``.
+    """
+    __slots__ = ('conditions', 'folded', 'expires_at', 'results')
+
+    def __init__(self, conditions, folded=None, expires_at=None, results=None):
+        self.conditions = tuple(conditions)
+        self.folded = folded
+        self.expires_at = expires_at
+        self.results = results
+
+    def __repr__(self):
+        return '<%s: %r folded=%r>' % (self.__class__.__name__, self.conditions, self.folded)
+
+    def has_expired(self, now=None):
+        if self.expires_at is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now >= self.expires_at
+
+    def get_fingerprint(self, instances):
+        """
+        Returns the fingerprints of ``instances``, and the non-instance
+        default, for each condition set that can execute them.
+        """
+        return tuple(
+            tuple(
+                condition_set.get_fingerprint(instance, compiled)
+                for instance in itertools.chain(instances, [None])
+                if condition_set.can_execute(instance)
+            )
+            for condition_set, compiled in self.conditions
+        )
+
+
+class ResultCache(object):
+    """
+    A least recently used cache of up to ``size`` results.
+
+    It doesn't lock. A check racing another may miss, and evaluate the
+    switch itself, or evict one entry too many.
+    """
+    __slots__ = ('size', 'results')
+
+    def __init__(self, size):
+        self.size = size
+        self.results = OrderedDict()
+
+    def __len__(self):
+        return len(self.results)
+
+    def get(self, key):
+        """
+        Returns the result for ``key``, or ``None``.
+        """
+        try:
+            result = self.results.pop(key)
+        except (KeyError, TypeError):
+            # Missing, or the fingerprint holds unhashable values
+            return None
+        self.results[key] = result
+        return result
+
+    def set(self, key, result):
+        try:
+            self.results[key] = result
+        except TypeError:
+            return
+        while len(self.results) > self.size:
+            try:
+                self.results.popitem(last=False)
+            except KeyError:
+                break
+
+
+class SwitchSnapshot(object):
+    """
+    The state switches are checked against: ``switches``, the loaded switches
+    by key, and ``registry``, the registered condition sets by id.
+
+    Neither is changed once the snapshot is published. ``SwitchManager``
+    publishes a new snapshot instead, with a single assignment, so a check
+    holding a snapshot never sees a partial reload, and never takes a lock.
+
+    ``plans`` caches ``SwitchManager.get_plan`` for this snapshot. Entries are
+    only added, each with a single assignment. ``version`` counts the switch
+    tables published before this one.
+    """
+    __slots__ = ('switches', 'registry', 'plans', 'version')
+
+    def __init__(self, switches, registry, plans=None, version=0):
+        self.switches = switches
+        self.registry = registry
+        self.plans = {} if plans is None else plans
+        self.version = version
+
+    def __repr__(self):
+        return '<%s: %d switches>' % (self.__class__.__name__, len(self.switches))
+
+    def __getitem__(self, key):
+        return self.switches[key]
+
+    def __contains__(self, key):
+        return key in self.switches
+
+    def get(self, key, default=None):
+        return self.switches.get(key, default)
+
+
+class ManagerSwitches(object):
+    """
+    The mapping of switches ``is_active`` reads: a snapshot, with missing
+    switches created by the manager when ``auto_create`` is set.
+    """
+    __slots__ = ('manager', 'snapshot')
+
+    def __init__(self, manager, snapshot):
+        self.manager = manager
+        self.snapshot = snapshot
+
+    def __getitem__(self, key):
+        try:
+            return self.snapshot.switches[key]
+        except KeyError:
+            value = self.manager.get_default(key)
+            if value is NoValue:
+                raise
+            return value
+
+
+class SwitchMemo(object):
+    """
+    Results of ``is_active`` for one request, as kept by
+    ``SwitchManager.start_memo``. They're dropped once the manager publishes
+    a new snapshot.
+    """
+    __slots__ = ('snapshot', 'results')
+
+    def __init__(self):
+        self.snapshot = None
+        self.results = {}
+
+    def get_results(self, snapshot):
+        if snapshot is not self.snapshot:
+            self.snapshot = snapshot
+            self.results = {}
+        return self.results
+
+
+def _get_memo_key(key, instances, kwargs):
+    """
+    Returns the key of an ``is_active`` call in a ``SwitchMemo``, and the
+    objects whose identities it holds, which must outlive it.
+    """
+    objects = list(instances)
+    for instance in instances:
+        if isinstance(instance, HttpRequest):
+            # request.user is replaced on login
+            objects.append(getattr(instance, 'user', None))
+    memo_key = (
+        key,
+        kwargs.get('switch_type', FEATURE),
+        kwargs.get('default', False),
+        tuple(id(obj) for obj in objects),
+    )
+    return memo_key, objects
+
+
+class SwitchRefresher(threading.Thread):
+    """
+    Daemon thread which calls ``manager.refresh()`` every ``interval``
+    seconds, as started by ``SwitchManager.start_refresher``.
+    """
+    def __init__(self, manager, interval):
+        super(SwitchRefresher, self).__init__(name='gargoyle-refresher')
+        self.daemon = True
+        self.manager = manager
+        self.interval = interval
+        # Threads don't survive a fork, so children start their own
+        self.pid = os.getpid()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.manager.refresh()
+            except Exception:
+                logger.exception('Could not refresh switches')
+            finally:
+                close_old_connections()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+    def is_running(self):
+        """
+        Returns ``True`` if the thread is refreshing the switches of this
+        process.
+        """
+        return self.pid == os.getpid() and self.is_alive()
+
 
 class SwitchManager(ModelDict):
     DISABLED = DISABLED
@@ -21,9 +278,40 @@ class SwitchManager(ModelDict):
     INCLUDE = INCLUDE
     EXCLUDE = EXCLUDE
 
+    #: The number of results cached for each switch whose conditions are all
+    #: in pure condition sets, by the fingerprints of the instances checked.
+    #: ``0`` disables the cache.
+    result_cache_size = 1000
+
+    #: How often, in seconds, a process with stats enabled writes them to the
+    #: remote cache at the end of a request, and how long they're kept there.
+    stats_publish_interval = 60
+    stats_timeout = 60 * 60
+
+    #: How often, in seconds, a slow evaluation of the same switch is logged.
+    slow_evaluation_log_interval = 60
+
+    #: The thread started by ``start_refresher``.
+    refresher_class = SwitchRefresher
+
     def __init__(self, *args, **kwargs):
-        self._registry = {}
+        self._snapshot = SwitchSnapshot({}, {})
+        self._publish_lock = threading.Lock()
+        self._async_loader = None
+        self._refresher = None
+        self._refresher_lock = threading.Lock()
+        self._memo = threading.local()
+        self._trace = threading.local()
+        self._deferred_reloads = threading.local()
+        self._evaluation_hooks = ()
+        self._slow_evaluations_logged = {}
+        self.stats = None
+        # In seconds, see set_slow_evaluation_threshold
+        self.slow_evaluation_threshold = None
+        self.metrics = ManagerMetrics()
         super(SwitchManager, self).__init__(*args, **kwargs)
+        # Folded plans may depend on settings, such as TIME_ZONE
+        setting_changed.connect(self._clear_plans)
 
     def __repr__(self):
         return "<%s: %s (%s)>" % (self.__class__.__name__, self.model, self._registry.values())
@@ -36,6 +324,197 @@ class SwitchManager(ModelDict):
         """
         return SwitchProxy(self, super(SwitchManager, self).__getitem__(key))
 
+    @property
+    def _local_cache(self):
+        return self._snapshot.switches
+
+    @_local_cache.setter
+    def _local_cache(self, switches):
+        # ModelDict assigns freshly loaded switches
+        self._publish(switches=switches)
+
+    @property
+    def _registry(self):
+        return self._snapshot.registry
+
+    @_registry.setter
+    def _registry(self, registry):
+        self._publish(registry=registry)
+
+    def _publish(self, switches=None, registry=None, plans=None, version=None):
+        """
+        Replaces the current snapshot with one holding the given switches,
+        registry or plans, keeping the others. Only writers take the lock, so
+        that concurrent writes aren't lost.
+
+        If ``version`` is given and the switches were replaced since the
+        snapshot of that version, nothing is published and ``False`` is
+        returned.
+        """
+        with self._publish_lock:
+            snapshot = self._snapshot
+            if version is not None and snapshot.version != version:
+                return False
+            self._snapshot = SwitchSnapshot(
+                snapshot.switches if switches is None else switches,
+                snapshot.registry if registry is None else registry,
+                plans,
+                snapshot.version if switches is None else snapshot.version + 1,
+            )
+        return True
+
+    def get_snapshot(self):
+        """
+        Returns the current ``SwitchSnapshot``, after loading the switches or
+        checking them for changes as ``is_active`` does.
+        """
+        self._populate()
+        return self._snapshot
+
+    def clear_cache(self):
+        # Unlike ModelDict, keep the switches until they're reloaded, rather
+        # than clearing them in place under concurrent checks
+        self._local_last_updated = None
+        self._last_checked_for_remote_changes = 0.0
+
+    def _post_save(self, sender, instance, created, **kwargs):
+        if not getattr(self._deferred_reloads, 'active', False):
+            super(SwitchManager, self)._post_save(sender, instance, created, **kwargs)
+
+    def _post_delete(self, sender, instance, **kwargs):
+        if not getattr(self._deferred_reloads, 'active', False):
+            super(SwitchManager, self)._post_delete(sender, instance, **kwargs)
+
+    @contextmanager
+    def defer_reloads(self):
+        """
+        Reloads the switches once at the end of the block, rather than after
+        each switch saved or deleted by the current thread inside it, e.g.
+        when deleting many switches. Other threads still reload immediately.
+
+        >>> with gargoyle.defer_reloads():
+        >>>     Switch.objects.filter(key__startswith='old_').delete()
+        """
+        if getattr(self._deferred_reloads, 'active', False):
+            yield
+            return
+        self._deferred_reloads.active = True
+        try:
+            yield
+        finally:
+            self._deferred_reloads.active = False
+            self._populate(reset=True)
+
+    def _populate(self, reset=False):
+        if not reset and self._local_last_updated is not None:
+            refresher = self._refresher
+            if refresher is not None and refresher.pid != os.getpid():
+                refresher = self._restart_refresher(refresher)
+            if refresher is not None and refresher.is_running():
+                # The refresher checks for changes, off the request path
+                return self._local_cache
+            if not self.local_cache_has_expired():
+                return self._local_cache
+
+        started = timer()
+        switches = self._local_cache
+        # Switches not loaded from the database by this thread came from the cache
+        database_loads = self.metrics.get_accumulator()['database_loads']
+        if reset:
+            # Load the switches before swapping them in
+            self._update_cache_data()
+            loaded = self._local_cache
+        else:
+            loaded = super(SwitchManager, self)._populate()
+        if loaded is not switches:
+            from_cache = self.metrics.get_accumulator()['database_loads'] == database_loads
+            self.metrics.add(reloads=1, reload_time=timer() - started, cache_loads=int(from_cache))
+        return loaded
+
+    def get_cache_data(self):
+        self.metrics.add(database_loads=1)
+        return super(SwitchManager, self).get_cache_data()
+
+    def get_default(self, key):
+        if self.auto_create:
+            self.metrics.add(auto_creates=1)
+        return super(SwitchManager, self).get_default(key)
+
+    def refresh(self):
+        """
+        Checks the remote cache for changed switches now. If they changed, or
+        were never loaded, loads them and compiles their plans before swapping
+        them in, so checks in progress keep using the previous switches.
+
+        Returns ``True`` if the switches were swapped. They aren't if they
+        were reloaded in the meantime, e.g. after a save, as those are newer.
+        """
+        started = timer()
+        now = time.time()
+        version = self._snapshot.version
+        local_cache_is_invalid = self.local_cache_is_invalid()
+        if local_cache_is_invalid is None:
+            self.remote_cache.add(self.remote_cache_last_updated_key, now)
+
+        switches = None
+        if local_cache_is_invalid or local_cache_is_invalid is None:
+            switches = self.remote_cache.get(self.remote_cache_key)
+        from_cache = switches is not None
+        if switches is None and self._local_last_updated is None:
+            switches = self.get_cache_data()
+            self.remote_cache.set_many({
+                self.remote_cache_key: switches,
+                self.remote_cache_last_updated_key: now,
+            })
+
+        if switches is not None:
+            registry = self._registry
+            plans = {}
+            for switch in six.itervalues(switches):
+                if switch.status == SELECTIVE and switch.value:
+                    plan = self.compile(switch.value, registry=registry)
+                    plans[(switch.key, FEATURE)] = (switch.value, registry, plan)
+            if not self._publish(switches=switches, plans=plans, version=version):
+                return False
+            self._local_last_updated = now
+            self.metrics.add(reloads=1, reload_time=timer() - started, cache_loads=int(from_cache))
+        self._last_checked_for_remote_changes = now
+        return switches is not None
+
+    def start_refresher(self, interval=None):
+        """
+        Starts a daemon thread calling ``refresh`` every ``interval`` seconds,
+        which defaults to the manager's timeout. Checks then no longer look
+        for changes themselves, but switches saved in this process are still
+        reloaded immediately.
+
+        >>> gargoyle.start_refresher(interval=5)
+        """
+        self.stop_refresher()
+        refresher = self.refresher_class(self, self.timeout if interval is None else interval)
+        self._refresher = refresher
+        refresher.start()
+        return refresher
+
+    def _restart_refresher(self, refresher):
+        # The thread was started before this process was forked, and didn't
+        # survive it. Only the first check after the fork starts a new one.
+        with self._refresher_lock:
+            if self._refresher is refresher:
+                logger.info('Restarting the switch refresher after a fork')
+                self.start_refresher(refresher.interval)
+            return self._refresher
+
+    def stop_refresher(self):
+        """
+        Stops the thread started by ``start_refresher``, if any. Checks look
+        for changes themselves again.
+        """
+        refresher = self._refresher
+        if refresher is not None:
+            self._refresher = None
+            refresher.stop()
+
     def is_active(self, key, *instances, **kwargs):
         """
         Returns ``True`` if any of ``instances`` match an active switch. Otherwise
@@ -43,6 +522,268 @@ class SwitchManager(ModelDict):
 
         >>> gargoyle.is_active('my_feature', request)
         """
+        stats = self.stats
+        hooks = self._evaluation_hooks
+        slow_evaluation_threshold = self.slow_evaluation_threshold
+        if stats is None and not hooks and slow_evaluation_threshold is None:
+            return self._is_active(self.get_snapshot(), key, instances, kwargs)
+
+        # Sample before doing any more work
+        sampled = [hook for hook, sample_rate in hooks if sample_rate >= 1 or random.random() < sample_rate]
+        if stats is None and not sampled and slow_evaluation_threshold is None:
+            return self._is_active(self.get_snapshot(), key, instances, kwargs)
+
+        trace = previous_trace = None
+        if sampled:
+            trace = EvaluationTrace()
+            previous_trace = getattr(self._trace, 'current', None)
+            self._trace.current = trace
+        started = timer()
+        snapshot = self.get_snapshot()
+        try:
+            result = self._is_active(snapshot, key, instances, kwargs)
+        finally:
+            if trace is not None:
+                self._trace.current = previous_trace
+        duration = timer() - started
+
+        if stats is not None:
+            switch = snapshot.switches.get(key)
+            defaulted = switch is None or switch.status == INHERIT or (switch.status == SELECTIVE and not switch.value)
+            stats.record(key, result, duration, defaulted=defaulted, missing=switch is None)
+
+        if sampled:
+            evaluation = Evaluation(
+                key, result, duration, trace, instances,
+                switch_type=kwargs.get('switch_type', FEATURE), default=kwargs.get('default', False),
+            )
+            for hook in sampled:
+                try:
+                    hook(evaluation)
+                except Exception:
+                    logger.exception('Error in evaluation hook %r', hook)
+
+        if slow_evaluation_threshold is not None and duration >= slow_evaluation_threshold:
+            self._log_slow_evaluation(key, instances, kwargs, duration)
+        return result
+
+    def set_slow_evaluation_threshold(self, milliseconds):
+        """
+        Logs calls to ``is_active`` taking at least ``milliseconds``, at most
+        once every ``slow_evaluation_log_interval`` seconds for each switch.
+        ``None`` stops logging them. Set by ``GARGOYLE_SLOW_EVALUATION_MS``.
+        """
+        self.slow_evaluation_threshold = None if milliseconds is None else milliseconds / 1000
+
+    def _log_slow_evaluation(self, key, instances, kwargs, duration):
+        now = time.time()
+        if now < self._slow_evaluations_logged.get(key, 0) + self.slow_evaluation_log_interval:
+            return
+        self._slow_evaluations_logged[key] = now
+
+        # Only slow calls which are logged pay for timing each condition set,
+        # by evaluating the switch again
+        timings = OrderedDict()
+        decided = []
+        try:
+            explanation = self.explain(key, *instances, **kwargs)
+        except Exception:
+            logger.exception("Error explaining slow evaluation of switch '%s'", key)
+        else:
+            # A condition set may be evaluated for the switch and its parents
+            for step in explanation.switches:
+                for condition_set_step in step.condition_sets:
+                    condition_set = condition_set_step.condition_set
+                    timings[condition_set] = timings.get(condition_set, 0) + condition_set_step.duration
+                    if condition_set_step.result is not None:
+                        decided.append(condition_set)
+
+        instance_types = [type(instance).__name__ for instance in instances]
+        logger.warning(
+            "Slow evaluation of switch '%s' took %.1fms for %s; condition sets deciding: %s; "
+            "time per condition set: %s",
+            key,
+            duration * 1000,
+            ', '.join(instance_types) or 'no instances',
+            ', '.join(decided) or 'none',
+            ', '.join('%s %.1fms' % (condition_set, timing * 1000) for condition_set, timing in timings.items())
+            or 'none evaluated',
+            extra={
+                'switch': key,
+                'duration': duration,
+                'instance_types': instance_types,
+                'condition_sets': decided,
+                'condition_set_timings': dict(timings),
+            },
+        )
+
+    def _is_active(self, snapshot, key, instances, kwargs):
+        memo = getattr(self._memo, 'current', None)
+        if memo is None:
+            return self.is_active_in(ManagerSwitches(self, snapshot), key, *instances, **kwargs)
+
+        results = memo.get_results(snapshot)
+        memo_key, objects = _get_memo_key(key, instances, kwargs)
+        cached = results.get(memo_key)
+        if cached is not None:
+            return cached[0]
+
+        result = self.is_active_in(ManagerSwitches(self, snapshot), key, *instances, **kwargs)
+        results[memo_key] = (result, objects)
+        return result
+
+    def add_evaluation_hook(self, hook, sample_rate=1.0):
+        """
+        Calls ``hook`` after a ``sample_rate`` fraction of calls to
+        ``is_active``, with a ``gargoyle.tracing.Evaluation`` holding the key,
+        result, duration and the condition sets which decided it. Calls
+        which aren't sampled do no extra work. Exceptions raised by ``hook``
+        are logged, not raised.
+
+        >>> from gargoyle.tracing import get_default_sink
+        >>> gargoyle.add_evaluation_hook(get_default_sink(), sample_rate=0.01)
+        """
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('sample_rate must be between 0 and 1, not %r' % (sample_rate,))
+        with self._publish_lock:
+            self._evaluation_hooks = tuple(
+                (other, other_rate) for other, other_rate in self._evaluation_hooks if other != hook
+            ) + ((hook, sample_rate),)
+
+    def remove_evaluation_hook(self, hook):
+        """
+        Stops calling ``hook``. Returns whether it had been added.
+        """
+        with self._publish_lock:
+            hooks = self._evaluation_hooks
+            self._evaluation_hooks = tuple((other, rate) for other, rate in hooks if other != hook)
+        return len(self._evaluation_hooks) != len(hooks)
+
+    def enable_stats(self):
+        """
+        Starts counting the calls to ``is_active`` for each switch, their
+        results, and how long they took. See ``gargoyle.stats``.
+        """
+        if self.stats is None:
+            self.stats = SwitchStats()
+
+    def disable_stats(self):
+        """
+        Stops counting calls to ``is_active``, and forgets the counts.
+        """
+        self.stats = None
+
+    def get_stats(self):
+        """
+        Returns a dict of ``gargoyle.stats.KeyStats`` by switch key, for the
+        calls to ``is_active`` in this process since stats were enabled.
+
+        >>> gargoyle.get_stats()['my_feature'].calls
+        """
+        stats = self.stats
+        if stats is None:
+            return {}
+        return stats.collect()
+
+    def publish_stats(self):
+        """
+        Writes the stats of this process to the remote cache, where
+        ``get_published_stats`` and the ``gargoyle_stats`` command read them.
+        Called at the end of requests every ``stats_publish_interval``
+        seconds.
+        """
+        stats = self.stats
+        if stats is None:
+            return
+        now = time.time()
+        stats.published_at = now
+
+        process = '%s:%d' % (socket.gethostname(), os.getpid())
+        counters = dict((key, key_stats.get_counters()) for key, key_stats in six.iteritems(stats.collect()))
+        self.remote_cache.set(self.get_stats_key(process), counters, self.stats_timeout)
+
+        # Another process may be updating the index, but then this one adds
+        # itself again next time
+        index_key = self.get_stats_key()
+        processes = self.remote_cache.get(index_key) or {}
+        processes = dict(
+            (other, published_at) for other, published_at in six.iteritems(processes)
+            if published_at > now - self.stats_timeout
+        )
+        processes[process] = now
+        self.remote_cache.set(index_key, processes, self.stats_timeout)
+
+    def get_published_stats(self):
+        """
+        Same as ``get_stats``, but summed over the stats each process last
+        published to the remote cache.
+        """
+        processes = self.remote_cache.get(self.get_stats_key()) or {}
+        published = self.remote_cache.get_many([self.get_stats_key(process) for process in processes])
+        merged = {}
+        for counters in six.itervalues(published):
+            merge_counters(counters, into=merged)
+        return merged
+
+    def get_stats_key(self, process=None):
+        if process is None:
+            return '%s.stats' % (self.remote_cache_key,)
+        return '%s.stats:%s' % (self.remote_cache_key, process)
+
+    def _cleanup(self, *args, **kwargs):
+        super(SwitchManager, self)._cleanup(*args, **kwargs)
+        stats = self.stats
+        if stats is not None and time.time() >= stats.published_at + self.stats_publish_interval:
+            self.publish_stats()
+
+    def start_memo(self):
+        """
+        Memoizes the results of ``is_active`` in the current thread, by the
+        identities of the instances checked, until ``stop_memo`` is called.
+        Used by ``gargoyle.middleware.SwitchMemoMiddleware`` for each request.
+        """
+        self._memo.current = SwitchMemo()
+
+    def stop_memo(self):
+        """
+        Stops memoizing the results of ``is_active`` in the current thread.
+        """
+        self._memo.current = None
+
+    def clear_memo(self):
+        """
+        Forgets the results memoized in the current thread, if any.
+        """
+        memo = getattr(self._memo, 'current', None)
+        if memo is not None:
+            memo.results = {}
+
+    @contextmanager
+    def memoize(self):
+        """
+        Memoizes the results of ``is_active`` inside the block, e.g. in a
+        task checking the same switches many times.
+
+        >>> with gargoyle.memoize():
+        >>>     for item in items:
+        >>>         gargoyle.is_active('my_feature', user)
+        """
+        previous = getattr(self._memo, 'current', None)
+        if previous is not None:
+            yield
+            return
+        self.start_memo()
+        try:
+            yield
+        finally:
+            self.stop_memo()
+
+    def is_active_in(self, switches, key, *instances, **kwargs):
+        """
+        Same as ``is_active``, but looks switches up in ``switches``, a mapping
+        of keys to switches such as a ``SwitchSnapshot``, rather than in the
+        manager itself.
+        """
         default = kwargs.pop('default', False)
         switch_type = kwargs.pop('switch_type', FEATURE)
 
@@ -51,7 +792,7 @@ class SwitchManager(ModelDict):
         if len(parts) > 1:
             child_kwargs = kwargs.copy()
             child_kwargs['default'] = None
-            result = self.is_active(':'.join(parts[:-1]), *instances, **child_kwargs)
+            result = self.is_active_in(switches, ':'.join(parts[:-1]), *instances, **child_kwargs)
 
             if result is False:
                 return result
@@ -59,7 +800,7 @@ class SwitchManager(ModelDict):
                 default = result
 
         try:
-            switch = self[key]
+            switch = switches[key]
         except KeyError:
             # switch is not defined, defer to parent
             return default
@@ -76,6 +817,14 @@ class SwitchManager(ModelDict):
         if not conditions:
             return default
 
+        if isinstance(switches, SwitchSnapshot):
+            snapshot = switches
+        else:
+            snapshot = getattr(switches, 'snapshot', None)
+        plan = self.get_plan(switch, switch_type, snapshot=snapshot)
+        if plan.folded is False:
+            return False
+
         if instances:
             # HACK: support request.user by swapping in User instance
             instances = list(instances)
@@ -83,11 +832,30 @@ class SwitchManager(ModelDict):
                 if isinstance(v, HttpRequest) and hasattr(v, 'user'):
                     instances.append(v.user)
 
+        if plan.results is None:
+            return self._evaluate_plan(key, plan, conditions, instances, switch_type)
+
+        fingerprint = plan.get_fingerprint(instances)
+        result = plan.results.get(fingerprint)
+        if result is None:
+            result = self._evaluate_plan(key, plan, conditions, instances, switch_type)
+            plan.results.set(fingerprint, result)
+        return result
+
+    def _evaluate_plan(self, key, plan, conditions, instances, switch_type):
         # check each switch to see if it can execute
-        return_value = False
+        return_value = plan.folded is True
+        trace = getattr(self._trace, 'current', None)
 
-        for switch in six.itervalues(self._registry):
-            result = switch.has_active_condition(conditions, instances, switch_type=switch_type)
+        for condition_set, compiled in plan.conditions:
+            if trace is not None:
+                started = timer()
+            if compiled is None:
+                result = condition_set.has_active_condition(conditions, instances, switch_type=switch_type)
+            else:
+                result = condition_set.has_active_compiled_condition(compiled, instances)
+            if trace is not None:
+                trace.add(key, condition_set, result, timer() - started)
             if result is False:
                 return False
             elif result is True:
@@ -96,6 +864,410 @@ class SwitchManager(ModelDict):
         # there were no matching conditions, so it must not be enabled
         return return_value
 
+    def explain(self, key, *instances, **kwargs):
+        """
+        Evaluates the switch ``key`` for ``instances`` like ``is_active``, and
+        returns a ``gargoyle.explain.Explanation`` of each parent switch,
+        condition set and field consulted, which conditions matched, and the
+        time each step took. Memoized and cached results are not used.
+
+        >>> gargoyle.explain('my_feature', request).as_dict()
+        """
+        default = kwargs.pop('default', False)
+        switch_type = kwargs.pop('switch_type', FEATURE)
+        snapshot = self.get_snapshot()
+        return explain(
+            self, ManagerSwitches(self, snapshot), key, instances,
+            default=default, switch_type=switch_type, snapshot=snapshot,
+        )
+
+    def memory_report(self, trace=True):
+        """
+        Returns a ``gargoyle.memory.MemoryReport`` of the memory each loaded
+        switch, its compiled plans and each condition set's conditions take,
+        largest first. With ``trace``, the bytes allocated loading and
+        compiling the switches are measured with ``tracemalloc`` too.
+
+        >>> gargoyle.memory_report().largest(10)
+        """
+        return memory_report(self, self.get_snapshot(), trace=trace)
+
+    def ais_active(self, key, *instances, **kwargs):
+        """
+        Same as ``is_active``, but for asyncio code. Requires Python 3.5+.
+
+        Switches are read from a snapshot which is refreshed in the
+        background, so checks don't block the event loop on the cache or
+        database, other than to load the first snapshot.
+
+        >>> await gargoyle.ais_active('my_feature', request)
+        """
+        return self.async_loader.is_active(key, *instances, **kwargs)
+
+    def ais_active_many(self, keys, *instances, **kwargs):
+        """
+        Same as ``ais_active``, but checks several switches at once and
+        returns a dict of their results.
+
+        >>> await gargoyle.ais_active_many(['my_feature', 'other_feature'], request)
+        """
+        return self.async_loader.is_active_many(keys, *instances, **kwargs)
+
+    @property
+    def async_loader(self):
+        """
+        The ``gargoyle.aio.AsyncSnapshotLoader`` used by ``ais_active``.
+        """
+        if self._async_loader is None:
+            from gargoyle.aio import AsyncSnapshotLoader
+            self._async_loader = AsyncSnapshotLoader(self)
+        return self._async_loader
+
+    def to_q(self, key, model=None, switch_type=FEATURE):
+        """
+        Returns a ``Q`` matching the rows of ``model``, which defaults to the
+        user model, for which ``is_active(key, instance)`` returns ``True``.
+
+        Raises ``QueryNotSupported`` if the switch has conditions which can't
+        be expressed in SQL.
+
+        >>> User.objects.filter(gargoyle.to_q('my_feature'))
+        """
+        if model is None:
+            model = get_user_model()
+        active = self.get_q(key, model, switch_type=switch_type)[0]
+        if active is True:
+            return Q()
+        elif active is False:
+            return Q(pk__in=[])
+        return active
+
+    def filter_queryset(self, key, queryset, switch_type=FEATURE):
+        """
+        Filters ``queryset`` down to the rows for which ``is_active(key, instance)``
+        returns ``True``, as ``to_q`` does.
+
+        >>> gargoyle.filter_queryset('my_feature', User.objects.all())
+        """
+        active = self.get_q(key, queryset.model, switch_type=switch_type)[0]
+        if active is True:
+            return queryset
+        elif active is False:
+            return queryset.none()
+        return queryset.filter(active)
+
+    def get_q(self, key, model, default=(False, True), switch_type=FEATURE):
+        """
+        Returns a pair of ``Q`` objects matching the rows of ``model`` for
+        which ``is_active(key, instance)`` returns ``True`` and ``False``
+        respectively. Either may be ``True`` or ``False`` instead, to match
+        every row or none. ``default`` is such a pair for the default value.
+        """
+        def get_rows(condition_set, conditions, compiled):
+            if compiled is None:
+                raise QueryNotSupported('%r overrides is_active' % (condition_set,))
+            return condition_set.get_q(model, conditions, switch_type=switch_type)
+
+        return self._get_rows(key, model, default, switch_type, get_rows)
+
+    def evaluate_batch(self, key, columns, model=None, switch_type=FEATURE):
+        """
+        Returns a boolean NumPy array which is ``True`` for the rows for which
+        ``is_active(key, instance)`` returns ``True``. Requires NumPy.
+
+        ``columns`` is a dict of equal length arrays of the fields of
+        ``model``, which defaults to the user model, or a queryset to load
+        them from. Conditions are evaluated over whole arrays where the types
+        allow, so pass numbers and dates as NumPy arrays.
+
+        >>> gargoyle.evaluate_batch('my_feature', {'id': ids, 'is_staff': is_staff})
+        >>> gargoyle.evaluate_batch('my_feature', User.objects.filter(is_active=True))
+        """
+        if numpy is None:
+            raise ImportError('evaluate_batch() requires NumPy')
+
+        if isinstance(columns, QuerySet):
+            model = columns.model
+            columns = self.get_columns(columns)
+        elif model is None:
+            model = get_user_model()
+
+        columns = dict((name, numpy.asarray(values)) for name, values in six.iteritems(columns))
+        lengths = set(len(values) for values in six.itervalues(columns))
+        if len(lengths) > 1:
+            raise ValueError('Columns must all be the same length')
+        size = lengths.pop() if lengths else 0
+
+        def get_rows(condition_set, conditions, compiled):
+            if compiled is None:
+                raise QueryNotSupported('%r overrides is_active' % (condition_set,))
+            return condition_set.get_mask(columns, conditions, switch_type=switch_type)
+
+        active = self._get_rows(key, model, (False, True), switch_type, get_rows)[0]
+        if isinstance(active, bool):
+            return numpy.full(size, active, dtype=bool)
+        return active
+
+    def iter_active(self, key, queryset, chunk_size=1000, switch_type=FEATURE):
+        """
+        Yields the primary keys of the rows of ``queryset`` for which
+        ``is_active(key, instance)`` returns ``True``.
+
+        Rows are loaded in chunks of ``chunk_size`` ordered by primary key, so
+        memory use doesn't grow with the size of the table, and only the
+        fields the switch's conditions check are loaded.
+
+        >>> for user_id in gargoyle.iter_active('my_feature', User.objects.all()):
+        >>>     send_email(user_id)
+        """
+        model = queryset.model
+        fields = self.get_referenced_fields(key, model, switch_type=switch_type)
+        names = [field.name for field in fields]
+        attnames = [field.attname for field in fields]
+
+        # Every row is checked against one snapshot, holding only the switch
+        # and its parents, looked up once. The rows are checked outside the
+        # memo, stats, hooks and slow log of is_active(), which would hold on
+        # to or count each of them.
+        snapshot = self.get_snapshot()
+        manager_switches = ManagerSwitches(self, snapshot)
+        parts = key.split(':')
+        switches = {}
+        for index in range(1, len(parts) + 1):
+            parent = ':'.join(parts[:index])
+            try:
+                switches[parent] = manager_switches[parent]
+            except KeyError:
+                pass
+        snapshot = SwitchSnapshot(switches, snapshot.registry, snapshot.plans, snapshot.version)
+
+        queryset = queryset.order_by('pk').values_list(*names)
+        last_pk = None
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            rows = list(chunk[:chunk_size])
+            for row in rows:
+                instance = model(**dict(zip(attnames, row)))
+                if self.is_active_in(snapshot, key, instance, switch_type=switch_type):
+                    yield row[0]
+            if len(rows) < chunk_size:
+                return
+            last_pk = rows[-1][0]
+
+    def get_referenced_fields(self, key, model, switch_type=FEATURE):
+        """
+        Returns the fields of ``model`` which the conditions of ``key`` and its
+        parents check, starting with the primary key. All of the model's
+        fields are returned if a condition set which can check its instances
+        doesn't say which fields it reads.
+        """
+        opts = model._meta
+        instance = model()
+        fields = [opts.pk]
+        parts = key.split(':')
+        for index in range(1, len(parts) + 1):
+            try:
+                switch = self[':'.join(parts[:index])]
+            except KeyError:
+                continue
+            if switch.status != SELECTIVE or not switch.value:
+                continue
+
+            for condition_set in six.itervalues(self._registry):
+                if not condition_set.can_execute(instance):
+                    continue
+                if not isinstance(condition_set, ModelConditionSet) or not _is_compilable(condition_set):
+                    return [opts.pk] + [field for field in opts.concrete_fields if field is not opts.pk]
+
+                namespace_conditions = switch.value.get(condition_set.get_namespace(), {})
+                for name, _, _, _ in condition_set.get_field_conditions(namespace_conditions, switch_type):
+                    try:
+                        field = opts.get_field(condition_set.get_field_lookup(name))
+                    except FieldDoesNotExist:
+                        # e.g. properties, read from the defaults of the instance
+                        continue
+                    if field not in fields:
+                        fields.append(field)
+        return fields
+
+    def get_columns(self, queryset):
+        """
+        Loads the fields of ``queryset`` that registered condition sets check
+        into a dict of NumPy arrays, for ``evaluate_batch``. Datetimes are
+        converted to ``datetime64`` in UTC.
+        """
+        model = queryset.model
+        instance = model()
+        names = ['pk']
+        for condition_set in six.itervalues(self._registry):
+            if not isinstance(condition_set, ModelConditionSet) or not condition_set.can_execute(instance):
+                continue
+            for field_name in condition_set.fields:
+                lookup = condition_set.get_field_lookup(field_name)
+                try:
+                    model._meta.get_field(lookup)
+                except FieldDoesNotExist:
+                    continue
+                if lookup not in names:
+                    names.append(lookup)
+
+        rows = list(queryset.values_list(*names))
+        columns = {}
+        for index, name in enumerate(names):
+            values = [row[index] for row in rows]
+            field = model._meta.pk if name == 'pk' else model._meta.get_field(name)
+            if isinstance(field, DateTimeField):
+                columns[name] = numpy.array([
+                    timezone.make_naive(value, timezone.utc) if value and timezone.is_aware(value) else value
+                    for value in values
+                ], dtype='datetime64[us]')
+            else:
+                columns[name] = numpy.array(values)
+        return columns
+
+    def _get_rows(self, key, model, default, switch_type, get_rows):
+        parts = key.split(':')
+        parent_active = parent_inactive = False
+        if len(parts) > 1:
+            parent_active, parent_inactive = self._get_rows(
+                ':'.join(parts[:-1]), model, (False, False), switch_type, get_rows,
+            )
+            # An active parent becomes the default
+            default = (q_or(parent_active, default[0]), q_and(q_not(parent_active), default[1]))
+
+        try:
+            active, inactive = self._get_switch_rows(key, model, default, switch_type, get_rows)
+        except QueryNotSupported as e:
+            raise QueryNotSupported('Switch %r: %s' % (key, e))
+        return q_and(q_not(parent_inactive), active), q_or(parent_inactive, inactive)
+
+    def _get_switch_rows(self, key, model, default, switch_type, get_rows):
+        try:
+            switch = self[key]
+        except KeyError:
+            return default
+
+        if switch.status == GLOBAL:
+            return True, False
+        elif switch.status == DISABLED:
+            return False, True
+        elif switch.status == INHERIT:
+            return default
+
+        conditions = switch.value
+        if not conditions:
+            return default
+
+        plan = self.get_plan(switch, switch_type)
+        if plan.folded is False:
+            return False, True
+
+        # Condition sets which can't execute the rows only see the non-instance default
+        instance = model()
+        active = plan.folded is True
+        inactive = False
+        for condition_set, compiled in plan.conditions:
+            if compiled is None:
+                result = condition_set.has_active_condition(conditions, [], switch_type=switch_type)
+            else:
+                result = condition_set.has_active_compiled_condition(compiled, [])
+            if result is False:
+                return False, True
+            elif result is True:
+                active = True
+
+            if condition_set.can_execute(instance):
+                row_active, row_inactive = get_rows(condition_set, conditions, compiled)
+                active = q_or(active, row_active)
+                inactive = q_or(inactive, row_inactive)
+
+        # A switch with conditions is never undecided
+        active = q_and(q_not(inactive), active)
+        return active, q_not(active)
+
+    def get_plan(self, switch, switch_type=FEATURE, snapshot=None):
+        """
+        Returns the compiled conditions of ``switch`` for ``switch_type``, as
+        built by ``compile`` against the condition sets of ``snapshot``, the
+        current ``SwitchSnapshot`` by default.
+
+        Plans are cached in the snapshot until the value of the switch changes.
+        """
+        if snapshot is None:
+            snapshot = self._snapshot
+
+        cache_key = (switch.key, switch_type)
+        value = switch.value
+        registry = snapshot.registry
+        cached = snapshot.plans.get(cache_key)
+        if cached is not None and cached[0] is value and cached[1] is registry and not cached[2].has_expired():
+            return cached[2]
+
+        plan = self.compile(value, switch_type, registry=registry)
+        snapshot.plans[cache_key] = (value, registry, plan)
+        return plan
+
+    def _clear_plans(self, **kwargs):
+        self._publish()
+
+    def compile(self, conditions, switch_type=FEATURE, registry=None):
+        """
+        Compiles the conditions of a switch against every condition set in
+        ``registry``, the registered ones by default, returning a
+        ``SwitchPlan``.
+
+        Condition sets the switch has no conditions for are skipped, and
+        static condition sets are evaluated once here and folded into the
+        plan. ``compiled`` is ``None`` for condition sets which must be given
+        the raw conditions.
+
+        >>> gargoyle.compile(gargoyle['my_feature'].value)
+        """
+        if registry is None:
+            registry = self._registry
+
+        started = timer()
+        try:
+            return self._compile(registry, conditions, switch_type)
+        finally:
+            self.metrics.add(compiles=1, compile_time=timer() - started)
+
+    def _compile(self, registry, conditions, switch_type):
+        plan = []
+        folded = None
+        expires_at = None
+        for condition_set in six.itervalues(registry):
+            if not _is_compilable(condition_set):
+                compiled = None
+            else:
+                compiled = condition_set.compile(conditions, switch_type)
+                if compiled is None:
+                    continue
+
+            if condition_set.is_static:
+                if compiled is None:
+                    result = condition_set.has_active_condition(conditions, [], switch_type=switch_type)
+                else:
+                    result = condition_set.has_active_compiled_condition(compiled, [])
+                    transition = condition_set.get_next_transition(compiled)
+                    if transition is not None and (expires_at is None or transition < expires_at):
+                        expires_at = transition
+
+                if result is False:
+                    return SwitchPlan((), folded=False, expires_at=expires_at)
+                elif result is True:
+                    folded = True
+                continue
+
+            plan.append((condition_set, compiled))
+
+        results = None
+        if plan and self.result_cache_size and all(
+            compiled is not None and condition_set.is_pure for condition_set, compiled in plan
+        ):
+            results = ResultCache(self.result_cache_size)
+        return SwitchPlan(plan, folded=folded, expires_at=expires_at, results=results)
+
     def register(self, condition_set):
         """
         Registers a condition set with the manager.
@@ -108,7 +1280,10 @@ class SwitchManager(ModelDict):
             registerable = condition_set()
         else:
             registerable = condition_set
-        self._registry[registerable.get_id()] = registerable
+        # Replace rather than mutate the registry, which published snapshots share
+        registry = self._registry.copy()
+        registry[registerable.get_id()] = registerable
+        self._registry = registry
         return condition_set
 
     def unregister(self, condition_set):
@@ -121,7 +1296,9 @@ class SwitchManager(ModelDict):
             registerable = condition_set()
         else:
             registerable = condition_set
-        popped = self._registry.pop(registerable.get_id(), None)
+        registry = self._registry.copy()
+        popped = registry.pop(registerable.get_id(), None)
+        self._registry = registry
         return (popped is not None)
 
     def get_condition_set_by_id(self, switch_id):
@@ -164,7 +1341,19 @@ def make_gargoyle():
     if hasattr(settings, 'GARGOYLE_CACHE_NAME'):
         kwargs['cache'] = caches[settings.GARGOYLE_CACHE_NAME]
 
-    return SwitchManager(Switch, **kwargs)
+    manager = SwitchManager(Switch, **kwargs)
+
+    if getattr(settings, 'GARGOYLE_STATS', False):
+        manager.enable_stats()
+
+    slow_evaluation_ms = getattr(settings, 'GARGOYLE_SLOW_EVALUATION_MS', None)
+    if slow_evaluation_ms is not None:
+        manager.set_slow_evaluation_threshold(slow_evaluation_ms)
+
+    refresh_interval = getattr(settings, 'GARGOYLE_REFRESH_INTERVAL', None)
+    if refresh_interval:
+        manager.start_refresher(interval=refresh_interval)
+    return manager
 
 
 gargoyle = SimpleLazyObject(make_gargoyle)
@@ -0,0 +1,307 @@
+"""
+gargoyle.memory
+~~~~~~~~~~~~~~~
+
+Reports how much memory the loaded switch table takes, as returned by
+``SwitchManager.memory_report``.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import pickle
+import sys
+import types
+
+from django.utils import six
+
+from gargoyle.compat import tracemalloc
+from gargoyle.conditions import ConditionSet, Field
+
+from .constants import FEATURE, SELECTIVE
+
+#: Objects shared by every switch, which no switch is charged for
+SHARED_TYPES = (type, types.ModuleType, types.CodeType, ConditionSet, Field)
+
+
+def _get_referents(obj):
+    if isinstance(obj, (six.string_types, six.binary_type, six.integer_types, float)):
+        return ()
+    elif isinstance(obj, dict):
+        return list(obj.keys()) + list(obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        return obj
+    elif isinstance(obj, types.FunctionType):
+        # Compiled conditions are closures; their code and globals are shared
+        referents = list(obj.__defaults__ or ())
+        for cell in obj.__closure__ or ():
+            try:
+                referents.append(cell.cell_contents)
+            except ValueError:
+                # An empty cell
+                pass
+        return referents
+    elif isinstance(obj, types.MethodType):
+        return [obj.__self__]
+
+    referents = []
+    if hasattr(obj, '__dict__'):
+        referents.append(obj.__dict__)
+    for klass in type(obj).__mro__:
+        slots = klass.__dict__.get('__slots__', ())
+        if isinstance(slots, six.string_types):
+            slots = [slots]
+        for slot in slots:
+            if slot not in ('__dict__', '__weakref__') and hasattr(obj, slot):
+                referents.append(getattr(obj, slot))
+    return referents
+
+
+def get_size(obj, seen=None):
+    """
+    Returns the ``sys.getsizeof`` of ``obj`` and of everything it refers to,
+    in bytes. Objects whose ids are in ``seen`` are skipped, and the ids of
+    those counted are added to it, so an object shared by several calls is
+    only counted by the first.
+    """
+    if seen is None:
+        seen = set()
+    size = 0
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if obj is None or isinstance(obj, bool) or isinstance(obj, SHARED_TYPES) or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(_get_referents(obj))
+    return size
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'GiB'
+    if unit == 'B':
+        return '%d %s' % (size, unit)
+    return '%.1f %s' % (size, unit)
+
+
+class ConditionSetFootprint(object):
+    """
+    The memory the conditions of one condition set take, in bytes: the
+    ``value_size`` of the raw conditions in the switch values, and the
+    ``compiled_size`` of the indexes compiled from them, in ``switches``
+    switches with ``conditions`` conditions in all.
+    """
+    __slots__ = ('namespace', 'switches', 'conditions', 'value_size', 'compiled_size')
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.switches = 0
+        self.conditions = 0
+        self.value_size = 0
+        self.compiled_size = 0
+
+    def __repr__(self):
+        return '<%s: %s %s>' % (self.__class__.__name__, self.namespace, format_size(self.size))
+
+    @property
+    def size(self):
+        return self.value_size + self.compiled_size
+
+    def as_dict(self):
+        return {
+            'namespace': self.namespace,
+            'switches': self.switches,
+            'conditions': self.conditions,
+            'value_size': self.value_size,
+            'compiled_size': self.compiled_size,
+            'size': self.size,
+        }
+
+
+class SwitchFootprint(object):
+    """
+    The memory one switch takes, in bytes: the ``size`` of the ``Switch``
+    itself, including its value, and the ``plan_size`` of its compiled plans.
+    ``condition_sets`` has a ``ConditionSetFootprint`` of each namespace of
+    its value, and ``largest_field`` is the ``(namespace, field_name,
+    conditions)`` of the field with the most conditions, or ``None``.
+    """
+    __slots__ = ('key', 'status', 'conditions', 'switch_size', 'plan_size', 'condition_sets', 'largest_field')
+
+    def __init__(self, key, status):
+        self.key = key
+        self.status = status
+        self.conditions = 0
+        self.switch_size = 0
+        self.plan_size = 0
+        self.condition_sets = {}
+        self.largest_field = None
+
+    def __repr__(self):
+        return '<%s: %s %s>' % (self.__class__.__name__, self.key, format_size(self.size))
+
+    @property
+    def size(self):
+        return self.switch_size + self.plan_size
+
+    def as_dict(self):
+        return {
+            'key': self.key,
+            'status': self.status,
+            'conditions': self.conditions,
+            'switch_size': self.switch_size,
+            'plan_size': self.plan_size,
+            'size': self.size,
+            'condition_sets': dict(
+                (namespace, footprint.as_dict()) for namespace, footprint in six.iteritems(self.condition_sets)
+            ),
+            'largest_field': self.largest_field,
+        }
+
+
+class MemoryReport(object):
+    """
+    The memory a snapshot of the switch table takes: a ``SwitchFootprint`` of
+    each switch and a ``ConditionSetFootprint`` of each condition set, both
+    largest first, and the ``size`` of them all together, in bytes.
+
+    ``allocated`` is the bytes ``tracemalloc`` saw allocated loading the
+    ``switches`` from the cache and compiling their ``plans``, or ``None`` if
+    it wasn't measured.
+    """
+    __slots__ = ('version', 'size', 'switches', 'condition_sets', 'allocated')
+
+    def __init__(self, version, size, switches, condition_sets, allocated=None):
+        self.version = version
+        self.size = size
+        self.switches = switches
+        self.condition_sets = condition_sets
+        self.allocated = allocated
+
+    def __repr__(self):
+        return '<%s: %d switches %s>' % (self.__class__.__name__, len(self.switches), format_size(self.size))
+
+    def largest(self, count=10):
+        """
+        Returns the ``count`` switches taking the most memory.
+        """
+        return self.switches[:count]
+
+    def as_dict(self):
+        return {
+            'version': self.version,
+            'size': self.size,
+            'switches': [footprint.as_dict() for footprint in self.switches],
+            'condition_sets': [footprint.as_dict() for footprint in self.condition_sets],
+            'allocated': self.allocated,
+        }
+
+
+def measure_allocations(manager, snapshot):
+    """
+    Returns the bytes ``tracemalloc`` sees allocated unpickling the switches
+    of ``snapshot``, as each process loads them from the cache, and compiling
+    their plans.
+    """
+    data = pickle.dumps(snapshot.switches, pickle.HIGHEST_PROTOCOL)
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        switches = pickle.loads(data)
+        loaded = tracemalloc.get_traced_memory()[0]
+        plans = [
+            manager._compile(snapshot.registry, switch.value, FEATURE)
+            for switch in six.itervalues(switches)
+            if switch.status == SELECTIVE and switch.value
+        ]
+        compiled = tracemalloc.get_traced_memory()[0]
+    finally:
+        if started:
+            tracemalloc.stop()
+    del switches, plans
+    return {'switches': loaded - before, 'plans': compiled - loaded}
+
+
+def memory_report(manager, snapshot, trace=True):
+    """
+    Measures the switches of ``snapshot``, compiling the plans of those not
+    yet checked so the report matches a process which has checked them all.
+    With ``trace``, the allocations are measured with ``tracemalloc`` too,
+    where it's available.
+    """
+    registry = dict(
+        (condition_set.get_namespace(), condition_set) for condition_set in six.itervalues(snapshot.registry)
+    )
+    condition_sets = {}
+    switches = []
+    seen = set()
+    size = sys.getsizeof(snapshot.switches) + sys.getsizeof(snapshot.plans)
+
+    for key, switch in sorted(six.iteritems(snapshot.switches)):
+        if switch.status == SELECTIVE and switch.value:
+            manager.get_plan(switch, snapshot=snapshot)
+
+    # The plans of each switch, for each switch type
+    plans_by_key = {}
+    for (plan_key, switch_type), (_, _, plan) in sorted(six.iteritems(snapshot.plans)):
+        plans_by_key.setdefault(plan_key, []).append(plan)
+
+    for key, switch in sorted(six.iteritems(snapshot.switches)):
+        footprint = SwitchFootprint(key, switch.status)
+        value = switch.value or {}
+
+        # The raw conditions are counted first, so the compiled plans that
+        # refer to them aren't charged for them again
+        for namespace, fields in sorted(six.iteritems(value)):
+            set_footprint = footprint.condition_sets[namespace] = ConditionSetFootprint(namespace)
+            set_footprint.switches = 1
+            set_footprint.value_size = get_size(fields, seen)
+            for name, conditions in sorted(six.iteritems(fields)):
+                set_footprint.conditions += len(conditions)
+                if footprint.largest_field is None or len(conditions) > footprint.largest_field[2]:
+                    footprint.largest_field = (namespace, name, len(conditions))
+            footprint.conditions += set_footprint.conditions
+
+        for plan in plans_by_key.get(key, ()):
+            for condition_set, compiled in plan.conditions:
+                namespace = condition_set.get_namespace()
+                if namespace in footprint.condition_sets and registry.get(namespace) is condition_set:
+                    footprint.condition_sets[namespace].compiled_size += get_size(compiled, seen)
+            footprint.plan_size += get_size(plan, seen)
+
+        footprint.switch_size = get_size(switch, seen)
+        for namespace, set_footprint in six.iteritems(footprint.condition_sets):
+            footprint.switch_size += set_footprint.value_size
+            footprint.plan_size += set_footprint.compiled_size
+
+            total = condition_sets.get(namespace)
+            if total is None:
+                total = condition_sets[namespace] = ConditionSetFootprint(namespace)
+            total.switches += 1
+            total.conditions += set_footprint.conditions
+            total.value_size += set_footprint.value_size
+            total.compiled_size += set_footprint.compiled_size
+
+        size += footprint.size
+        switches.append(footprint)
+
+    allocated = None
+    if trace and tracemalloc is not None:
+        allocated = measure_allocations(manager, snapshot)
+
+    return MemoryReport(
+        snapshot.version,
+        size,
+        sorted(switches, key=lambda footprint: footprint.size, reverse=True),
+        sorted(six.itervalues(condition_sets), key=lambda footprint: footprint.size, reverse=True),
+        allocated=allocated,
+    )
@@ -0,0 +1,25 @@
+"""
+gargoyle.middleware
+~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from gargoyle import gargoyle
+from gargoyle.compat import MiddlewareMixin
+
+
+class SwitchMemoMiddleware(MiddlewareMixin):
+    """
+    Memoizes ``gargoyle.is_active`` for the duration of each request, so
+    views, templates and ``switch_is_active`` checking the same switch with
+    the same request or instances only evaluate it once.
+    """
+    def process_request(self, request):
+        gargoyle.start_memo()
+
+    def process_response(self, request, response):
+        gargoyle.stop_memo()
+        return response
@@ -7,6 +7,8 @@ gargoyle.models
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+from copy import deepcopy
+
 from django.conf import settings
 from django.db import models
 from django.utils import six
@@ -135,6 +137,9 @@ class Switch(models.Model):
 
         namespace = condition_set.get_namespace()
 
+        # Replace rather than mutate the value, so compiled plans notice
+        self.value = deepcopy(self.value)
+
         if namespace not in self.value:
             self.value[namespace] = {}
         if field_name not in self.value[namespace]:
@@ -169,6 +174,7 @@ class Switch(models.Model):
         if field_name not in self.value[namespace]:
             return
 
+        self.value = deepcopy(self.value)
         self.value[namespace][field_name] = [c for c in self.value[namespace][field_name] if c[1] != condition]
 
         if not self.value[namespace][field_name]:
@@ -205,10 +211,12 @@ class Switch(models.Model):
         if namespace not in self.value:
             return
 
+        if field_name and field_name not in self.value[namespace]:
+            return
+
+        self.value = deepcopy(self.value)
         if not field_name:
             del self.value[namespace]
-        elif field_name not in self.value[namespace]:
-            return
         else:
             del self.value[namespace][field_name]
 
@@ -0,0 +1,507 @@
+"""
+gargoyle.replay
+~~~~~~~~~~~~~~~
+
+Captures sampled calls to ``SwitchManager.is_active`` as lines of JSON, and
+replays them against a table of switches, as the ``gargoyle_replay``
+command does.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import copy
+import itertools
+import json
+import math
+import threading
+from collections import OrderedDict
+
+from django.http import HttpRequest
+from django.utils import six
+from django.utils.crypto import salted_hmac
+
+from gargoyle.conditions import AbstractDate, Boolean, KeyValue, Percent, Prefix, Regex, String, Suffix
+from gargoyle.manager import SwitchSnapshot
+from gargoyle.models import Switch
+from gargoyle.stats import timer
+
+from .constants import FEATURE
+
+#: The salt of the HMACs anonymized values are replaced with, keyed with
+#: ``SECRET_KEY``
+KEY_SALT = 'gargoyle.replay'
+
+# Returned by reduce_value() for values which aren't captured
+OMIT = object()
+
+#: The fields of each switch written to snapshots
+SNAPSHOT_FIELDS = ('key', 'status', 'value')
+
+
+def hash_value(value):
+    return 'hmac:' + salted_hmac(KEY_SALT, value).hexdigest()
+
+
+def reduce_value(field, value, conditions, anonymize=True):
+    """
+    Returns what is captured of the ``value`` a condition set read for
+    ``field``, which has ``conditions`` in the switches checked: only as
+    much as the conditions can tell apart, as JSON. With ``anonymize``,
+    strings compared for equality are replaced with HMACs, pattern matched
+    strings are cut to the longest pattern, and regular expressions aren't
+    captured, returning ``OMIT``.
+    """
+    if value is None:
+        return None
+    elif isinstance(field, Percent):
+        try:
+            return int(value) % 100
+        except (TypeError, ValueError):
+            return None
+    elif isinstance(field, Boolean):
+        return bool(value)
+    elif isinstance(field, AbstractDate):
+        return value.strftime(field.DATE_FORMAT)
+    elif isinstance(field, KeyValue):
+        names = set(field.parse(condition)[0] for condition in conditions)
+        reduced = {}
+        for name in names:
+            actual = value.get(name)
+            if actual is not None:
+                reduced[name] = hash_value(actual) if anonymize else actual
+        return reduced
+    elif isinstance(field, (Prefix, Suffix)) and anonymize:
+        if not isinstance(value, six.string_types):
+            return None
+        length = max([len(condition) for condition in conditions] or [0])
+        if isinstance(field, Prefix):
+            return value[:length]
+        return value[max(len(value) - length, 0):]
+    elif isinstance(field, Regex) and anonymize:
+        return OMIT
+    elif isinstance(field, String) and anonymize and isinstance(value, six.string_types):
+        return hash_value(value)
+    elif isinstance(value, (six.string_types, six.integer_types, float)):
+        return value
+    return six.text_type(value)
+
+
+def _expand_instances(instances):
+    # HACK: support request.user by swapping in User instance, as is_active_in does
+    instances = list(instances)
+    for v in instances:
+        if isinstance(v, HttpRequest) and hasattr(v, 'user'):
+            instances.append(v.user)
+    return instances
+
+
+def capture(manager, evaluation, anonymize=True):
+    """
+    Returns a record of the ``Evaluation`` of a call to ``is_active``, as a
+    dict of JSON, with the values each condition set read from each instance,
+    as reduced by ``reduce_value``. The values are found by evaluating the
+    switch again with ``SwitchManager.explain``.
+    """
+    instances = _expand_instances(evaluation.instances)
+    positions = {}
+    for index, instance in enumerate(instances):
+        positions.setdefault(id(instance), index)
+    captured = [{'type': type(instance).__name__, 'condition_sets': {}} for instance in instances]
+
+    # A trailing comma after *args is a syntax error on Python 2
+    explanation = manager.explain(
+        evaluation.key, *evaluation.instances, switch_type=evaluation.switch_type, default=evaluation.default)
+    switches = manager.get_snapshot().switches
+    values = [
+        switches[step.key].value for step in explanation.switches if step.status is not None and step.key in switches
+    ]
+
+    for step in explanation.switches:
+        for condition_set_step in step.condition_sets:
+            try:
+                condition_set = manager.get_condition_set_by_id(condition_set_step.condition_set)
+            except KeyError:
+                continue
+            namespace = condition_set.get_namespace()
+            for instance_step in condition_set_step.instances:
+                index = positions.get(id(instance_step.instance))
+                if index is None:
+                    # The non-instance default is evaluated again when replayed
+                    continue
+                fields = captured[index]['condition_sets'].setdefault(condition_set_step.condition_set, {})
+                for field_step in instance_step.fields:
+                    field = condition_set.fields.get(field_step.name)
+                    if field is None:
+                        continue
+                    conditions = [
+                        condition[1]
+                        for value in values
+                        for condition in (value or {}).get(namespace, {}).get(field_step.name, [])
+                    ]
+                    value = reduce_value(field, field_step.value, conditions, anonymize)
+                    if value is not OMIT:
+                        fields[field_step.name] = value
+
+    return {
+        'key': evaluation.key,
+        'switch_type': evaluation.switch_type,
+        'default': evaluation.default,
+        'result': evaluation.result,
+        'duration_ms': round(evaluation.duration * 1000, 3),
+        'anonymized': anonymize,
+        'instances': captured,
+    }
+
+
+class CaptureSink(object):
+    """
+    An evaluation hook writing each evaluation to ``stream`` as a line of
+    JSON, for ``gargoyle_replay``. Each call is evaluated again to capture
+    the values the condition sets read, so sample sparingly.
+
+    >>> gargoyle.add_evaluation_hook(CaptureSink(io.open('capture.jsonl', 'a')), sample_rate=0.001)
+    """
+    def __init__(self, stream, manager=None, anonymize=True):
+        if manager is None:
+            from gargoyle import gargoyle as manager
+        self.stream = stream
+        self.manager = manager
+        self.anonymize = anonymize
+        self.lock = threading.Lock()
+
+    def __call__(self, evaluation):
+        line = json.dumps(capture(self.manager, evaluation, anonymize=self.anonymize), sort_keys=True)
+        with self.lock:
+            self.stream.write(six.text_type(line) + '\n')
+            self.stream.flush()
+
+
+def load_capture(stream):
+    """
+    Returns the records in ``stream``, as written by ``CaptureSink``.
+    """
+    return [json.loads(line) for line in stream if line.strip()]
+
+
+def dump_switches(stream, queryset=None):
+    """
+    Writes the switches of ``queryset``, by default all of them, to ``stream``
+    as a snapshot for ``load_switches``: a JSON list of their ``key``,
+    ``status`` and ``value``, as the ``gargoyle_snapshot`` command does.
+    """
+    if queryset is None:
+        queryset = Switch.objects.all()
+    switches = [
+        dict((name, switch[name]) for name in SNAPSHOT_FIELDS)
+        for switch in queryset.order_by('key').values(*SNAPSHOT_FIELDS)
+    ]
+    stream.write(six.text_type(json.dumps(switches, indent=2, sort_keys=True)))
+
+
+def load_switches(stream):
+    """
+    Returns the switches by key in ``stream``, a snapshot written by
+    ``dump_switches``. Raises ``ValueError`` if it isn't one.
+    """
+    data = json.load(stream)
+    if not isinstance(data, list):
+        raise ValueError('Expected a list of switches.')
+
+    statuses = set(status for status, _ in Switch.STATUS_CHOICES)
+    switches = {}
+    for index, item in enumerate(data):
+        if not isinstance(item, dict) or not isinstance(item.get('key'), six.string_types):
+            raise ValueError('Switch %d has no key.' % (index,))
+        if item.get('status') not in statuses:
+            raise ValueError('Switch %s has an unknown status %r.' % (item['key'], item.get('status')))
+        value = item.get('value')
+        if value is None:
+            value = {}
+        if not isinstance(value, dict):
+            raise ValueError('The value of switch %s is not an object.' % (item['key'],))
+        switches[item['key']] = Switch(key=item['key'], status=item['status'], value=value)
+    return switches
+
+
+def anonymize_key_value(condition):
+    name, sep, expected = condition.partition('=')
+    if not sep:
+        return condition
+    return '%s=%s' % (name, hash_value(expected))
+
+
+def anonymize_switches(switches, condition_sets):
+    """
+    Returns copies of ``switches`` whose conditions on the fields
+    ``reduce_value`` replaces with HMACs are replaced in the same way, so they
+    match anonymized captures as the originals matched the values.
+    """
+    fields = dict(
+        (condition_set.get_namespace(), condition_set.fields) for condition_set in condition_sets
+    )
+    anonymized = {}
+    for key, switch in six.iteritems(switches):
+        value = copy.deepcopy(switch.value) or {}
+        for namespace, namespace_conditions in six.iteritems(value):
+            for name, conditions in six.iteritems(namespace_conditions):
+                field = fields.get(namespace, {}).get(name)
+                if isinstance(field, KeyValue):
+                    namespace_conditions[name] = [
+                        [condition[0], anonymize_key_value(condition[1])] + list(condition[2:])
+                        for condition in conditions
+                    ]
+                elif isinstance(field, String):
+                    namespace_conditions[name] = [
+                        [condition[0], hash_value(condition[1])] + list(condition[2:]) for condition in conditions
+                    ]
+        anonymized[key] = copy.copy(switch)
+        anonymized[key].value = value
+    return anonymized
+
+
+class CapturedInstance(object):
+    """
+    An instance as captured by ``CaptureSink``: the name of its ``type``, and
+    the values each condition set read from it, by condition set id. Replay
+    condition sets read these instead of the instance.
+    """
+    __slots__ = ('type', 'condition_sets')
+
+    def __init__(self, type, condition_sets):
+        self.type = type
+        self.condition_sets = condition_sets
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.type)
+
+    @classmethod
+    def from_record(cls, data, registry):
+        """
+        Returns the instance captured as ``data``, with dates parsed again for
+        the fields of the condition sets in ``registry``.
+        """
+        condition_sets = {}
+        for condition_set_id, values in six.iteritems(data['condition_sets']):
+            condition_set = registry.get(condition_set_id)
+            if condition_set is None:
+                continue
+            values = dict(values)
+            for name, value in six.iteritems(values):
+                field = condition_set.fields.get(name)
+                if isinstance(field, AbstractDate) and isinstance(value, six.string_types):
+                    values[name] = field.str_to_date(value)
+            condition_sets[condition_set_id] = values
+        return cls(data['type'], condition_sets)
+
+
+_replay_classes = {}
+
+
+def _get_replay_class(klass):
+    """
+    Returns a subclass of the ConditionSet class ``klass`` which reads the
+    values of ``CapturedInstance`` instances, and other instances as usual.
+    """
+    replay_class = _replay_classes.get(klass)
+    if replay_class is not None:
+        return replay_class
+
+    def can_execute(self, instance):
+        if isinstance(instance, CapturedInstance):
+            return self._replay_id in instance.condition_sets
+        return klass.can_execute(self, instance)
+
+    def get_field_value(self, instance, field_name):
+        if isinstance(instance, CapturedInstance):
+            return instance.condition_sets[self._replay_id].get(field_name)
+        return klass.get_field_value(self, instance, field_name)
+
+    def get_fingerprint(self, instance, compiled):
+        if isinstance(instance, CapturedInstance):
+            values = instance.condition_sets[self._replay_id]
+            return tuple((field[0] in values, values.get(field[0])) for field in compiled.fields)
+        return klass.get_fingerprint(self, instance, compiled)
+
+    def is_active_compiled(self, instance, compiled):
+        if not isinstance(instance, CapturedInstance):
+            return klass.is_active_compiled(self, instance, compiled)
+
+        # As ConditionSet.is_active_compiled, but fields which weren't read
+        # when the call was captured are skipped
+        values = instance.condition_sets[self._replay_id]
+        return_value = None
+        for name, include, exclude in compiled.fields:
+            if name not in values:
+                continue
+            value = values[name]
+            if exclude is not None:
+                if exclude(value):
+                    return False
+                return_value = True
+            if include is not None and include(value):
+                return_value = True
+        return return_value
+
+    # The original id and namespace, which default to the class name
+    def get_id(self):
+        return self._replay_id
+
+    def get_namespace(self):
+        return self._replay_namespace
+
+    replay_class = type(klass)(str('Replay%s' % (klass.__name__,)), (klass,), {
+        '__module__': klass.__module__,
+        'can_execute': can_execute,
+        'get_field_value': get_field_value,
+        'get_fingerprint': get_fingerprint,
+        'is_active_compiled': is_active_compiled,
+        'get_id': get_id,
+        'get_namespace': get_namespace,
+    })
+    _replay_classes[klass] = replay_class
+    return replay_class
+
+
+def get_replay_condition_set(condition_set):
+    replayer = object.__new__(_get_replay_class(type(condition_set)))
+    replayer.__dict__.update(condition_set.__dict__)
+    replayer._replay_id = condition_set.get_id()
+    replayer._replay_namespace = condition_set.get_namespace()
+    return replayer
+
+
+class Difference(object):
+    """
+    A replayed call whose ``result`` differs from the ``captured`` one. ``line``
+    is its line number in the capture.
+    """
+    __slots__ = ('line', 'key', 'captured', 'result')
+
+    def __init__(self, line, key, captured, result):
+        self.line = line
+        self.key = key
+        self.captured = captured
+        self.result = result
+
+    def __repr__(self):
+        return '<%s: %s %r -> %r>' % (self.__class__.__name__, self.key, self.captured, self.result)
+
+    def as_dict(self):
+        return {'line': self.line, 'key': self.key, 'captured': self.captured, 'result': self.result}
+
+
+class ReplayReport(object):
+    """
+    The replay of a capture: the number of ``calls`` made, the ``latencies``
+    of those which returned, sorted, and the ``duration`` of them all in
+    seconds. ``keys`` counts the records of each switch, ``differences`` has
+    a ``Difference`` for each record whose result changed, and ``errors``
+    the ``(line, exception)`` of each which raised one.
+    """
+    __slots__ = ('calls', 'duration', 'latencies', 'keys', 'differences', 'errors')
+
+    def __init__(self, calls, duration, latencies, keys, differences, errors):
+        self.calls = calls
+        self.duration = duration
+        self.latencies = latencies
+        self.keys = keys
+        self.differences = differences
+        self.errors = errors
+
+    def __repr__(self):
+        return '<%s: %d calls, %d differences>' % (self.__class__.__name__, self.calls, len(self.differences))
+
+    @property
+    def throughput(self):
+        """
+        Calls per second, or ``None`` if none were made.
+        """
+        if not self.calls or not self.duration:
+            return None
+        return self.calls / self.duration
+
+    def percentile(self, percent):
+        """
+        Returns the ``percent`` percentile latency in seconds, or ``None`` if
+        no calls returned.
+        """
+        if not self.latencies:
+            return None
+        index = max(int(math.ceil(percent / 100 * len(self.latencies))) - 1, 0)
+        return self.latencies[index]
+
+    def get_differences_by_key(self):
+        """
+        Returns the ``Difference`` instances of each switch, most first.
+        """
+        by_key = OrderedDict()
+        for difference in self.differences:
+            by_key.setdefault(difference.key, []).append(difference)
+        return OrderedDict(sorted(six.iteritems(by_key), key=lambda item: len(item[1]), reverse=True))
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'duration': self.duration,
+            'throughput': self.throughput,
+            'latency': dict(
+                ('p%d' % (percent,), self.percentile(percent)) for percent in (50, 90, 99, 100)
+            ),
+            'keys': dict(self.keys),
+            'differences': [difference.as_dict() for difference in self.differences],
+            'errors': [{'line': line, 'error': repr(error)} for line, error in self.errors],
+        }
+
+
+def replay(manager, records, switches, repeat=1):
+    """
+    Calls ``is_active`` for each of ``records``, as loaded by
+    ``load_capture``, against ``switches``, a mapping of keys to switches,
+    ``repeat`` times, and returns a ``ReplayReport``. The results of the first
+    pass are compared with the captured ones.
+
+    Captured instances are read by copies of the condition sets registered
+    with ``manager``, which is otherwise only used to compile the switches.
+    """
+    condition_sets = list(manager.get_condition_sets())
+    registry = dict(
+        (condition_set.get_id(), get_replay_condition_set(condition_set)) for condition_set in condition_sets
+    )
+    snapshots = {}
+
+    def get_snapshot(anonymized):
+        snapshot = snapshots.get(anonymized)
+        if snapshot is None:
+            table = anonymize_switches(switches, condition_sets) if anonymized else switches
+            snapshot = snapshots[anonymized] = SwitchSnapshot(table, registry)
+        return snapshot
+
+    calls = []
+    keys = {}
+    for line, record in enumerate(records, 1):
+        instances = [CapturedInstance.from_record(data, registry) for data in record['instances']]
+        kwargs = {'switch_type': record.get('switch_type', FEATURE), 'default': record.get('default', False)}
+        calls.append((line, record, get_snapshot(record.get('anonymized', False)), instances, kwargs))
+        keys[record['key']] = keys.get(record['key'], 0) + 1
+
+    latencies = []
+    differences = []
+    errors = []
+    is_active_in = manager.is_active_in
+    started = timer()
+    for iteration, (line, record, snapshot, instances, kwargs) in itertools.product(range(repeat), calls):
+        call_started = timer()
+        try:
+            result = is_active_in(snapshot, record['key'], *instances, **kwargs)
+        except Exception as e:
+            if not iteration:
+                errors.append((line, e))
+            continue
+        latencies.append(timer() - call_started)
+        if not iteration and result != record['result']:
+            differences.append(Difference(line, record['key'], record['result'], result))
+    duration = timer() - started
+
+    return ReplayReport(len(calls) * repeat, duration, sorted(latencies), keys, differences, errors)
@@ -0,0 +1,240 @@
+"""
+gargoyle.stats
+~~~~~~~~~~~~~~
+
+Counters and latency histograms of ``SwitchManager.is_active``, kept when
+``SwitchManager.enable_stats`` has been called.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import bisect
+import threading
+import time
+
+from django.utils import six
+
+#: Upper bounds, in seconds, of the latency histogram buckets, from 1 microsecond
+#: doubling up to about a second. A last bucket counts anything slower.
+LATENCY_BUCKETS = tuple(2 ** exponent / 1e6 for exponent in range(21))
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Offsets in the counter lists kept for each switch
+CALLS, TRUE, FALSE, DEFAULTS, MISSING, TOTAL_TIME, BUCKETS = range(7)
+COUNTERS_LENGTH = BUCKETS + len(LATENCY_BUCKETS) + 1
+
+
+class KeyStats(object):
+    """
+    The stats of one switch: the number of ``calls`` to ``is_active``, the
+    number that returned ``true`` or ``false``, the number of ``defaults``,
+    where the switch was missing or inherited its result, the number where
+    it was ``missing``, the ``total_time`` they took in seconds, and the
+    number of calls in each bucket of ``LATENCY_BUCKETS``.
+    """
+    __slots__ = ('key', 'calls', 'true', 'false', 'defaults', 'missing', 'total_time', 'buckets')
+
+    def __init__(self, key, counters=None):
+        self.key = key
+        if counters is None:
+            counters = [0] * COUNTERS_LENGTH
+        self.calls = counters[CALLS]
+        self.true = counters[TRUE]
+        self.false = counters[FALSE]
+        self.defaults = counters[DEFAULTS]
+        self.missing = counters[MISSING]
+        self.total_time = counters[TOTAL_TIME]
+        self.buckets = list(counters[BUCKETS:])
+
+    def __repr__(self):
+        return '<%s: %s calls=%d>' % (self.__class__.__name__, self.key, self.calls)
+
+    def add(self, counters):
+        self.calls += counters[CALLS]
+        self.true += counters[TRUE]
+        self.false += counters[FALSE]
+        self.defaults += counters[DEFAULTS]
+        self.missing += counters[MISSING]
+        self.total_time += counters[TOTAL_TIME]
+        for index, count in enumerate(counters[BUCKETS:]):
+            self.buckets[index] += count
+
+    def get_counters(self):
+        return [self.calls, self.true, self.false, self.defaults, self.missing, self.total_time] + self.buckets
+
+    @property
+    def mean(self):
+        if not self.calls:
+            return None
+        return self.total_time / self.calls
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound of the bucket holding the ``percent``
+        percentile latency, ``float('inf')`` if it's the last one, or
+        ``None`` if there were no calls.
+        """
+        total = sum(self.buckets)
+        if not total:
+            return None
+        threshold = total * percent / 100
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= threshold:
+                break
+        if index < len(LATENCY_BUCKETS):
+            return LATENCY_BUCKETS[index]
+        return float('inf')
+
+
+def merge_counters(counters_by_key, into=None):
+    """
+    Adds the counters of each switch in ``counters_by_key`` to the
+    ``KeyStats`` in ``into``, returning it.
+    """
+    if into is None:
+        into = {}
+    for key, counters in list(six.iteritems(counters_by_key)):
+        stats = into.get(key)
+        if stats is None:
+            into[key] = KeyStats(key, counters)
+        else:
+            stats.add(counters)
+    return into
+
+
+class ThreadAccumulators(object):
+    """
+    Keeps an accumulator for each thread, which only that thread writes to,
+    so that it needs no locking. When they are read, the accumulators of
+    threads that have ended are folded into a retired one and dropped.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._accumulators = []
+        self._retired = self.new_accumulator()
+
+    def new_accumulator(self):
+        raise NotImplementedError
+
+    def retire(self, accumulator):
+        """
+        Adds the counts of ``accumulator`` to the retired accumulator.
+        """
+        raise NotImplementedError
+
+    def get_accumulator(self):
+        try:
+            return self._local.accumulator
+        except AttributeError:
+            accumulator = self._local.accumulator = self.new_accumulator()
+            with self._lock:
+                self._accumulators.append((threading.current_thread(), accumulator))
+            return accumulator
+
+    def get_accumulators(self):
+        """
+        Returns the retired accumulator and those of running threads.
+        """
+        with self._lock:
+            running = []
+            for thread, accumulator in self._accumulators:
+                if thread.is_alive():
+                    running.append((thread, accumulator))
+                else:
+                    self.retire(accumulator)
+            self._accumulators = running
+            return [self._retired] + [accumulator for thread, accumulator in running]
+
+
+class SwitchStats(ThreadAccumulators):
+    """
+    Accumulates counters for each thread, without locking, and merges them
+    when they are read.
+    """
+    def __init__(self):
+        super(SwitchStats, self).__init__()
+        self.published_at = 0.0
+
+    def new_accumulator(self):
+        return {}
+
+    def retire(self, accumulator):
+        for key, counters in six.iteritems(accumulator):
+            retired = self._retired.get(key)
+            if retired is None:
+                self._retired[key] = list(counters)
+            else:
+                for index, count in enumerate(counters):
+                    retired[index] += count
+
+    def record(self, key, result, duration, defaulted=False, missing=False):
+        accumulator = self.get_accumulator()
+        counters = accumulator.get(key)
+        if counters is None:
+            counters = accumulator[key] = [0] * COUNTERS_LENGTH
+        counters[CALLS] += 1
+        counters[TRUE if result else FALSE] += 1
+        if defaulted:
+            counters[DEFAULTS] += 1
+        if missing:
+            counters[MISSING] += 1
+        counters[TOTAL_TIME] += duration
+        counters[BUCKETS + bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def collect(self):
+        """
+        Returns a dict of ``KeyStats`` by switch key, merged from every thread.
+        """
+        merged = {}
+        for accumulator in self.get_accumulators():
+            merge_counters(accumulator, into=merged)
+        return merged
+
+    def reset(self):
+        for accumulator in self.get_accumulators():
+            accumulator.clear()
+
+
+class ManagerMetrics(ThreadAccumulators):
+    """
+    Counts of the rarer work of a ``SwitchManager``, which are always kept:
+    the switch tables loaded from the remote cache or the database and the
+    time reloads took, the switches created on access, and the plans
+    compiled and the time that took.
+
+    Like ``SwitchStats``, the counts are kept for each thread, without
+    locking, and summed when they are read.
+    """
+    names = ('reloads', 'reload_time', 'cache_loads', 'database_loads', 'auto_creates', 'compiles', 'compile_time')
+
+    def new_accumulator(self):
+        return dict.fromkeys(self.names, 0)
+
+    def retire(self, accumulator):
+        for name, count in six.iteritems(accumulator):
+            self._retired[name] += count
+
+    def add(self, **counts):
+        accumulator = self.get_accumulator()
+        for name, count in six.iteritems(counts):
+            accumulator[name] += count
+
+    def get(self, name):
+        """
+        Returns the count ``name``, summed over every thread.
+        """
+        return sum(accumulator[name] for accumulator in self.get_accumulators())
+
+    reloads = property(lambda self: self.get('reloads'))
+    reload_time = property(lambda self: float(self.get('reload_time')))
+    cache_loads = property(lambda self: self.get('cache_loads'))
+    database_loads = property(lambda self: self.get('database_loads'))
+    auto_creates = property(lambda self: self.get('auto_creates'))
+    compiles = property(lambda self: self.get('compiles'))
+    compile_time = property(lambda self: float(self.get('compile_time')))
@@ -0,0 +1,152 @@
+"""
+gargoyle.synthetic
+~~~~~~~~~~~~~~~~~~
+
+Generates tables of synthetic switches for load testing, as used by the
+``gargoyle_generate`` command.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+import random
+
+from django.core.exceptions import ValidationError
+from django.utils import six
+
+from gargoyle.builtins import CountryCode, Header, IPAddress, RegionCode
+from gargoyle.conditions import AbstractDate, Boolean, Choice, KeyValue, Percent, Prefix, Range, Regex, Suffix
+from gargoyle.models import Switch
+
+from .constants import AB_TEST, DISABLED, EXCLUDE, FEATURE, GLOBAL, INCLUDE, INHERIT, SELECTIVE
+
+COUNTRIES = ('AU', 'BR', 'CA', 'DE', 'FR', 'GB', 'IN', 'JP', 'US')
+REGIONS = ('AU-NSW', 'CA-ON', 'DE-BE', 'GB-ENG', 'GB-SCT', 'US-CA', 'US-NY')
+
+#: Relative weights of the statuses of generated switches. Only nested
+#: switches inherit.
+STATUS_WEIGHTS = (
+    (SELECTIVE, 6),
+    (GLOBAL, 2),
+    (DISABLED, 1),
+    (INHERIT, 1),
+)
+
+
+def generate_condition(field, rng):
+    """
+    Returns a random condition for ``field``, in the format its ``clean``
+    method accepts.
+    """
+    number = rng.randrange(100000)
+    if isinstance(field, Percent):
+        low = rng.randrange(100)
+        return '%d-%d' % (low, rng.randrange(low, 100))
+    elif isinstance(field, Range):
+        return '%d-%d' % (number, number + rng.randrange(1, 10000))
+    elif isinstance(field, Boolean):
+        return '1'
+    elif isinstance(field, Choice):
+        return rng.choice(sorted(field.choices))
+    elif isinstance(field, AbstractDate):
+        date = datetime.date(2015, 1, 1) + datetime.timedelta(days=rng.randrange(20 * 365))
+        return date.strftime(field.DATE_FORMAT)
+    elif isinstance(field, IPAddress):
+        return '10.%d.%d.%d' % (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    elif isinstance(field, CountryCode):
+        return rng.choice(COUNTRIES)
+    elif isinstance(field, RegionCode):
+        return rng.choice(REGIONS)
+    elif isinstance(field, Header):
+        return 'X-Synthetic-%d=%d' % (number % 100, rng.randrange(10))
+    elif isinstance(field, KeyValue):
+        return 'synthetic%d=%d' % (number % 100, rng.randrange(10))
+    elif isinstance(field, Prefix):
+        return 'user%d' % (number,)
+    elif isinstance(field, Suffix):
+        return '@example%d.com' % (number % 1000,)
+    elif isinstance(field, Regex):
+        return r'^user%d[0-9]*@example\.com$' % (number,)
+    return '%s%d' % (field.name, number)
+
+
+class SwitchGenerator(object):
+    """
+    Generates unsaved ``Switch`` instances, with conditions for the condition
+    sets registered with ``manager``. The same ``seed`` always generates the
+    same switches.
+
+    ``conditions`` is a ``(minimum, maximum)`` pair of the number of
+    conditions of each selective switch. Switches are nested up to
+    ``max_depth`` levels deep. ``exclude_ratio`` and ``ab_test_ratio`` are
+    the fractions of conditions which are excludes and for A/B tests.
+
+    Every key starts with ``key_prefix``, ``prefix`` followed by a dash, so
+    the switches generated can be told apart from others starting with
+    ``prefix``.
+    """
+    def __init__(self, manager, seed=0, conditions=(1, 10), max_depth=3, exclude_ratio=0.2, ab_test_ratio=0.1,
+                 prefix='synthetic'):
+        self.rng = random.Random(seed)
+        self.conditions = conditions
+        self.max_depth = max_depth
+        self.exclude_ratio = exclude_ratio
+        self.ab_test_ratio = ab_test_ratio
+        self.prefix = prefix
+        self.key_prefix = '%s-' % (prefix,)
+        # Sorted, as registration order isn't stable between processes
+        self.fields = [
+            (condition_set.get_namespace(), name, field)
+            for condition_set in sorted(manager.get_condition_sets(), key=lambda condition_set: condition_set.get_id())
+            for name, field in sorted(six.iteritems(condition_set.fields))
+        ]
+
+    def generate(self, count):
+        """
+        Yields ``count`` switches, parents before their children.
+        """
+        parents = []
+        for index in range(count):
+            key = '%s%d' % (self.key_prefix, index)
+            depth = 1
+            if parents and self.max_depth > 1 and self.rng.random() < 0.3:
+                parent, parent_depth = self.rng.choice(parents)
+                key = '%s:%d' % (parent, index)
+                depth = parent_depth + 1
+            if depth < self.max_depth:
+                parents.append((key, depth))
+
+            status = self.choose_status(nested=depth > 1)
+            value = self.generate_value() if status == SELECTIVE else {}
+            yield Switch(key=key, status=status, value=value, label='Synthetic %d' % (index,))
+
+    def choose_status(self, nested):
+        weights = [(status, weight) for status, weight in STATUS_WEIGHTS if nested or status != INHERIT]
+        choice = self.rng.uniform(0, sum(weight for _, weight in weights))
+        for status, weight in weights:
+            choice -= weight
+            if choice <= 0:
+                break
+        return status
+
+    def generate_value(self):
+        value = {}
+        if not self.fields:
+            return value
+        for _ in range(self.rng.randint(*self.conditions)):
+            namespace, name, field = self.rng.choice(self.fields)
+            try:
+                condition = field.clean(generate_condition(field, self.rng))
+            except ValidationError:
+                continue
+            conditions = value.setdefault(namespace, {}).setdefault(name, [])
+            if any(existing[1] == condition for existing in conditions):
+                continue
+            conditions.append([
+                EXCLUDE if self.rng.random() < self.exclude_ratio else INCLUDE,
+                condition,
+                AB_TEST if self.rng.random() < self.ab_test_ratio else FEATURE,
+            ])
+        return value
@@ -9,7 +9,14 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import inspect
 import sys
+import threading
 import unittest
+from collections import Counter
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
 
 from gargoyle import gargoyle
 
@@ -102,6 +109,7 @@ class SwitchContextManager(TestCaseContextDecorator):
     def __init__(self, gargoyle=gargoyle, **keys):
         self.gargoyle = gargoyle
         self.is_active_func = gargoyle.is_active
+        self.is_active_in_func = gargoyle.is_active_in
         self.keys = keys
         self._state = {}
         self._values = {
@@ -125,10 +133,144 @@ class SwitchContextManager(TestCaseContextDecorator):
                 return is_active_func(key, *args, **kwargs)
             return wrapped
 
+        def is_active_in(gargoyle):
+            is_active_in_func = gargoyle.is_active_in
+
+            def wrapped(switches, key, *args, **kwargs):
+                if key in self.keys:
+                    return self.keys[key]
+                return is_active_in_func(switches, key, *args, **kwargs)
+            return wrapped
+
         self.gargoyle.is_active = is_active(self.gargoyle)
+        # Parents, and snapshots used by ais_active(), are checked with is_active_in()
+        self.gargoyle.is_active_in = is_active_in(self.gargoyle)
+        # Results memoized for the current request may depend on the overrides
+        self.gargoyle.clear_memo()
 
     def unpatch(self):
         self.gargoyle.is_active = self.is_active_func
+        self.gargoyle.is_active_in = self.is_active_in_func
+        self.gargoyle.clear_memo()
 
 
 switches = SwitchContextManager
+
+
+#: Cache methods counted as reads and writes by ``CountingLocMemCache``
+CACHE_READS = ('get', 'get_many', 'has_key')
+CACHE_WRITES = ('set', 'set_many', 'add', 'delete', 'delete_many', 'incr', 'decr', 'touch', 'clear')
+
+
+def _counted(name):
+    def method(self, *args, **kwargs):
+        # Count the outermost call only, e.g. not the get() calls of get_many()
+        if getattr(self._counting, 'active', False):
+            return getattr(super(CountingLocMemCache, self), name)(*args, **kwargs)
+        self.calls[name] += 1
+        self._counting.active = True
+        try:
+            return getattr(super(CountingLocMemCache, self), name)(*args, **kwargs)
+        finally:
+            self._counting.active = False
+    method.__name__ = str(name)
+    return method
+
+
+class CountingLocMemCache(LocMemCache):
+    """
+    A local-memory cache backend counting the calls to each of its methods in
+    ``calls``, for ``budget`` to check. Use it in test settings:
+
+    >>> CACHES = {
+    >>>     'default': {
+    >>>         'BACKEND': 'gargoyle.testutils.CountingLocMemCache',
+    >>>     },
+    >>> }
+    """
+    def __init__(self, *args, **kwargs):
+        super(CountingLocMemCache, self).__init__(*args, **kwargs)
+        self.calls = Counter()
+        self._counting = threading.local()
+
+
+for _name in CACHE_READS + CACHE_WRITES:
+    if hasattr(LocMemCache, _name):
+        setattr(CountingLocMemCache, _name, _counted(_name))
+
+
+class BudgetContextManager(TestCaseContextDecorator):
+    """
+    Asserts that a block makes at most ``queries`` database queries, and at
+    most ``cache_reads`` and ``cache_writes`` calls to ``cache``, which
+    defaults to the cache of ``gargoyle`` and must be a
+    ``CountingLocMemCache``. Budgets left as ``None`` aren't checked.
+
+    Ideal for keeping checks off the database and cache.
+
+    >>> gargoyle.is_active('my_switch_name', request)
+    >>> with budget(queries=0, cache_reads=0, cache_writes=0):
+    >>>     gargoyle.is_active('my_switch_name', request)
+
+    Like ``switches``, it can also decorate functions and unittest classes.
+    After the block, ``captured_queries`` and ``cache_calls`` hold what was
+    counted.
+    """
+    def __init__(self, queries=None, cache_reads=None, cache_writes=None, cache=None, using=DEFAULT_DB_ALIAS):
+        self.budgets = {
+            'queries': queries,
+            'cache reads': cache_reads,
+            'cache writes': cache_writes,
+        }
+        self.cache = cache
+        self.using = using
+        self.captured_queries = []
+        self.cache_calls = Counter()
+
+    def get_cache(self):
+        cache = self.gargoyle_cache() if self.cache is None else self.cache
+        if not isinstance(getattr(cache, 'calls', None), Counter):
+            raise ImproperlyConfigured(
+                'Checking a cache budget requires the cache to be a gargoyle.testutils.CountingLocMemCache.',
+            )
+        return cache
+
+    def gargoyle_cache(self):
+        return gargoyle.remote_cache
+
+    def __enter__(self):
+        self.check_cache = self.budgets['cache reads'] is not None or self.budgets['cache writes'] is not None
+        if self.check_cache:
+            self.cache_calls_before = Counter(self.get_cache().calls)
+        self.queries_context = CaptureQueriesContext(connections[self.using])
+        self.queries_context.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.queries_context.__exit__(exc_type, exc_val, exc_tb)
+        self.captured_queries = self.queries_context.captured_queries
+        if self.check_cache:
+            cache_calls = Counter(self.get_cache().calls)
+            cache_calls.subtract(self.cache_calls_before)
+            # Unary + on a Counter is Python 3 only
+            self.cache_calls = Counter(dict((name, count) for name, count in cache_calls.items() if count > 0))
+        if exc_type is not None:
+            return
+
+        counts = {
+            'queries': len(self.captured_queries),
+            'cache reads': sum(self.cache_calls[name] for name in CACHE_READS),
+            'cache writes': sum(self.cache_calls[name] for name in CACHE_WRITES),
+        }
+        exceeded = [
+            '%d %s, over the budget of %d' % (counts[name], name, budget)
+            for name, budget in sorted(self.budgets.items())
+            if budget is not None and counts[name] > budget
+        ]
+        if exceeded:
+            details = ['  %s' % (query['sql'],) for query in self.captured_queries]
+            details.extend('  cache.%s() x%d' % (name, count) for name, count in sorted(self.cache_calls.items()))
+            raise AssertionError('Budget exceeded: %s\n%s' % ('; '.join(exceeded), '\n'.join(details)))
+
+
+budget = BudgetContextManager
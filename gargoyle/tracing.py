@@ -0,0 +1,141 @@
+"""
+gargoyle.tracing
+~~~~~~~~~~~~~~~~
+
+Records of ``SwitchManager.is_active`` calls, passed to the hooks added with
+``SwitchManager.add_evaluation_hook``, and sinks writing them out.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import logging
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+from gargoyle.compat import opentelemetry_trace
+
+from .constants import FEATURE
+
+
+class EvaluationTrace(object):
+    """
+    Collects the condition sets evaluated during one call to ``is_active``,
+    as ``(key, condition_set, result, duration)`` tuples in ``steps``, where
+    ``key`` is the switch or parent the condition set was evaluated for.
+    """
+    __slots__ = ('steps',)
+
+    def __init__(self):
+        self.steps = []
+
+    def add(self, key, condition_set, result, duration):
+        self.steps.append((key, condition_set, result, duration))
+
+
+class Evaluation(object):
+    """
+    A sampled call to ``is_active``: the switch ``key``, its ``result``, how
+    long it took in seconds, and the ``EvaluationTrace`` of the condition sets
+    evaluated. Results memoized or cached for pure condition sets evaluate
+    none. ``instances``, ``switch_type`` and ``default`` are the arguments of
+    the call.
+    """
+    __slots__ = ('key', 'result', 'duration', 'trace', 'instances', 'switch_type', 'default')
+
+    def __init__(self, key, result, duration, trace, instances=(), switch_type=FEATURE, default=False):
+        self.key = key
+        self.result = result
+        self.duration = duration
+        self.trace = trace
+        self.instances = instances
+        self.switch_type = switch_type
+        self.default = default
+
+    def __repr__(self):
+        return '<%s: %s=%r>' % (self.__class__.__name__, self.key, self.result)
+
+    @property
+    def condition_sets(self):
+        """
+        The ids of the condition sets which decided the result, by returning
+        ``True`` or ``False`` rather than ``None``.
+        """
+        return [condition_set.get_id() for _, condition_set, result, _ in self.trace.steps if result is not None]
+
+    @property
+    def timings(self):
+        """
+        A list of ``(condition set id, duration)`` for each condition set
+        evaluated.
+        """
+        return [(condition_set.get_id(), duration) for _, condition_set, _, duration in self.trace.steps]
+
+    def as_dict(self):
+        return {
+            'key': self.key,
+            'result': self.result,
+            'duration_ms': round(self.duration * 1000, 3),
+            'condition_sets': self.condition_sets,
+        }
+
+
+class LoggingSink(object):
+    """
+    An evaluation hook logging each evaluation as a line of JSON.
+
+    >>> gargoyle.add_evaluation_hook(LoggingSink(), sample_rate=0.01)
+    """
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logging.getLogger('gargoyle.evaluations') if logger is None else logger
+        self.level = level
+
+    def __call__(self, evaluation):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        fields = evaluation.as_dict()
+        self.logger.log(self.level, json.dumps(fields, sort_keys=True), extra={'evaluation': fields})
+
+
+class TracingSink(object):
+    """
+    An evaluation hook writing each evaluation as an OpenTelemetry span, a
+    child of the current span. Requires ``opentelemetry-api``, unless a
+    ``tracer`` is passed.
+
+    >>> gargoyle.add_evaluation_hook(TracingSink(), sample_rate=0.01)
+    """
+    span_name = 'gargoyle.is_active'
+
+    def __init__(self, tracer=None):
+        if tracer is None:
+            if opentelemetry_trace is None:
+                raise ImproperlyConfigured('TracingSink requires opentelemetry-api to be installed.')
+            tracer = opentelemetry_trace.get_tracer('gargoyle')
+        self.tracer = tracer
+
+    def __call__(self, evaluation):
+        end_time = int(time.time() * 1e9)
+        span = self.tracer.start_span(
+            self.span_name,
+            start_time=end_time - int(evaluation.duration * 1e9),
+            attributes={
+                'gargoyle.switch': evaluation.key,
+                'gargoyle.result': evaluation.result,
+                'gargoyle.condition_sets': evaluation.condition_sets,
+            },
+        )
+        span.end(end_time=end_time)
+
+
+def get_default_sink():
+    """
+    Returns a ``TracingSink`` if OpenTelemetry is installed, otherwise a
+    ``LoggingSink``.
+    """
+    if opentelemetry_trace is not None:
+        return TracingSink()
+    return LoggingSink()
@@ -0,0 +1,145 @@
+"""
+gargoyle.views
+~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+from django.http import HttpResponse
+from django.utils import six
+
+from gargoyle import gargoyle
+from gargoyle.stats import LATENCY_BUCKETS
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, six.text_type(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for name, value in labels
+    )
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else six.text_type(value)
+
+
+class MetricsWriter(object):
+    """
+    Writes metrics in the Prometheus text exposition format.
+    """
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, metric_type, help_text, samples):
+        """
+        Adds the metric ``name``, with ``samples`` of ``(suffix, labels,
+        value)``, where labels is a sequence of ``(name, value)`` pairs.
+        """
+        self.lines.append('# HELP %s %s' % (name, help_text))
+        self.lines.append('# TYPE %s %s' % (name, metric_type))
+        for suffix, labels, value in samples:
+            self.lines.append('%s%s%s %s' % (name, suffix, format_labels(labels), format_value(value)))
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def render_metrics(manager, now=None):
+    """
+    Returns the runtime state of ``manager`` in the Prometheus text format.
+    Only state already in memory is read, never the cache or database.
+    """
+    if now is None:
+        now = time.time()
+    snapshot = manager._snapshot
+    metrics = manager.metrics
+    writer = MetricsWriter()
+
+    writer.add('gargoyle_snapshot_version', 'gauge', 'Number of switch tables loaded by this process.', [
+        ('', (), snapshot.version),
+    ])
+    writer.add('gargoyle_snapshot_switches', 'gauge', 'Number of switches in the current switch table.', [
+        ('', (), len(snapshot.switches)),
+    ])
+    if manager._local_last_updated is not None:
+        writer.add('gargoyle_snapshot_age_seconds', 'gauge', 'Seconds since the switch table was loaded.', [
+            ('', (), now - manager._local_last_updated),
+        ])
+        writer.add('gargoyle_snapshot_checked_age_seconds', 'gauge', 'Seconds since the switches were checked for '
+                   'changes.', [
+                       ('', (), now - manager._last_checked_for_remote_changes),
+                   ])
+
+    writer.add('gargoyle_reloads_total', 'counter', 'Switch tables loaded, by where they were loaded from.', [
+        ('', (('source', 'cache'),), metrics.cache_loads),
+        ('', (('source', 'database'),), metrics.database_loads),
+    ])
+    writer.add('gargoyle_reload_seconds_total', 'counter', 'Seconds spent loading switch tables.', [
+        ('', (), metrics.reload_time),
+    ])
+    writer.add('gargoyle_auto_creates_total', 'counter', 'Missing switches created on access.', [
+        ('', (), metrics.auto_creates),
+    ])
+    writer.add('gargoyle_compiles_total', 'counter', 'Switch plans compiled.', [
+        ('', (), metrics.compiles),
+    ])
+    writer.add('gargoyle_compile_seconds_total', 'counter', 'Seconds spent compiling switch plans.', [
+        ('', (), metrics.compile_time),
+    ])
+
+    stats = sorted(six.itervalues(manager.get_stats()), key=lambda key_stats: key_stats.key)
+    if not stats:
+        return writer.render()
+
+    calls = sum(key_stats.calls for key_stats in stats)
+    missing = sum(key_stats.missing for key_stats in stats)
+    writer.add('gargoyle_switch_lookups_total', 'counter', 'Switches looked up by is_active, by whether they were '
+               'loaded.', [
+                   ('', (('result', 'hit'),), calls - missing),
+                   ('', (('result', 'miss'),), missing),
+               ])
+
+    samples = []
+    for key_stats in stats:
+        for result, count in (('true', key_stats.true), ('false', key_stats.false)):
+            samples.append(('', (('switch', key_stats.key), ('result', result)), count))
+    writer.add('gargoyle_switch_evaluations_total', 'counter', 'Calls to is_active, by switch and result.', samples)
+
+    samples = []
+    for key_stats in stats:
+        labels = (('switch', key_stats.key),)
+        samples.append(('', labels, key_stats.defaults))
+    writer.add('gargoyle_switch_defaults_total', 'counter', 'Calls to is_active returning the default, as the '
+               'switch was missing or inherited.', samples)
+
+    samples = []
+    for key_stats in stats:
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), key_stats.buckets):
+            cumulative += count
+            samples.append(('_bucket', (('switch', key_stats.key), ('le', format_value(bound))), cumulative))
+        samples.append(('_sum', (('switch', key_stats.key),), key_stats.total_time))
+        samples.append(('_count', (('switch', key_stats.key),), key_stats.calls))
+    writer.add('gargoyle_switch_evaluation_seconds', 'histogram', 'Latency of is_active, by switch.', samples)
+    return writer.render()
+
+
+def metrics(request):
+    """
+    Renders the runtime state of ``gargoyle`` for Prometheus, e.g.:
+
+    >>> url(r'^gargoyle/metrics/$', gargoyle.views.metrics)
+
+    Per-switch metrics need stats to be enabled with ``GARGOYLE_STATS``.
+    """
+    return HttpResponse(render_metrics(gargoyle), content_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs the benchmarks in tests/benchmarks with pytest-benchmark, saving the
+results as JSON under .benchmarks/ to compare between commits, e.g.:
+
+    ./runbenchmarks.py
+    ./runbenchmarks.py --benchmark-compare --benchmark-compare-fail=mean:10%
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+
+import pytest
+
+
+def main():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings.test')
+    sys.path.insert(0, 'tests')
+    return pytest.main([
+        'tests/benchmarks',
+        '-o', 'python_files=bench_*.py',
+        '--no-cov',
+        '--benchmark-only',
+        '--benchmark-autosave',
+    ] + sys.argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -47,6 +47,12 @@ setup(
         ':python_version=="2.7"': [
             'contextdecorator',
         ],
+        'numpy': [
+            'numpy',
+        ],
+        'opentelemetry': [
+            'opentelemetry-api',
+        ],
     },
     license='Apache License 2.0',
     include_package_data=True,
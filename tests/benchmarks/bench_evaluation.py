@@ -0,0 +1,106 @@
+"""
+Benchmarks of checking switches, parametrized by the number of other switches
+loaded. Run with ``./runbenchmarks.py``.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import pytest
+from django.http import HttpResponse
+from django.template import Context, Template
+
+from gargoyle.decorators import switch_is_active
+from gargoyle.models import DISABLED, GLOBAL, INCLUDE, INHERIT, SELECTIVE
+
+USER_NAMESPACE = 'auth.user'
+IP_NAMESPACE = 'ip'
+
+
+def include(field_name, values):
+    return {field_name: [[INCLUDE, value] for value in values]}
+
+
+@pytest.mark.parametrize('status', [GLOBAL, DISABLED, SELECTIVE], ids=['global', 'disabled', 'selective'])
+def test_status(benchmark, switch_table, user, status):
+    value = {USER_NAMESPACE: include('username', ['benchmark'])} if status == SELECTIVE else {}
+    switch_table.add('checked', status, value)
+    gargoyle = switch_table.load()
+
+    assert benchmark(gargoyle.is_active, 'checked', user) is (status != DISABLED)
+
+
+@pytest.mark.parametrize('depth', [1, 2, 3, 4, 5])
+def test_nested(benchmark, switch_table, depth):
+    keys = ['level%d' % (level,) for level in range(depth)]
+    for index in range(depth):
+        switch_table.add(':'.join(keys[:index + 1]), INHERIT if index else GLOBAL)
+    gargoyle = switch_table.load()
+
+    assert benchmark(gargoyle.is_active, ':'.join(keys)) is True
+
+
+@pytest.mark.parametrize('cached', [True, False], ids=['cached', 'uncached'])
+@pytest.mark.parametrize('count', [1, 10, 100, 1000, 10000])
+def test_conditions(benchmark, switch_table, user, monkeypatch, count, cached):
+    # None match, so every condition is considered
+    switch_table.add('checked', SELECTIVE, {
+        USER_NAMESPACE: include('username', ['user%d' % (index,) for index in range(count)]),
+    })
+    gargoyle = switch_table.load()
+    if not cached:
+        monkeypatch.setattr(gargoyle, 'result_cache_size', 0)
+
+    assert benchmark(gargoyle.is_active, 'checked', user) is False
+
+
+def test_user_condition_set(benchmark, switch_table, user):
+    switch_table.add('checked', SELECTIVE, {
+        USER_NAMESPACE: dict(
+            include('username', ['someone%d' % (index,) for index in range(20)]),
+            percent=[[INCLUDE, '0-10']],
+            is_staff=[[INCLUDE, '1']],
+            email_suffix=[[INCLUDE, '@example.com']],
+        ),
+    })
+    gargoyle = switch_table.load()
+
+    assert benchmark(gargoyle.is_active, 'checked', user) is True
+
+
+def test_ip_address_condition_set(benchmark, switch_table, http_request):
+    switch_table.add('checked', SELECTIVE, {
+        IP_NAMESPACE: dict(
+            include('ip_address', ['10.0.0.%d' % (index,) for index in range(20)]),
+            percent=[[INCLUDE, '0-50']],
+        ),
+    })
+    gargoyle = switch_table.load()
+
+    assert benchmark(gargoyle.is_active, 'checked', http_request) is True
+
+
+def test_request_with_both(benchmark, switch_table, http_request):
+    switch_table.add('checked', SELECTIVE, {
+        USER_NAMESPACE: include('username', ['nobody']),
+        IP_NAMESPACE: include('ip_address', ['10.1.2.3']),
+    })
+    gargoyle = switch_table.load()
+
+    assert benchmark(gargoyle.is_active, 'checked', http_request) is True
+
+
+@pytest.mark.parametrize('status', [GLOBAL, DISABLED], ids=['global', 'disabled'])
+def test_switch_node_render(benchmark, switch_table, http_request, status):
+    switch_table.add('checked', status)
+    switch_table.load()
+    template = Template('{% load gargoyle_tags %}{% ifswitch checked %}on{% else %}off{% endifswitch %}')
+    context = Context({'request': http_request})
+
+    assert benchmark(template.render, context) == ('on' if status == GLOBAL else 'off')
+
+
+def test_switch_is_active_decorator(benchmark, switch_table, http_request):
+    switch_table.add('checked', GLOBAL)
+    switch_table.load()
+    view = switch_is_active('checked')(lambda request: HttpResponse())
+
+    assert benchmark(view, http_request).status_code == 200
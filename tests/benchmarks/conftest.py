@@ -0,0 +1,56 @@
+"""
+Fixtures for the benchmarks, which are run separately from the tests with
+``./runbenchmarks.py``.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from gargoyle import gargoyle
+from gargoyle.models import DISABLED, GLOBAL, Switch
+from testapp.utils import RequestFactory
+
+#: The number of other switches loaded alongside the ones checked
+TABLE_SIZES = (10, 1000, 10000)
+
+
+class SwitchTable(object):
+    """
+    Creates switches for a benchmark in bulk, then loads them into the
+    global ``gargoyle`` once, so the benchmark only measures steady-state
+    checks.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.switches = [
+            Switch(key='filler%d' % (index,), status=GLOBAL if index % 2 else DISABLED, value={})
+            for index in range(size)
+        ]
+
+    def add(self, key, status, value=None):
+        self.switches.append(Switch(key=key, status=status, value=value or {}))
+
+    def load(self):
+        Switch.objects.bulk_create(self.switches)
+        # bulk_create() doesn't send post_save, which reloads the switches
+        gargoyle._populate(reset=True)
+        return gargoyle
+
+
+@pytest.fixture(params=TABLE_SIZES, ids=lambda size: 'table%d' % (size,))
+def switch_table(request, db):
+    yield SwitchTable(request.param)
+    cache.clear()
+    gargoyle.clear_cache()
+
+
+@pytest.fixture
+def user():
+    return User(id=12345, username='benchmark', email='benchmark@example.com', is_staff=True)
+
+
+@pytest.fixture
+def http_request(user):
+    return RequestFactory().get('/', user=user, REMOTE_ADDR='10.1.2.3')
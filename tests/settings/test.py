@@ -6,7 +6,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 from copy import deepcopy
 
 from .base import *  # noqa
-from .base import DATABASES, TEMPLATES
+from .base import CACHES, DATABASES, TEMPLATES
 
 DEBUG = False
 
@@ -14,5 +14,9 @@ DATABASES = deepcopy(DATABASES)
 del DATABASES['default']['NAME']
 
 
+# Counts cache calls, for gargoyle.testutils.budget
+CACHES = deepcopy(CACHES)
+CACHES['default']['BACKEND'] = 'gargoyle.testutils.CountingLocMemCache'
+
 TEMPLATES = deepcopy(TEMPLATES)
 TEMPLATES[0]['OPTIONS']['debug'] = False
@@ -0,0 +1,155 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from contextlib import contextmanager
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import RequestFactory, TransactionTestCase
+from django.utils.functional import SimpleLazyObject
+
+from gargoyle.builtins import UserConditionSet
+from gargoyle.manager import SwitchManager
+from gargoyle.models import DISABLED, GLOBAL, SELECTIVE, Switch
+from gargoyle.testutils import switches
+
+asyncio = pytest.importorskip('asyncio')
+
+
+class AsyncTest(TransactionTestCase):
+
+    def setUp(self):
+        super(AsyncTest, self).setUp()
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='disabled', status=DISABLED)
+        Switch.objects.create(key='global:disabled', status=DISABLED)
+        self.gargoyle = self.make_gargoyle()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.gargoyle.async_loader.stop()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        super(AsyncTest, self).tearDown()
+
+    def make_gargoyle(self, **kwargs):
+        kwargs.setdefault('auto_create', False)
+        manager = SwitchManager(Switch, key='key', value='value', instances=True, **kwargs)
+        manager.register(UserConditionSet(User))
+        return manager
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    @contextmanager
+    def no_loading(self):
+        def populate(*args, **kwargs):
+            raise AssertionError('ais_active() loaded switches')
+
+        self.gargoyle._populate = populate
+        try:
+            yield
+        finally:
+            del self.gargoyle._populate
+
+    def change_behind_cache(self, key, status):
+        Switch.objects.filter(key=key).update(status=status)
+        cache.clear()
+        self.gargoyle.clear_cache()
+
+    def test_cold_start(self):
+        assert self.gargoyle._local_last_updated is None
+        assert self.run_async(self.gargoyle.ais_active('global')) is True
+        assert self.gargoyle.async_loader.snapshot is not None
+        assert self.run_async(self.gargoyle.ais_active('disabled')) is False
+        assert self.run_async(self.gargoyle.ais_active('missing')) is False
+
+    def test_warm_start_copies_manager(self):
+        assert self.gargoyle.is_active('global')
+
+        with self.no_loading():
+            assert self.run_async(self.gargoyle.ais_active('global')) is True
+            assert self.run_async(self.gargoyle.ais_active('global:disabled')) is False
+
+    def test_snapshot_not_reloaded_on_checks(self):
+        self.run_async(self.gargoyle.ais_active('global'))
+        snapshot = self.gargoyle.async_loader.snapshot
+
+        with self.no_loading():
+            assert self.run_async(self.gargoyle.ais_active_many(['global', 'disabled'])) == {
+                'global': True,
+                'disabled': False,
+            }
+        assert self.gargoyle.async_loader.snapshot is snapshot
+
+    def test_saves_update_snapshot(self):
+        assert self.run_async(self.gargoyle.ais_active('disabled')) is False
+
+        switch = self.gargoyle['disabled']
+        switch.status = GLOBAL
+        switch.save()
+        assert self.run_async(self.gargoyle.ais_active('disabled')) is True
+
+    def test_refresh(self):
+        self.run_async(self.gargoyle.ais_active('global'))
+        self.change_behind_cache('global', DISABLED)
+
+        self.run_async(self.gargoyle.async_loader.refresh())
+        assert self.run_async(self.gargoyle.ais_active('global')) is False
+
+    def test_background_refresh(self):
+        self.gargoyle.async_loader.interval = 0.01
+        assert self.run_async(self.gargoyle.ais_active('global')) is True
+
+        self.change_behind_cache('global', DISABLED)
+        for _ in range(100):
+            self.run_async(asyncio.sleep(0.01))
+            if self.gargoyle.async_loader.snapshot['global'].status == DISABLED:
+                break
+        assert self.run_async(self.gargoyle.ais_active('global')) is False
+
+    def test_conditions_with_lazy_user(self):
+        switch = Switch.objects.create(key='users', status=SELECTIVE)
+        switch.add_condition(
+            self.gargoyle,
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='bob',
+        )
+        loaded = []
+
+        def lazy_user(username):
+            def get():
+                loaded.append(username)
+                return User(pk=1, username=username)
+            return SimpleLazyObject(get)
+
+        request = RequestFactory().get('/')
+        request.user = lazy_user('bob')
+        assert self.run_async(self.gargoyle.ais_active('users', request)) is True
+        request.user = lazy_user('alice')
+        assert self.run_async(self.gargoyle.ais_active('users', request)) is False
+
+        # Users aren't loaded for switches without conditions
+        request.user = lazy_user('carol')
+        assert self.run_async(self.gargoyle.ais_active('global', request)) is True
+        assert loaded == ['bob', 'alice']
+
+    def test_auto_create(self):
+        self.gargoyle = self.make_gargoyle(auto_create=True)
+        assert self.run_async(self.gargoyle.ais_active('created')) is False
+
+        for _ in range(100):
+            self.run_async(asyncio.sleep(0.01))
+            if 'created' in self.gargoyle.async_loader.snapshot:
+                break
+        assert Switch.objects.filter(key='created').exists()
+        assert 'created' in self.gargoyle.async_loader.snapshot
+
+    def test_switches_override(self):
+        with switches(self.gargoyle, disabled=True):
+            assert self.run_async(self.gargoyle.ais_active('disabled')) is True
+            # Overrides apply to parents too
+            assert self.gargoyle.is_active('disabled:child') is True
+            assert self.run_async(self.gargoyle.ais_active('disabled:child')) is True
+        assert self.run_async(self.gargoyle.ais_active('disabled')) is False
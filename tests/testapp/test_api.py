@@ -9,11 +9,14 @@ import datetime
 import pytest
 from django.contrib.auth.models import AnonymousUser, User
 from django.core.cache import cache
+from django.db import connection
 from django.http import Http404, HttpResponse
 from django.test import TestCase
-from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext, override_settings
 
 from gargoyle.builtins import IPAddressConditionSet, UserConditionSet
+from gargoyle.compat import numpy
+from gargoyle.conditions import ModelConditionSet, QueryNotSupported, String
 from gargoyle.constants import AB_TEST, FEATURE
 from gargoyle.decorators import switch_is_active
 from gargoyle.manager import SwitchManager
@@ -823,3 +826,377 @@ class APITest(TestCase):
         assert not self.gargoyle.is_active('test:child', user)
 
         assert not self.gargoyle.is_active('test:child')
+
+
+class QueryTest(TestCase):
+    condition_set = 'gargoyle.builtins.UserConditionSet(auth.user)'
+
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        self.gargoyle.register(UserConditionSet(User))
+        self.gargoyle.register(IPAddressConditionSet())
+
+        joined = datetime.datetime(2018, 6, 1, 12, 0)
+        User.objects.create(pk=5, username='alice', email='alice@example.com', is_staff=True, date_joined=joined)
+        User.objects.create(pk=42, username='bob', email='bob@example.org', date_joined=joined)
+        User.objects.create(
+            pk=150, username='carol', email='carol@example.com', is_superuser=True,
+            date_joined=joined + datetime.timedelta(days=30),
+        )
+        User.objects.create(pk=199, username='dave', email='', is_active=False, date_joined=joined)
+        User.objects.create(
+            pk=260, username='admin_eve', email='eve@example.net', is_staff=True, is_superuser=True,
+            date_joined=joined + datetime.timedelta(days=60),
+        )
+
+    def add_condition(self, key, field_name, condition, **kwargs):
+        # A trailing comma after **kwargs is a syntax error on Python 2
+        self.gargoyle[key].add_condition(
+            condition_set=self.condition_set, field_name=field_name, condition=condition, **kwargs)
+
+    def assertMatchesIsActive(self, key, **kwargs):
+        users = User.objects.order_by('pk')
+        expected = [user.username for user in users if self.gargoyle.is_active(key, user, **kwargs)]
+        queryset = self.gargoyle.filter_queryset(key, User.objects.order_by('pk'), **kwargs)
+        assert [user.username for user in queryset] == expected
+        queryset = User.objects.filter(self.gargoyle.to_q(key, **kwargs)).order_by('pk')
+        assert [user.username for user in queryset] == expected
+        return expected
+
+    def test_statuses(self):
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='disabled', status=DISABLED)
+        Switch.objects.create(key='inherit', status=INHERIT)
+        Switch.objects.create(key='selective', status=SELECTIVE)
+
+        assert len(self.assertMatchesIsActive('global')) == 5
+        assert self.assertMatchesIsActive('disabled') == []
+        assert self.assertMatchesIsActive('inherit') == []
+        assert self.assertMatchesIsActive('selective') == []
+        assert self.assertMatchesIsActive('missing') == []
+
+    def test_strings(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'username', 'bob')
+        self.add_condition('test', 'email', 'carol@example.com')
+
+        assert self.assertMatchesIsActive('test') == ['bob', 'carol']
+
+    def test_booleans_and_exclusions(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'is_staff', '1')
+        self.add_condition('test', 'is_superuser', '1', exclude=True)
+
+        assert self.assertMatchesIsActive('test') == ['alice', 'bob', 'dave']
+
+    def test_only_exclusions(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'is_active', '1', exclude=True)
+
+        assert self.assertMatchesIsActive('test') == ['dave']
+
+    def test_date_joined(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'date_joined', '2018-07-01')
+        self.add_condition('test', 'date_joined', '2018-07-15')
+
+        assert self.assertMatchesIsActive('test') == ['carol', 'admin_eve']
+
+    @override_settings(USE_TZ=True)
+    def test_date_joined_with_time_zones(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'date_joined', '2018-07-01')
+
+        assert self.assertMatchesIsActive('test') == ['carol', 'admin_eve']
+
+    def test_percent(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'percent', '0-10')
+        self.add_condition('test', 'percent', '40-60')
+
+        assert self.assertMatchesIsActive('test') == ['alice', 'bob', 'carol', 'admin_eve']
+
+        self.add_condition('test', 'percent', '99-100', exclude=True)
+        assert self.assertMatchesIsActive('test') == ['alice', 'bob', 'carol', 'admin_eve']
+
+    def test_patterns(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'username_prefix', 'admin_')
+        self.add_condition('test', 'email_suffix', '@example.org')
+        self.add_condition('test', 'email_regex', '^c[a-z]+@')
+
+        assert self.assertMatchesIsActive('test') == ['bob', 'carol', 'admin_eve']
+
+    def test_anonymous(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'is_anonymous', '1')
+
+        assert self.assertMatchesIsActive('test') == []
+
+    def test_ab_test(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'username', 'alice')
+        self.add_condition('test', 'username', 'bob', condition_type=AB_TEST)
+
+        assert self.assertMatchesIsActive('test') == ['alice']
+        assert self.assertMatchesIsActive('test', switch_type=AB_TEST) == ['bob']
+
+    def test_other_condition_sets(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.gargoyle['test'].add_condition(
+            condition_set='gargoyle.builtins.IPAddressConditionSet',
+            field_name='ip_address',
+            condition='192.168.1.1',
+        )
+
+        assert self.assertMatchesIsActive('test') == []
+
+        self.add_condition('test', 'username', 'bob')
+        assert self.assertMatchesIsActive('test') == ['bob']
+
+    def test_inheritance(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'is_staff', '1')
+        Switch.objects.create(key='test:child', status=INHERIT)
+        Switch.objects.create(key='test:global', status=GLOBAL)
+        Switch.objects.create(key='test:selective', status=SELECTIVE)
+        self.add_condition('test:selective', 'username', 'alice')
+        self.add_condition('test:selective', 'username', 'bob')
+
+        assert self.assertMatchesIsActive('test:child') == ['alice', 'admin_eve']
+        assert self.assertMatchesIsActive('test:global') == ['alice', 'admin_eve']
+        assert self.assertMatchesIsActive('test:selective') == ['alice']
+
+        switch = self.gargoyle['test']
+        switch.status = DISABLED
+        switch.save()
+        assert self.assertMatchesIsActive('test:global') == []
+
+    def test_unsupported_field(self):
+        class NicknameConditionSet(ModelConditionSet):
+            nickname = String()
+
+            def get_namespace(self):
+                return 'nickname'
+
+        self.gargoyle.register(NicknameConditionSet(User))
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.gargoyle['test'].add_condition(
+            condition_set=NicknameConditionSet(User).get_id(),
+            field_name='nickname',
+            condition='bobby',
+        )
+
+        with pytest.raises(QueryNotSupported) as excinfo:
+            self.gargoyle.filter_queryset('test', User.objects.all())
+        assert 'nickname is not a database field' in str(excinfo.value)
+
+    def test_unsupported_condition_set(self):
+        class LegacyConditionSet(ModelConditionSet):
+            username = String()
+
+            def get_namespace(self):
+                return 'legacy'
+
+            def is_active(self, instance, conditions):
+                return True
+
+        self.gargoyle.register(LegacyConditionSet(User))
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.gargoyle['test'].add_condition(
+            condition_set=LegacyConditionSet(User).get_id(),
+            field_name='username',
+            condition='bob',
+        )
+
+        with pytest.raises(QueryNotSupported):
+            self.gargoyle.to_q('test')
+
+
+@pytest.mark.skipif(numpy is None, reason='NumPy is not installed')
+class BatchTest(QueryTest):
+    """
+    Runs the QueryTest cases against evaluate_batch(), with columns both
+    loaded from a queryset and given as Python lists.
+    """
+    def assertMatchesIsActive(self, key, **kwargs):
+        users = list(User.objects.order_by('pk'))
+        expected = [user.username for user in users if self.gargoyle.is_active(key, user, **kwargs)]
+
+        mask = self.gargoyle.evaluate_batch(key, User.objects.order_by('pk'), **kwargs)
+        assert mask.dtype == bool
+        assert [user.username for user, active in zip(users, mask) if active] == expected
+
+        columns = {
+            'id': [user.pk for user in users],
+            'username': [user.username for user in users],
+            'email': [user.email for user in users],
+            'is_active': [user.is_active for user in users],
+            'is_staff': [user.is_staff for user in users],
+            'is_superuser': [user.is_superuser for user in users],
+            'date_joined': [user.date_joined for user in users],
+        }
+        mask = self.gargoyle.evaluate_batch(key, columns, **kwargs)
+        assert [user.username for user, active in zip(users, mask) if active] == expected
+        return expected
+
+    def test_unsupported_field(self):
+        class NicknameConditionSet(ModelConditionSet):
+            nickname = String()
+
+            def get_namespace(self):
+                return 'nickname'
+
+        self.gargoyle.register(NicknameConditionSet(User))
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.gargoyle['test'].add_condition(
+            condition_set=NicknameConditionSet(User).get_id(),
+            field_name='nickname',
+            condition='bobby',
+        )
+
+        with pytest.raises(ValueError) as excinfo:
+            self.gargoyle.evaluate_batch('test', User.objects.all())
+        assert 'No nickname column' in str(excinfo.value)
+
+        mask = self.gargoyle.evaluate_batch('test', {'nickname': ['bob', 'bobby']})
+        assert mask.tolist() == [False, True]
+
+    def test_unsupported_condition_set(self):
+        class LegacyConditionSet(ModelConditionSet):
+            username = String()
+
+            def get_namespace(self):
+                return 'legacy'
+
+            def is_active(self, instance, conditions):
+                return True
+
+        self.gargoyle.register(LegacyConditionSet(User))
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.gargoyle['test'].add_condition(
+            condition_set=LegacyConditionSet(User).get_id(),
+            field_name='username',
+            condition='bob',
+        )
+
+        with pytest.raises(QueryNotSupported):
+            self.gargoyle.evaluate_batch('test', {'username': ['bob']})
+
+    def test_mismatched_columns(self):
+        with pytest.raises(ValueError):
+            self.gargoyle.evaluate_batch('test', {'id': [1, 2], 'username': ['bob']})
+
+    def test_numpy_columns(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'percent', '0-49')
+        self.add_condition('test', 'date_joined', '2018-07-01', exclude=True)
+
+        ids = numpy.arange(1000)
+        date_joined = numpy.array(['2018-06-30T23:59'] * 999 + ['2018-07-01T00:00'], dtype='datetime64[us]')
+        mask = self.gargoyle.evaluate_batch('test', {'id': ids, 'date_joined': date_joined})
+        expected = [
+            self.gargoyle.is_active('test', User(pk=pk, date_joined=joined))
+            for pk, joined in zip(ids.tolist(), date_joined.tolist())
+        ]
+        assert mask.tolist() == expected
+        assert mask.sum() == 999
+
+
+class IterActiveTest(QueryTest):
+    """
+    Runs the QueryTest cases against iter_active(), in chunks small enough
+    to need several queries.
+    """
+    def assertMatchesIsActive(self, key, **kwargs):
+        users = list(User.objects.order_by('pk'))
+        expected = [user.pk for user in users if self.gargoyle.is_active(key, user, **kwargs)]
+
+        queryset = User.objects.order_by('-username')
+        assert list(self.gargoyle.iter_active(key, queryset, chunk_size=2, **kwargs)) == expected
+        assert list(self.gargoyle.iter_active(key, queryset, **kwargs)) == expected
+        return [user.username for user in users if user.pk in expected]
+
+    def test_chunks(self):
+        Switch.objects.create(key='test', status=GLOBAL)
+
+        with CaptureQueriesContext(connection) as queries:
+            assert list(self.gargoyle.iter_active('test', User.objects.all(), chunk_size=2)) == [5, 42, 150, 199, 260]
+        assert len(queries) == 3
+        assert 'LIMIT 2' in queries[-1]['sql']
+
+        with CaptureQueriesContext(connection) as queries:
+            assert list(self.gargoyle.iter_active('test', User.objects.filter(pk__gt=42), chunk_size=3)) == [
+                150, 199, 260,
+            ]
+        assert len(queries) == 2
+
+    def test_outside_memo_and_stats(self):
+        Switch.objects.create(key='test', status=GLOBAL)
+        self.gargoyle.enable_stats()
+        try:
+            with self.gargoyle.memoize():
+                assert list(self.gargoyle.iter_active('test', User.objects.all())) == [5, 42, 150, 199, 260]
+                assert self.gargoyle._memo.current.results == {}
+            assert self.gargoyle.get_stats() == {}
+        finally:
+            self.gargoyle.disable_stats()
+
+    def test_referenced_fields(self):
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.add_condition('test', 'email_suffix', '@example.com')
+        self.add_condition('test', 'percent', '0-50')
+        self.add_condition('test', 'is_anonymous', '1')
+        Switch.objects.create(key='test:child', status=SELECTIVE)
+        self.add_condition('test:child', 'is_staff', '1', exclude=True)
+
+        fields = self.gargoyle.get_referenced_fields('test:child', User)
+        assert [field.name for field in fields] == ['id', 'email', 'is_staff']
+
+        with CaptureQueriesContext(connection) as queries:
+            assert list(self.gargoyle.iter_active('test:child', User.objects.all())) == [42, 150]
+        assert len(queries) == 1
+        assert 'username' not in queries[0]['sql']
+
+    def test_unsupported_field(self):
+        class NicknameConditionSet(ModelConditionSet):
+            nickname = String()
+
+            def get_namespace(self):
+                return 'nickname'
+
+        self.gargoyle.register(NicknameConditionSet(User))
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.gargoyle['test'].add_condition(
+            condition_set=NicknameConditionSet(User).get_id(),
+            field_name='nickname',
+            condition='bobby',
+        )
+
+        # Users have no nickname to check, whichever way they are loaded
+        with pytest.raises(AttributeError):
+            self.gargoyle.is_active('test', User.objects.get(pk=5))
+        with pytest.raises(AttributeError):
+            list(self.gargoyle.iter_active('test', User.objects.all()))
+
+    def test_unsupported_condition_set(self):
+        class LegacyConditionSet(ModelConditionSet):
+            username = String()
+
+            def get_namespace(self):
+                return 'legacy'
+
+            def is_active(self, instance, conditions):
+                return instance.last_name == 'Smith'
+
+        self.gargoyle.register(LegacyConditionSet(User))
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.gargoyle['test'].add_condition(
+            condition_set=LegacyConditionSet(User).get_id(),
+            field_name='username',
+            condition='bob',
+        )
+        User.objects.filter(pk=150).update(last_name='Smith')
+
+        assert len(self.gargoyle.get_referenced_fields('test', User)) == len(User._meta.concrete_fields)
+        assert self.assertMatchesIsActive('test') == ['carol']
@@ -1,8 +1,11 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import calendar
 import datetime
+import os
 import socket
 
+import pytest
 import pytz
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
@@ -12,11 +15,12 @@ from django.utils import timezone
 from freezegun import freeze_time
 
 from gargoyle.builtins import (
-    ActiveTimezoneTodayConditionSet, AppTodayConditionSet, ConditionSet, HostConditionSet, IPAddressConditionSet,
-    UserConditionSet, UTCTodayConditionSet,
+    ActiveTimezoneTodayConditionSet, AppTodayConditionSet, ConditionSet, GeoIPConditionSet, HostConditionSet,
+    HTTPConditionSet, IPAddressConditionSet, UserConditionSet, UTCTodayConditionSet,
 )
-from gargoyle.conditions import Field
-from gargoyle.constants import AB_TEST, FEATURE, INCLUDE
+from gargoyle.conditions import Field, ValidationError
+from gargoyle.constants import AB_TEST, EXCLUDE, FEATURE, INCLUDE
+from gargoyle.context import EvaluationContext
 from gargoyle.manager import SwitchManager
 from gargoyle.models import SELECTIVE, Switch
 
@@ -97,6 +101,140 @@ class IPAddressConditionSetTests(TestCase):
         assert self.gargoyle.is_active('test', request)
 
 
+class HTTPConditionSetTests(TestCase):
+    condition_set = 'gargoyle.builtins.HTTPConditionSet'
+
+    def setUp(self):
+        super(HTTPConditionSetTests, self).setUp()
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        self.gargoyle.register(HTTPConditionSet())
+        self.request_factory = RequestFactory()
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.switch = self.gargoyle['test']
+
+    def add_condition(self, field_name, condition, exclude=False):
+        self.switch.add_condition(
+            condition_set=self.condition_set,
+            field_name=field_name,
+            condition=condition,
+            exclude=exclude,
+        )
+
+    def test_header(self):
+        self.add_condition('header', 'X-Canary=1')
+
+        assert self.gargoyle.is_active('test', self.request_factory.get('/', HTTP_X_CANARY='1'))
+        assert not self.gargoyle.is_active('test', self.request_factory.get('/', HTTP_X_CANARY='0'))
+        assert not self.gargoyle.is_active('test', self.request_factory.get('/'))
+
+    def test_header_any_value(self):
+        self.add_condition('header', 'x-canary')
+
+        assert self.gargoyle.is_active('test', self.request_factory.get('/', HTTP_X_CANARY='0'))
+        assert not self.gargoyle.is_active('test', self.request_factory.get('/'))
+
+    def test_content_type_header(self):
+        self.add_condition('header', 'Content-Type=application/json')
+
+        request = self.request_factory.post('/', data='{}', content_type='application/json')
+        assert self.gargoyle.is_active('test', request)
+
+    def test_cookie(self):
+        self.add_condition('cookie', 'beta=1')
+
+        request = self.request_factory.get('/')
+        request.COOKIES['beta'] = '1'
+        assert self.gargoyle.is_active('test', request)
+
+        request = self.request_factory.get('/')
+        assert not self.gargoyle.is_active('test', request)
+
+    def test_query_param(self):
+        self.add_condition('query_param', 'preview=on')
+
+        assert self.gargoyle.is_active('test', self.request_factory.get('/', {'preview': 'on'}))
+        assert not self.gargoyle.is_active('test', self.request_factory.get('/', {'preview': 'off'}))
+
+    def test_user_agent(self):
+        self.add_condition('user_agent', 'Firefox/|Chrome/')
+        self.add_condition('user_agent', 'bot', exclude=True)
+
+        request = self.request_factory.get('/', HTTP_USER_AGENT='Mozilla/5.0 Firefox/60.0')
+        assert self.gargoyle.is_active('test', request)
+
+        request = self.request_factory.get('/', HTTP_USER_AGENT='Chrome/1 googlebot')
+        assert not self.gargoyle.is_active('test', request)
+
+
+@override_settings(GARGOYLE_GEOIP_DATABASE=os.path.join(os.path.dirname(__file__), 'data', 'geoip.dat'))
+class GeoIPConditionSetTests(TestCase):
+    condition_set = 'gargoyle.builtins.GeoIPConditionSet'
+
+    def setUp(self):
+        super(GeoIPConditionSetTests, self).setUp()
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        self.gargoyle.register(GeoIPConditionSet())
+        self.request_factory = RequestFactory()
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.switch = self.gargoyle['test']
+
+    def test_country(self):
+        self.switch.add_condition(
+            condition_set=self.condition_set,
+            field_name='country',
+            condition='GB',
+        )
+
+        assert self.gargoyle.is_active('test', self.request_factory.get('/', REMOTE_ADDR='81.2.69.160'))
+        assert not self.gargoyle.is_active('test', self.request_factory.get('/', REMOTE_ADDR='1.0.0.1'))
+        assert not self.gargoyle.is_active('test', self.request_factory.get('/', REMOTE_ADDR='127.0.0.1'))
+
+    def test_region(self):
+        self.switch.add_condition(
+            condition_set=self.condition_set,
+            field_name='region',
+            condition='US-CA',
+        )
+
+        assert self.gargoyle.is_active('test', self.request_factory.get('/', REMOTE_ADDR='198.51.100.1'))
+        assert not self.gargoyle.is_active('test', self.request_factory.get('/', REMOTE_ADDR='198.51.100.200'))
+
+    def test_exclude_country(self):
+        self.switch.add_condition(
+            condition_set=self.condition_set,
+            field_name='country',
+            condition='DE',
+            exclude=True,
+        )
+
+        assert not self.gargoyle.is_active('test', self.request_factory.get('/', REMOTE_ADDR='2001:db8::1'))
+        assert self.gargoyle.is_active('test', self.request_factory.get('/', REMOTE_ADDR='81.2.69.160'))
+
+    def test_location_cached_per_request(self):
+        condition_set = GeoIPConditionSet()
+        request = self.request_factory.get('/', REMOTE_ADDR='81.2.69.160')
+        location = condition_set.get_location(request)
+        assert location.country == 'GB'
+        assert request._gargoyle_geoip_location == ('81.2.69.160', location)
+
+        request._gargoyle_geoip_location = ('81.2.69.160', 'cached')
+        assert condition_set.get_location(request) == 'cached'
+
+        request.META['REMOTE_ADDR'] = '1.0.0.1'
+        assert condition_set.get_location(request).country == 'AU'
+
+    def test_clean(self):
+        fields = GeoIPConditionSet.fields
+        assert fields['country'].clean(' gb ') == 'GB'
+        assert fields['region'].clean('us-ca') == 'US-CA'
+        with pytest.raises(ValidationError):
+            fields['country'].clean('GBR')
+        with pytest.raises(ValidationError):
+            fields['region'].clean('CA')
+
+
 class HostConditionSetTests(TestCase):
     def setUp(self):
         self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
@@ -164,6 +302,84 @@ class UTCTodayConditionSetTests(TestCase):
             assert self.condition_set.get_field_value(None, 'now_is_on_or_after') == self.utc_dt
 
 
+class TodayActivationWindowTests(TestCase):
+    condition_set = 'gargoyle.builtins.UTCTodayConditionSet'
+
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        self.gargoyle.register(UTCTodayConditionSet())
+        self.gargoyle.register(AppTodayConditionSet())
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.switch = self.gargoyle['test']
+
+    def test_window(self):
+        # Active from 2016-01-02 until the end of 2016-01-03
+        self.switch.add_condition(
+            condition_set=self.condition_set,
+            field_name='today_is_before',
+            condition='2016-01-02',
+            exclude=True,
+        )
+        self.switch.add_condition(
+            condition_set=self.condition_set,
+            field_name='today_is_on_or_after',
+            condition='2016-01-04',
+            exclude=True,
+        )
+
+        with freeze_time('2016-01-01 23:59:59') as frozen:
+            assert not self.gargoyle.is_active('test')
+            plan = self.gargoyle.get_plan(self.gargoyle['test'])
+            assert plan.folded is False
+            assert plan.expires_at == calendar.timegm((2016, 1, 2, 0, 0, 0))
+
+            frozen.tick()
+            assert self.gargoyle.is_active('test')
+            plan = self.gargoyle.get_plan(self.gargoyle['test'])
+            assert plan.folded is True
+            assert plan.conditions == ()
+            assert plan.expires_at == calendar.timegm((2016, 1, 4, 0, 0, 0))
+
+            frozen.move_to('2016-01-03 23:59:59')
+            assert self.gargoyle.is_active('test')
+
+            frozen.tick()
+            assert not self.gargoyle.is_active('test')
+            plan = self.gargoyle.get_plan(self.gargoyle['test'])
+            assert plan.expires_at is None
+
+    def test_plan_reused_until_transition(self):
+        self.switch.add_condition(
+            condition_set=self.condition_set,
+            field_name='today_is_on_or_after',
+            condition='2016-01-02',
+        )
+
+        with freeze_time('2016-01-01 12:00:00') as frozen:
+            plan = self.gargoyle.get_plan(self.gargoyle['test'])
+            frozen.tick(delta=datetime.timedelta(hours=11))
+            assert self.gargoyle.get_plan(self.gargoyle['test']) is plan
+            frozen.tick(delta=datetime.timedelta(hours=1))
+            assert self.gargoyle.get_plan(self.gargoyle['test']) is not plan
+
+    @override_settings(USE_TZ=True, TIME_ZONE='America/New_York')
+    def test_app_timezone_transition(self):
+        self.switch.add_condition(
+            condition_set='gargoyle.builtins.AppTodayConditionSet',
+            field_name='today_is_on_or_after',
+            condition='2016-01-02',
+        )
+
+        with freeze_time('2016-01-02 04:59:59') as frozen:
+            assert not self.gargoyle.is_active('test')
+            plan = self.gargoyle.get_plan(self.gargoyle['test'])
+            assert plan.expires_at == calendar.timegm((2016, 1, 2, 5, 0, 0))
+
+            frozen.tick()
+            assert self.gargoyle.is_active('test')
+
+
 class AppTodayConditionSetTests(TestCase):
     def setUp(self):
         """
@@ -342,6 +558,21 @@ class UserConditionSetTests(TestCase):
         user = self.User(id=75)
         assert not self.condition_set.is_active(user, conditions)
 
+    def test_user_email_suffix(self):
+        conditions = self._create_condition('email_suffix', [(INCLUDE, '@example.com')])
+        assert self.condition_set.is_active(self.User(email='bob@example.com'), conditions) is True
+        assert not self.condition_set.is_active(self.User(email='bob@example.org'), conditions)
+
+    def test_user_username_prefix(self):
+        conditions = self._create_condition('username_prefix', [(INCLUDE, 'test.')])
+        assert self.condition_set.is_active(self.User(username='test.user'), conditions) is True
+        assert not self.condition_set.is_active(self.User(username='another.user'), conditions)
+
+    def test_user_email_regex(self):
+        conditions = self._create_condition('email_regex', [(INCLUDE, r'^qa\+\w+@'), (EXCLUDE, r'\.org$')])
+        assert self.condition_set.is_active(self.User(email='qa+1@example.com'), conditions) is True
+        assert not self.condition_set.is_active(self.User(email='qa+1@example.org'), conditions)
+
     def test_user_is_anonymous(self):
         conditions = self._create_condition('is_anonymous', [(INCLUDE, True)])
         user = AnonymousUser()
@@ -353,6 +584,108 @@ class UserConditionSetTests(TestCase):
         assert not self.condition_set.is_active(user, conditions)
 
 
+@override_settings(GARGOYLE_GEOIP_DATABASE=os.path.join(os.path.dirname(__file__), 'data', 'geoip.dat'))
+class EvaluationContextTests(TestCase):
+
+    def setUp(self):
+        super(EvaluationContextTests, self).setUp()
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        self.user_condition_set = UserConditionSet(get_user_model())
+        for condition_set in (self.user_condition_set, IPAddressConditionSet(), HTTPConditionSet(),
+                              GeoIPConditionSet()):
+            self.gargoyle.register(condition_set)
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.switch = self.gargoyle['test']
+
+    def add_condition(self, condition_set, field_name, condition, exclude=False):
+        self.switch.add_condition(
+            condition_set=condition_set.get_id(),
+            field_name=field_name,
+            condition=condition,
+            exclude=exclude,
+        )
+
+    def test_slots(self):
+        context = EvaluationContext(user_id=5)
+        with pytest.raises(AttributeError):
+            context.user = None
+        assert context.attributes == {}
+        assert context.headers == {}
+
+    def test_headers_keyed_as_meta(self):
+        context = EvaluationContext(headers={'X-Canary': '1', 'Content-Type': 'text/plain'})
+        assert context.headers == {'HTTP_X_CANARY': '1', 'CONTENT_TYPE': 'text/plain'}
+
+    def test_user_percent(self):
+        self.add_condition(self.user_condition_set, 'percent', '0-50')
+
+        assert self.gargoyle.is_active('test', EvaluationContext(user_id=25))
+        assert not self.gargoyle.is_active('test', EvaluationContext(user_id=75))
+        assert not self.gargoyle.is_active('test', EvaluationContext())
+
+    def test_user_attributes(self):
+        self.add_condition(self.user_condition_set, 'is_staff', '1')
+        self.add_condition(self.user_condition_set, 'username_prefix', 'qa.')
+        self.add_condition(self.user_condition_set, 'date_joined', '2018-10-23', exclude=True)
+
+        assert self.gargoyle.is_active('test', EvaluationContext(user_id=1, attributes={'is_staff': True}))
+        assert self.gargoyle.is_active('test', EvaluationContext(user_id=1, attributes={'username': 'qa.bob'}))
+        # Exclusions with unknown values don't match
+        assert self.gargoyle.is_active('test', EvaluationContext(user_id=1))
+        assert not self.gargoyle.is_active(
+            'test', EvaluationContext(user_id=1, attributes={'date_joined': datetime.date(2018, 10, 24)}),
+        )
+
+    def test_ip_address(self):
+        self.add_condition(IPAddressConditionSet(), 'ip_address', '192.168.1.1')
+
+        assert self.gargoyle.is_active('test', EvaluationContext(ip='192.168.1.1'))
+        assert not self.gargoyle.is_active('test', EvaluationContext(ip='192.168.1.2'))
+        assert not self.gargoyle.is_active('test', EvaluationContext(user_id=1))
+
+    @override_settings(INTERNAL_IPS=['10.0.0.1'])
+    def test_internal_ip(self):
+        self.add_condition(IPAddressConditionSet(), 'internal_ip', '1')
+
+        assert self.gargoyle.is_active('test', EvaluationContext(ip='10.0.0.1'))
+        assert not self.gargoyle.is_active('test', EvaluationContext(ip='10.0.0.2'))
+
+    def test_headers(self):
+        self.add_condition(HTTPConditionSet(), 'header', 'X-Canary=1')
+        self.add_condition(HTTPConditionSet(), 'user_agent', 'bot', exclude=True)
+
+        assert self.gargoyle.is_active('test', EvaluationContext(headers={'X-Canary': '1'}))
+        assert not self.gargoyle.is_active('test', EvaluationContext(headers={'X-Canary': '1', 'User-Agent': 'bot'}))
+
+    def test_cookies_unknown(self):
+        self.add_condition(HTTPConditionSet(), 'cookie', 'beta')
+
+        assert not self.gargoyle.is_active('test', EvaluationContext(headers={'Cookie': 'beta=1'}))
+
+    def test_http_needs_request(self):
+        assert not HTTPConditionSet().can_execute(EvaluationContext(user_id=5))
+        assert HTTPConditionSet().can_execute(EvaluationContext(ip='10.0.0.1'))
+        assert HTTPConditionSet().can_execute(EvaluationContext(headers={'X-Canary': '1'}))
+
+    def test_exclude_cookie_user_only(self):
+        self.add_condition(self.user_condition_set, 'percent', '0-100')
+        self.add_condition(HTTPConditionSet(), 'cookie', 'beta', exclude=True)
+
+        assert self.gargoyle.is_active('test', EvaluationContext(user_id=5))
+        # The cookie is never read from a context without a request
+        explanation = self.gargoyle.explain('test', EvaluationContext(user_id=5))
+        steps = dict((step.condition_set, step) for step in explanation.switches[0].condition_sets)
+        assert steps[HTTPConditionSet().get_id()].instances == []
+
+    def test_geoip(self):
+        self.add_condition(GeoIPConditionSet(), 'country', 'GB')
+
+        assert self.gargoyle.is_active('test', EvaluationContext(ip='81.2.69.160'))
+        assert not self.gargoyle.is_active('test', EvaluationContext(ip='1.0.0.1'))
+        assert not self.gargoyle.is_active('test', EvaluationContext())
+
+
 class ConditionSetABTestTests(TestCase):
     def _create_instance(self):
         """ Returns an empty object which can get new fields in execution time """
@@ -2,12 +2,16 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import pytest
 import six
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.management import call_command
 from django.core.management.base import CommandError
 from django.test import TestCase
 
+from gargoyle import gargoyle as global_gargoyle
+from gargoyle.constants import AB_TEST, EXCLUDE, FEATURE, INCLUDE
 from gargoyle.manager import SwitchManager
-from gargoyle.models import DISABLED, GLOBAL, Switch
+from gargoyle.models import DISABLED, GLOBAL, INHERIT, SELECTIVE, Switch
 
 
 class CommandAddSwitchTestCase(TestCase):
@@ -87,3 +91,93 @@ class CommandRemoveSwitchTestCase(TestCase):
         call_command('remove_switch', 'idontexist')
 
         assert 'idontexist' not in self.gargoyle
+
+
+class CommandGargoyleGenerateTestCase(TestCase):
+
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True)
+        for condition_set in global_gargoyle.get_condition_sets():
+            self.gargoyle.register(condition_set)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_generate(self):
+        out = six.StringIO()
+        call_command('gargoyle_generate', switches=200, seed=1, stdout=out)
+        assert out.getvalue().strip() == 'Created 200 switches.'
+
+        switches = list(Switch.objects.all())
+        assert len(switches) == 200
+        keys = set(switch.key for switch in switches)
+        assert any(':' in key for key in keys)
+        for key in keys:
+            assert key.startswith('synthetic-')
+            assert ':'.join(key.split(':')[:-1]) in keys | {''}
+            assert len(key.split(':')) <= 3
+        statuses = set(switch.status for switch in switches)
+        assert statuses == {DISABLED, GLOBAL, INHERIT, SELECTIVE}
+
+        namespaces = set()
+        condition_types = set()
+        kinds = set()
+        for switch in switches:
+            if switch.status != SELECTIVE:
+                assert switch.value == {}
+                continue
+            for namespace, fields in switch.value.items():
+                namespaces.add(namespace)
+                for conditions in fields.values():
+                    for kind, condition, condition_type in conditions:
+                        kinds.add(kind)
+                        condition_types.add(condition_type)
+        assert namespaces == set(condition_set.get_namespace() for condition_set in self.gargoyle.get_condition_sets())
+        assert kinds == {INCLUDE, EXCLUDE}
+        assert condition_types == {FEATURE, AB_TEST}
+
+        # Every switch can be checked
+        for switch in switches:
+            self.gargoyle.is_active(switch.key, User(id=42, username='foo', email='foo@example.com'))
+
+    def test_seeded(self):
+        call_command('gargoyle_generate', switches=50, seed=7, stdout=six.StringIO())
+        first = dict(Switch.objects.values_list('key', 'value'))
+        call_command('gargoyle_generate', switches=50, seed=7, replace=True, stdout=six.StringIO())
+        assert dict(Switch.objects.values_list('key', 'value')) == first
+        call_command('gargoyle_generate', switches=50, seed=8, replace=True, stdout=six.StringIO())
+        assert dict(Switch.objects.values_list('key', 'value')) != first
+
+    def test_replace(self):
+        Switch.objects.create(key='synthetic_users', status=GLOBAL)
+        Switch.objects.create(key='synthetics', status=GLOBAL)
+        call_command('gargoyle_generate', switches=50, stdout=six.StringIO())
+        reloads = global_gargoyle.metrics.reloads
+
+        call_command('gargoyle_generate', switches=20, replace=True, stdout=six.StringIO())
+        # Once, rather than after each switch deleted
+        assert global_gargoyle.metrics.reloads == reloads + 1
+        keys = set(Switch.objects.values_list('key', flat=True))
+        assert len(keys) == 22
+        assert {'synthetic_users', 'synthetics'} <= keys
+        assert global_gargoyle.is_active('synthetics')
+
+    def test_conditions_per_switch(self):
+        call_command(
+            'gargoyle_generate', '--switches', '30', '--conditions-per-switch', '3', '--max-depth', '1',
+            '--exclude-ratio', '0', stdout=six.StringIO(),
+        )
+        for switch in Switch.objects.all():
+            assert ':' not in switch.key
+            conditions = [
+                condition
+                for fields in switch.value.values()
+                for field_conditions in fields.values()
+                for condition in field_conditions
+            ]
+            assert len(conditions) <= 3
+            assert all(condition[0] == INCLUDE for condition in conditions)
+
+    def test_invalid_range(self):
+        with pytest.raises(CommandError):
+            call_command('gargoyle_generate', '--conditions-per-switch', '5-1')
@@ -6,7 +6,12 @@ import pytest
 from django.core.validators import ValidationError
 from django.test import TestCase
 
-from gargoyle.conditions import AbstractDate, BeforeDate, ConditionSet, OnOrAfterDate, Percent, Range
+from gargoyle.compat import numpy
+from gargoyle.conditions import (
+    AbstractDate, BeforeDate, Boolean, ConditionSet, IntervalIndex, KeyValue, OnOrAfterDate, Percent, Prefix,
+    QueryNotSupported, Range, Regex, String, Suffix,
+)
+from gargoyle.constants import EXCLUDE, INCLUDE
 from gargoyle.manager import SwitchManager
 from gargoyle.models import SELECTIVE, Switch
 
@@ -74,8 +79,97 @@ class RangeTests(TestCase):
         with pytest.raises(ValidationError):
             condition.clean('1-2-3')
 
+    def test_compile_matches_is_active(self):
+        condition = Range()
+        conditions = ['1-3', '10-20', '2-5', '30-25', '21-22']
+        matcher = condition.compile(conditions)
+        for value in [-1, 0, 1, 2, 3, 4.5, 5, 5.5, 6, 9, 10, 15, 20, 20.5, 21, 22, 23, 25, 30, '2', None]:
+            assert matcher(value) == any(condition.is_active(c, value) for c in conditions), value
+
+    def test_compile_malformed_fails_on_use(self):
+        condition = Range()
+        matcher = condition.compile(['1'])
+        assert not matcher('1')
+        with pytest.raises(IndexError):
+            matcher(1)
+
+
+class ExclusiveRange(Range):
+    def is_active(self, condition, value):
+        bounds = list(map(int, condition.split('-')))
+        return bounds[0] < value < bounds[1]
+
+
+class CenturyPercent(Percent):
+    def is_active(self, condition, value):
+        return super(CenturyPercent, self).is_active(condition, value // 100)
+
+
+class OverriddenIsActiveTests(TestCase):
+
+    def test_range_compile(self):
+        matcher = ExclusiveRange().compile(['1-3'])
+        assert matcher(2)
+        assert not matcher(1)
+        assert not matcher(3)
+
+    def test_percent_compile(self):
+        matcher = CenturyPercent().compile(['0-0'])
+        assert matcher(50)
+        assert not matcher(150)
+
+    def test_not_queried(self):
+        with pytest.raises(QueryNotSupported):
+            ExclusiveRange().get_q('id', ['1-3'], Switch)
+        with pytest.raises(QueryNotSupported):
+            CenturyPercent().get_q('id', ['0-0'], Switch)
+
+    @pytest.mark.skipif(numpy is None, reason='NumPy is not installed')
+    def test_get_mask(self):
+        values = numpy.array([1, 2, 3])
+        assert ExclusiveRange().get_mask(['1-3'], values).tolist() == [False, True, False]
+        assert CenturyPercent().get_mask(['0-0'], numpy.array([50, 150])).tolist() == [True, False]
+
+
+class IntervalIndexTests(TestCase):
+
+    def test_merges_overlapping(self):
+        index = IntervalIndex([(10, 20), (1, 3), (2, 5), (5, 6)])
+        assert index.lowers == [1, 10]
+        assert index.uppers == [6, 20]
+        assert len(index) == 2
+
+    def test_keeps_adjacent_separate(self):
+        index = IntervalIndex([(1, 2), (3, 4)])
+        assert len(index) == 2
+        assert 2 in index
+        assert 2.5 not in index
+        assert 3 in index
+
+    def test_drops_empty(self):
+        index = IntervalIndex([(5, 3)])
+        assert len(index) == 0
+        assert 4 not in index
+
+    def test_contains(self):
+        index = IntervalIndex([(1, 3), (10, 20)])
+        assert 0 not in index
+        assert 1 in index
+        assert 3 in index
+        assert 4 not in index
+        assert 10 in index
+        assert 20 in index
+        assert 21 not in index
+
 
 class PercentTests(TestCase):
+    def test_compile_matches_is_active(self):
+        condition = Percent()
+        conditions = ['0-10', '50-60', '55-70', '100-100']
+        matcher = condition.compile(conditions)
+        for value in range(0, 250, 3):
+            assert matcher(value) == any(condition.is_active(c, value) for c in conditions), value
+
     def test_clean_success(self):
         condition = Percent()
         assert condition.clean('0-50') == '0-50'
@@ -111,6 +205,126 @@ class PercentTests(TestCase):
             condition.clean('80-20')
 
 
+class PrefixTests(TestCase):
+    def test_is_active(self):
+        condition = Prefix()
+        assert condition.is_active('admin', 'admin_bob')
+        assert not condition.is_active('admin', 'bob_admin')
+        assert not condition.is_active('admin', None)
+
+    def test_compile(self):
+        matcher = Prefix().compile(['admin', 'staff_'])
+        assert matcher('admin_bob')
+        assert matcher('staff_alice')
+        assert not matcher('staff')
+        assert not matcher(1)
+
+    def test_clean_fail_empty(self):
+        with pytest.raises(ValidationError):
+            Prefix().clean('')
+
+
+class SuffixTests(TestCase):
+    def test_is_active(self):
+        condition = Suffix()
+        assert condition.is_active('@example.com', 'bob@example.com')
+        assert not condition.is_active('@example.com', 'bob@example.com.evil')
+        assert not condition.is_active('@example.com', None)
+
+    def test_compile(self):
+        matcher = Suffix().compile(['@example.com', '@example.org'])
+        assert matcher('bob@example.com')
+        assert matcher('bob@example.org')
+        assert not matcher('bob@example.net')
+        assert not matcher(None)
+
+
+class RegexTests(TestCase):
+    def test_is_active(self):
+        condition = Regex()
+        assert condition.is_active(r'^bob\d+$', 'bob12')
+        assert condition.is_active(r'ob', 'bob12')
+        assert not condition.is_active(r'^bob\d+$', 'bob')
+        assert not condition.is_active(r'^bob\d+$', None)
+
+    def test_compile_matches_is_active(self):
+        condition = Regex()
+        conditions = [r'^bob\d+$', r'@example\.(com|org)$', r'(?i)^ALICE$']
+        matcher = condition.compile(conditions)
+        for value in ['bob1', 'bob', 'a@example.com', 'a@example.net', 'alice', 'ALICE', '', None]:
+            assert matcher(value) == any(condition.is_active(c, value) for c in conditions), value
+
+    def test_compile_keeps_backreferences_separate(self):
+        condition = Regex()
+        conditions = [r'^(a)\1$', r'^(b)\1$']
+        matcher = condition.compile(conditions)
+        assert matcher('aa')
+        assert matcher('bb')
+        assert not matcher('ba')
+
+    def test_clean_success(self):
+        assert Regex().clean(r'^[a-z]+@example\.com$') == r'^[a-z]+@example\.com$'
+        assert Regex().clean(r'^(foo|bar)+$') == r'^(foo|bar)+$'
+        assert Regex().clean(r'^(a{3})+$') == r'^(a{3})+$'
+        assert Regex().clean(r'^(a?){5}$') == r'^(a?){5}$'
+        assert Regex().clean(r'^(\d{1,3}\.){3}\d{1,3}$') == r'^(\d{1,3}\.){3}\d{1,3}$'
+        assert Regex().clean(r'^([a-z0-9]{1,63}\.)+[a-z]+$') == r'^([a-z0-9]{1,63}\.)+[a-z]+$'
+        assert Regex().clean(r'^(?:ab|cd)*$') == r'^(?:ab|cd)*$'
+        assert Regex().clean(r'^(\d|[a-f])+$') == r'^(\d|[a-f])+$'
+        assert Regex().clean(r'^(a|b)|(a|ab)$') == r'^(a|b)|(a|ab)$'
+
+    def test_clean_fail_invalid(self):
+        with pytest.raises(ValidationError):
+            Regex().clean('(')
+
+    def test_clean_fail_nested_repetition(self):
+        with pytest.raises(ValidationError):
+            Regex().clean('^(a+)+$')
+        with pytest.raises(ValidationError):
+            Regex().clean('^(?:x(a*)?)*$')
+
+    def test_clean_fail_large_bounded_repetition(self):
+        # Bounded, but each of the repeats could match in more than one way
+        for pattern in (r'^(a?){30}a{30}$', r'(a{1,3}){20}', r'^(a{1,3})+$'):
+            with pytest.raises(ValidationError):
+                Regex().clean(pattern)
+
+    def test_clean_fail_overlapping_alternatives(self):
+        for pattern in (r'^(a|a)*$', r'^(a|aa)+$', r'(\d|\d\d)+x', r'^(.|a)*$', r'^(?:x|y|)+$'):
+            with pytest.raises(ValidationError):
+                Regex().clean(pattern)
+
+    def test_clean_fail_backreference(self):
+        with pytest.raises(ValidationError):
+            Regex().clean(r'^(a+)\1$')
+
+
+class KeyValueTests(TestCase):
+    def test_is_active(self):
+        condition = KeyValue()
+        assert condition.is_active('beta=1', {'beta': '1'})
+        assert not condition.is_active('beta=1', {'beta': '0'})
+        assert condition.is_active('beta', {'beta': '0'})
+        assert not condition.is_active('beta', {})
+        assert not condition.is_active('beta', None)
+
+    def test_compile_matches_is_active(self):
+        condition = KeyValue()
+        conditions = ['beta=1', 'beta=yes', 'preview', 'lang=en=GB']
+        matcher = condition.compile(conditions)
+        for value in [{}, {'beta': '1'}, {'beta': 'yes'}, {'beta': 'no'}, {'preview': ''}, {'lang': 'en=GB'}, None]:
+            assert matcher(value) == any(condition.is_active(c, value) for c in conditions), value
+
+    def test_clean(self):
+        condition = KeyValue()
+        assert condition.clean(' beta=1 ') == 'beta=1'
+        assert condition.clean('beta') == 'beta'
+        with pytest.raises(ValidationError):
+            condition.clean('=1')
+        with pytest.raises(ValidationError):
+            condition.clean('be ta=1')
+
+
 class AbstractDateTests(TestCase):
     def test_clean_success(self):
         condition = AbstractDate()
@@ -150,6 +364,57 @@ class OnOrAfterDateTests(TestCase):
         assert condition.is_active("2016-08-05", datetime.date(2016, 8, 10))
 
 
+@pytest.mark.skipif(numpy is None, reason='NumPy is not installed')
+class FieldMaskTests(TestCase):
+    """
+    get_mask() must agree with compile(), whether values are compared as a
+    whole array or one at a time.
+    """
+    def assertMaskMatchesCompile(self, field, conditions, values):
+        matcher = field.compile(conditions)
+        mask = field.get_mask(conditions, values)
+        assert mask.dtype == bool
+        assert mask.tolist() == [matcher(value) for value in values.tolist()]
+
+    def test_string(self):
+        field = String()
+        self.assertMaskMatchesCompile(field, ['a', 'b'], numpy.array(['a', 'b', 'c', '']))
+        self.assertMaskMatchesCompile(field, ['a', 'b'], numpy.array(['a', None, 1], dtype=object))
+        self.assertMaskMatchesCompile(field, ['1'], numpy.array([1, 2]))
+
+    def test_boolean(self):
+        field = Boolean()
+        self.assertMaskMatchesCompile(field, ['1'], numpy.array([True, False]))
+        self.assertMaskMatchesCompile(field, ['1'], numpy.array([0, 1, 2, float('nan')]))
+        self.assertMaskMatchesCompile(field, ['1'], numpy.array([None, '', 'x'], dtype=object))
+
+    def test_range(self):
+        field = Range()
+        self.assertMaskMatchesCompile(field, ['1-2', '5-8', '7-10'], numpy.arange(-2, 14))
+        self.assertMaskMatchesCompile(field, ['1-2'], numpy.array([0.5, 1.0, 2.0, 2.5, float('nan')]))
+        self.assertMaskMatchesCompile(field, ['1-2'], numpy.array([True, False]))
+        self.assertMaskMatchesCompile(field, ['1-2'], numpy.array(['1', None, 1], dtype=object))
+        self.assertMaskMatchesCompile(field, ['2-1'], numpy.arange(4))
+
+    def test_percent(self):
+        field = Percent()
+        self.assertMaskMatchesCompile(field, ['0-10', '90-100'], numpy.arange(-150, 350))
+
+    def test_patterns(self):
+        values = numpy.array(['admin_bob', 'bob@example.com', ''])
+        self.assertMaskMatchesCompile(Prefix(), ['admin_', 'bob'], values)
+        self.assertMaskMatchesCompile(Suffix(), ['.com', '.org'], values)
+        self.assertMaskMatchesCompile(Regex(), ['^a', '@'], values)
+        self.assertMaskMatchesCompile(Prefix(), ['admin_'], numpy.array(['admin_bob', None], dtype=object))
+
+    def test_dates(self):
+        values = numpy.array(['2018-06-30T23:59', '2018-07-01T00:00', '2018-07-02'], dtype='datetime64[us]')
+        self.assertMaskMatchesCompile(BeforeDate(), ['2018-07-01', '2018-06-01'], values)
+        self.assertMaskMatchesCompile(OnOrAfterDate(), ['2018-07-01', '2018-07-02'], values)
+        dates = numpy.array([datetime.date(2018, 6, 30), datetime.date(2018, 7, 1)], dtype=object)
+        self.assertMaskMatchesCompile(OnOrAfterDate(), ['2018-07-01'], dates)
+
+
 class NumberConditionSet(ConditionSet):
     in_range = Range()
 
@@ -182,3 +447,132 @@ class NumberConditionSetTests(TestCase):
         assert self.gargoyle.is_active('test', 2)
         assert self.gargoyle.is_active('test', 3)
         assert not self.gargoyle.is_active('test', 4)
+
+    def test_many_ranges(self):
+        for lower in range(0, 1000, 10):
+            self.switch.add_condition(
+                condition_set=self.condition_set,
+                field_name='in_range',
+                condition='%d-%d' % (lower, lower + 4),
+                commit=False,
+            )
+
+        assert self.gargoyle.is_active('test', 0)
+        assert self.gargoyle.is_active('test', 994)
+        assert not self.gargoyle.is_active('test', 995)
+        assert self.gargoyle.is_active('test', 502)
+        assert not self.gargoyle.is_active('test', 1005)
+
+        self.switch.add_condition(
+            condition_set=self.condition_set,
+            field_name='in_range',
+            condition='500-504',
+            exclude=True,
+            commit=False,
+        )
+
+        assert not self.gargoyle.is_active('test', 502)
+        # Anything not excluded is active once there's an exclusion
+        assert self.gargoyle.is_active('test', 995)
+
+    def test_plan_follows_uncommitted_conditions(self):
+        assert not self.gargoyle.is_active('test', 1)
+
+        self.switch.add_condition(
+            condition_set=self.condition_set,
+            field_name='in_range',
+            condition='1-3',
+            commit=False,
+        )
+        assert self.gargoyle.is_active('test', 1)
+
+        self.switch.clear_conditions(condition_set=self.condition_set, commit=False)
+        assert not self.gargoyle.is_active('test', 1)
+
+
+class ConditionSetCompileTests(TestCase):
+
+    def test_compile(self):
+        condition_set = NumberConditionSet()
+        compiled = condition_set.compile({
+            'NumberConditionSet': {
+                'in_range': [(INCLUDE, '1-3'), (EXCLUDE, '2-2')],
+            },
+        })
+        assert [field[0] for field in compiled.fields] == ['in_range']
+        assert condition_set.is_active_compiled(1, compiled) is True
+        assert condition_set.is_active_compiled(2, compiled) is False
+        assert condition_set.is_active_compiled(5, compiled) is True
+
+    def test_compile_other_namespace(self):
+        assert NumberConditionSet().compile({'other': {'in_range': [(INCLUDE, '1-3')]}}) is None
+
+
+class DeploymentRegionConditionSet(ConditionSet):
+    region = String()
+
+    is_static = True
+    calls = 0
+
+    def can_execute(self, instance):
+        return instance is None
+
+    def get_field_value(self, instance, field_name):
+        DeploymentRegionConditionSet.calls += 1
+        return 'eu-west-1'
+
+
+class StaticConditionSetTests(TestCase):
+
+    condition_set = __name__ + '.' + DeploymentRegionConditionSet.__name__
+
+    def setUp(self):
+        super(StaticConditionSetTests, self).setUp()
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        self.gargoyle.register(DeploymentRegionConditionSet())
+        self.gargoyle.register(NumberConditionSet())
+        DeploymentRegionConditionSet.calls = 0
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.switch = self.gargoyle['test']
+
+    def test_folds_true(self):
+        self.switch.add_condition(condition_set=self.condition_set, field_name='region', condition='eu-west-1')
+
+        for _ in range(5):
+            assert self.gargoyle.is_active('test')
+        assert DeploymentRegionConditionSet.calls == 1
+
+        plan = self.gargoyle.get_plan(self.gargoyle['test'])
+        assert plan.folded is True
+        assert plan.conditions == ()
+
+    def test_folds_false(self):
+        self.switch.add_condition(condition_set=self.condition_set, field_name='region', condition='eu-west-1',
+                                  exclude=True)
+        self.switch.add_condition(condition_set=NumberConditionSetTests.condition_set, field_name='in_range',
+                                  condition='1-3')
+
+        for _ in range(5):
+            assert not self.gargoyle.is_active('test', 2)
+        assert DeploymentRegionConditionSet.calls == 1
+
+        plan = self.gargoyle.get_plan(self.gargoyle['test'])
+        assert plan.folded is False
+        assert plan.conditions == ()
+
+    def test_folded_true_still_checks_other_conditions(self):
+        self.switch.add_condition(condition_set=self.condition_set, field_name='region', condition='eu-west-1')
+        self.switch.add_condition(condition_set=NumberConditionSetTests.condition_set, field_name='in_range',
+                                  condition='1-3', exclude=True)
+
+        assert not self.gargoyle.is_active('test', 2)
+        assert self.gargoyle.is_active('test', 5)
+        assert DeploymentRegionConditionSet.calls == 1
+
+    def test_no_match_drops(self):
+        self.switch.add_condition(condition_set=self.condition_set, field_name='region', condition='us-east-1')
+
+        assert not self.gargoyle.is_active('test')
+        plan = self.gargoyle.get_plan(self.gargoyle['test'])
+        assert plan.folded is None
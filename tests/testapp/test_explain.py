@@ -0,0 +1,164 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.test import TestCase
+
+from gargoyle.builtins import IPAddressConditionSet, UserConditionSet
+from gargoyle.conditions import ConditionSet, String
+from gargoyle.manager import SwitchManager
+from gargoyle.models import DISABLED, GLOBAL, INHERIT, SELECTIVE, Switch
+from testapp.utils import RequestFactory
+
+
+class LegacyConditionSet(ConditionSet):
+    name = String()
+
+    def is_active(self, instance, conditions, switch_type='f'):
+        # Overriding is_active means the conditions aren't compiled
+        return super(LegacyConditionSet, self).is_active(instance, conditions, switch_type)
+
+    def can_execute(self, instance):
+        return isinstance(instance, User)
+
+    def get_field_value(self, instance, field_name):
+        return instance.username
+
+
+class ExplainTests(TestCase):
+
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True)
+        self.gargoyle.register(UserConditionSet(User))
+        self.gargoyle.register(IPAddressConditionSet())
+        self.user_id = UserConditionSet(User).get_id()
+
+    def tearDown(self):
+        cache.clear()
+
+    def add_condition(self, switch, field_name, condition, exclude=False, condition_set=None):
+        switch.add_condition(
+            self.gargoyle,
+            condition_set=condition_set or 'gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name=field_name,
+            condition=condition,
+            exclude=exclude,
+        )
+
+    def test_status(self):
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='disabled', status=DISABLED)
+
+        explanation = self.gargoyle.explain('global')
+        assert explanation.result is True
+        step, = explanation.switches
+        assert (step.key, step.status, step.reason, step.result) == ('global', 'global', 'status', True)
+
+        explanation = self.gargoyle.explain('disabled')
+        assert explanation.result is False
+        assert explanation.switches[0].status == 'disabled'
+
+    def test_missing(self):
+        explanation = self.gargoyle.explain('missing', default=True)
+        assert explanation.result is True
+        step, = explanation.switches
+        assert (step.status, step.reason, step.result) == (None, 'missing', None)
+
+    def test_parents(self):
+        Switch.objects.create(key='parent', status=GLOBAL)
+        Switch.objects.create(key='parent:child', status=INHERIT)
+        Switch.objects.create(key='off', status=DISABLED)
+        Switch.objects.create(key='off:child', status=GLOBAL)
+
+        explanation = self.gargoyle.explain('parent:child')
+        assert explanation.result is True
+        assert [(step.key, step.reason, step.result) for step in explanation.switches] == [
+            ('parent', 'status', True),
+            ('parent:child', 'inherit', None),
+        ]
+
+        explanation = self.gargoyle.explain('off:child')
+        assert explanation.result is False
+        assert [(step.key, step.reason, step.result) for step in explanation.switches] == [
+            ('off', 'status', False),
+            ('off:child', 'parent', False),
+        ]
+
+    def test_conditions(self):
+        switch = Switch.objects.create(key='selective', status=SELECTIVE)
+        self.add_condition(switch, 'username', 'foo')
+        self.add_condition(switch, 'username', 'bar')
+        self.add_condition(switch, 'email_suffix', '@example.com', exclude=True)
+
+        user = User(username='foo', email='foo@example.org')
+        explanation = self.gargoyle.explain('selective', user)
+        assert explanation.result is True
+        assert explanation.result == self.gargoyle.is_active('selective', user)
+        step, = explanation.switches
+        assert (step.reason, step.result) == ('conditions', True)
+        condition_set, = step.condition_sets
+        assert (condition_set.condition_set, condition_set.result) == (self.user_id, True)
+        instance, = condition_set.instances
+        assert instance.instance is user
+        fields = dict((field.name, field) for field in instance.fields)
+        assert (fields['username'].value, fields['username'].include) == ('foo', ['foo'])
+        assert (fields['email_suffix'].value, fields['email_suffix'].exclude) == ('foo@example.org', [])
+        assert all(field.duration >= 0 for field in instance.fields)
+
+        excluded = User(username='foo', email='foo@example.com')
+        explanation = self.gargoyle.explain('selective', excluded)
+        assert explanation.result is False
+        fields = dict((field.name, field) for field in explanation.switches[0].condition_sets[0].instances[0].fields)
+        assert fields['email_suffix'].exclude == ['@example.com']
+
+    def test_no_match(self):
+        switch = Switch.objects.create(key='selective', status=SELECTIVE)
+        self.add_condition(switch, 'username', 'foo')
+
+        explanation = self.gargoyle.explain('selective', User(username='bar'), AnonymousUser())
+        assert explanation.result is False
+        condition_set, = explanation.switches[0].condition_sets
+        assert condition_set.result is None
+        assert [instance.result for instance in condition_set.instances] == [None, None]
+
+    def test_request_user(self):
+        switch = Switch.objects.create(key='selective', status=SELECTIVE)
+        self.add_condition(switch, 'username', 'foo')
+        self.add_condition(
+            switch, 'ip_address', '10.0.0.1',
+            condition_set='gargoyle.builtins.IPAddressConditionSet',
+        )
+        request = RequestFactory().get('/', user=User(username='foo'), REMOTE_ADDR='192.168.0.1')
+
+        explanation = self.gargoyle.explain('selective', request)
+        assert explanation.result is True
+        condition_sets = dict((step.condition_set, step) for step in explanation.switches[0].condition_sets)
+        assert condition_sets[self.user_id].result is True
+        ip_step = condition_sets[IPAddressConditionSet().get_id()]
+        assert ip_step.instances[0].fields[0].value == '192.168.0.1'
+        assert ip_step.instances[0].fields[0].include == []
+
+    def test_legacy_condition_set(self):
+        self.gargoyle.register(LegacyConditionSet())
+        switch = Switch.objects.create(key='selective', status=SELECTIVE)
+        self.add_condition(
+            switch, 'name', 'foo',
+            condition_set=LegacyConditionSet().get_id(),
+        )
+
+        explanation = self.gargoyle.explain('selective', User(username='foo'))
+        assert explanation.result is True
+        condition_set, = explanation.switches[0].condition_sets
+        assert condition_set.condition_set == LegacyConditionSet().get_id()
+        assert [(field.name, field.value) for field in condition_set.instances[0].fields] == [('name', 'foo')]
+
+    def test_as_dict(self):
+        switch = Switch.objects.create(key='selective', status=SELECTIVE)
+        self.add_condition(switch, 'username', 'foo')
+
+        data = self.gargoyle.explain('selective', User(username='foo')).as_dict()
+        assert json.loads(json.dumps(data)) == data
+        assert data['result'] is True
+        assert data['switches'][0]['condition_sets'][0]['instances'][0]['fields'][0]['include'] == ['foo']
@@ -0,0 +1,84 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+
+import pytest
+from django.test import SimpleTestCase
+
+from gargoyle.geoip import GeoIPDatabase, Location, get_database, write_database
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'data', 'geoip.dat')
+
+
+class GeoIPDatabaseTests(SimpleTestCase):
+
+    def setUp(self):
+        self.database = GeoIPDatabase(FIXTURE)
+
+    def tearDown(self):
+        self.database.close()
+
+    def test_len(self):
+        assert len(self.database) == 5
+
+    def test_lookup_ipv4(self):
+        assert self.database.lookup('1.0.0.0') == Location('AU', 'AU-NSW')
+        assert self.database.lookup('81.2.69.160') == Location('GB', 'GB-ENG')
+        assert self.database.lookup('198.51.100.127') == Location('US', 'US-CA')
+        assert self.database.lookup('198.51.100.128') == Location('US', None)
+
+    def test_lookup_ipv6(self):
+        assert self.database.lookup('2001:db8::1') == Location('DE', 'DE-BE')
+
+    def test_lookup_missing(self):
+        assert self.database.lookup('0.255.255.255') is None
+        assert self.database.lookup('1.0.1.0') is None
+        assert self.database.lookup('255.255.255.255') is None
+        assert self.database.lookup('::1') is None
+
+    def test_lookup_invalid(self):
+        assert self.database.lookup('not an ip') is None
+        assert self.database.lookup('1') is None
+        assert self.database.lookup(None) is None
+
+    def test_get_database_is_shared(self):
+        assert get_database(FIXTURE) is get_database(FIXTURE)
+
+
+class WriteDatabaseTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'geoip.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        write_database(self.path, [
+            ('10.0.0.0', '10.255.255.255', 'fr', 'fr-idf'),
+            ('9.0.0.0', '9.0.0.0', 'it', None),
+        ])
+        database = GeoIPDatabase(self.path)
+        assert database.lookup('9.0.0.0') == Location('IT', None)
+        assert database.lookup('10.1.2.3') == Location('FR', 'FR-IDF')
+        database.close()
+
+    def test_overlapping(self):
+        with pytest.raises(ValueError):
+            write_database(self.path, [
+                ('10.0.0.0', '10.0.0.10', 'FR', None),
+                ('10.0.0.10', '10.0.0.20', 'IT', None),
+            ])
+
+    def test_invalid_range(self):
+        with pytest.raises(ValueError):
+            write_database(self.path, [('10.0.0.10', '10.0.0.0', 'FR', None)])
+
+    def test_not_a_database(self):
+        with open(self.path, 'wb') as fp:
+            fp.write(b'not a database')
+        with pytest.raises(ValueError):
+            GeoIPDatabase(self.path)
@@ -1,9 +1,39 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from django.test import TestCase
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
 
-from gargoyle.manager import SwitchManager
-from gargoyle.models import Switch
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase
+
+from gargoyle.builtins import IPAddressConditionSet, UserConditionSet
+from gargoyle.constants import FEATURE
+from gargoyle.manager import ResultCache, SwitchManager, SwitchRefresher
+from gargoyle.models import DISABLED, GLOBAL, SELECTIVE, Switch
+from testapp.utils import RequestFactory
+
+
+@contextmanager
+def switch_threads_often():
+    if hasattr(sys, 'setswitchinterval'):
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            yield
+        finally:
+            sys.setswitchinterval(interval)
+    else:
+        # Python 2 switches threads every so many bytecode instructions
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            yield
+        finally:
+            sys.setcheckinterval(interval)
 
 
 class ConstantTest(TestCase):
@@ -24,3 +54,405 @@ class ConstantTest(TestCase):
 
     def test_exclude(self):
         assert self.gargoyle.EXCLUDE == 'e'
+
+
+class RunningRefresher(SwitchRefresher):
+    # Looks alive, without a thread refreshing the switches
+    def is_alive(self):
+        return True
+
+    def start(self):
+        pass
+
+
+class RefresherTest(TestCase):
+    def setUp(self):
+        Switch.objects.create(key='global', status=GLOBAL)
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True)
+        self.gargoyle.register(UserConditionSet(User))
+
+    def tearDown(self):
+        self.gargoyle.stop_refresher()
+
+    def change_remotely(self, key, status):
+        # As saved by another process
+        Switch.objects.filter(key=key).update(status=status)
+        cache.set(self.gargoyle.remote_cache_key, dict((s.key, s) for s in Switch.objects.all()))
+        cache.set(self.gargoyle.remote_cache_last_updated_key, time.time() + 1)
+
+    def test_refresh_loads_and_compiles(self):
+        switch = Switch.objects.create(key='users', status=SELECTIVE)
+        switch.add_condition(
+            self.gargoyle,
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='is_staff',
+            condition='1',
+        )
+        self.gargoyle.clear_cache()
+        cache.clear()
+
+        assert self.gargoyle.refresh() is True
+        switches = self.gargoyle._local_cache
+        plan = self.gargoyle.get_plan(switches['users'])
+        assert self.gargoyle._snapshot.plans[('users', FEATURE)][2] is plan
+        assert self.gargoyle.is_active('users', User(is_staff=True))
+
+    def test_refresh_without_changes(self):
+        self.gargoyle.refresh()
+        switches = self.gargoyle._local_cache
+
+        assert self.gargoyle.refresh() is False
+        assert self.gargoyle._local_cache is switches
+
+    def test_refresh_with_changes(self):
+        self.gargoyle.refresh()
+        switches = self.gargoyle._local_cache
+        self.change_remotely('global', DISABLED)
+
+        assert self.gargoyle.refresh() is True
+        assert self.gargoyle._local_cache is not switches
+        assert not self.gargoyle.is_active('global')
+
+    def test_checks_skip_freshness_checks_while_refreshing(self):
+        self.gargoyle.refresh()
+        self.gargoyle._refresher = RunningRefresher(self.gargoyle, 60)
+        self.change_remotely('global', DISABLED)
+        self.gargoyle._last_checked_for_remote_changes = 0.0
+
+        assert self.gargoyle.is_active('global')
+
+        self.gargoyle._refresher = None
+        assert not self.gargoyle.is_active('global')
+
+    def test_checks_for_changes_if_refresher_died(self):
+        self.gargoyle.refresh()
+        self.gargoyle._refresher = SwitchRefresher(self.gargoyle, 60)
+        self.change_remotely('global', DISABLED)
+        self.gargoyle._last_checked_for_remote_changes = 0.0
+
+        assert not self.gargoyle.is_active('global')
+
+    def test_refresh_keeps_newer_reload(self):
+        self.gargoyle.refresh()
+        older = dict(self.gargoyle._local_cache)
+        local_cache_is_invalid = self.gargoyle.local_cache_is_invalid
+
+        def save_while_refreshing():
+            # Saved in this process while the refresher reads the older switches
+            Switch.objects.filter(key='global').update(status=DISABLED)
+            self.gargoyle._populate(reset=True)
+            cache.set(self.gargoyle.remote_cache_key, older)
+            cache.set(self.gargoyle.remote_cache_last_updated_key, time.time() + 1)
+            return local_cache_is_invalid()
+
+        self.gargoyle.local_cache_is_invalid = save_while_refreshing
+        assert self.gargoyle.refresh() is False
+        assert self.gargoyle._local_cache['global'].status == DISABLED
+
+    def test_restarts_after_fork(self):
+        self.gargoyle.refresh()
+        self.gargoyle.refresher_class = RunningRefresher
+        refresher = self.gargoyle._refresher = RunningRefresher(self.gargoyle, 30)
+        # As inherited from the parent process
+        refresher.pid = os.getpid() + 1
+        assert not refresher.is_running()
+
+        assert self.gargoyle.is_active('global')
+        restarted = self.gargoyle._refresher
+        assert restarted is not refresher
+        assert restarted.is_running()
+        assert restarted.interval == 30
+
+    def test_saves_reload_while_refreshing(self):
+        self.gargoyle.refresh()
+        self.gargoyle._refresher = RunningRefresher(self.gargoyle, 60)
+
+        switch = self.gargoyle['global']
+        switch.status = DISABLED
+        switch.save()
+        self.gargoyle._refresher = None
+        assert not self.gargoyle.is_active('global')
+
+
+class RefresherThreadTest(TransactionTestCase):
+    def setUp(self):
+        Switch.objects.create(key='global', status=GLOBAL)
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True)
+
+    def tearDown(self):
+        self.gargoyle.stop_refresher()
+
+    def test_start_stop(self):
+        refresher = self.gargoyle.start_refresher(interval=0.01)
+        assert refresher.daemon
+        assert refresher.is_running()
+        for _ in range(100):
+            if self.gargoyle._local_last_updated is not None:
+                break
+            time.sleep(0.01)
+        assert self.gargoyle.is_active('global')
+
+        Switch.objects.filter(key='global').update(status=DISABLED)
+        cache.set(self.gargoyle.remote_cache_key, {'global': Switch.objects.get(key='global')})
+        cache.set(self.gargoyle.remote_cache_last_updated_key, time.time() + 1)
+        for _ in range(100):
+            if not self.gargoyle.is_active('global'):
+                break
+            time.sleep(0.01)
+        assert not self.gargoyle.is_active('global')
+
+        self.gargoyle.stop_refresher()
+        refresher.join(1)
+        assert not refresher.is_running()
+        assert self.gargoyle._refresher is None
+
+    def test_restart_replaces_thread(self):
+        first = self.gargoyle.start_refresher(interval=10)
+        second = self.gargoyle.start_refresher(interval=10)
+        first.join(1)
+        assert not first.is_alive()
+        assert self.gargoyle._refresher is second
+
+
+class SnapshotTest(TestCase):
+    child = ':'.join(['parent'] * 8)
+
+    def setUp(self):
+        Switch.objects.create(key='global', status=GLOBAL)
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, timeout=3600)
+        self.gargoyle.register(UserConditionSet(User))
+
+    def make_switches(self, parent, child):
+        staff = Switch(key='staff', status=SELECTIVE)
+        staff.add_condition(
+            self.gargoyle,
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='is_staff',
+            condition='1',
+            commit=False,
+        )
+        # Between them, the switches in the middle are global
+        chain = [Switch(key=':'.join(['parent'] * depth), status=GLOBAL) for depth in range(2, 8)]
+        return dict((switch.key, switch) for switch in chain + [
+            Switch(key='global', status=GLOBAL),
+            Switch(key='parent', status=parent),
+            Switch(key=self.child, status=child),
+            staff,
+        ])
+
+    def test_reload_publishes_new_snapshot(self):
+        snapshot = self.gargoyle.get_snapshot()
+        switches = snapshot.switches
+
+        Switch.objects.create(key='other', status=GLOBAL)
+        assert self.gargoyle._snapshot is not snapshot
+        assert snapshot.switches is switches
+        assert 'other' not in snapshot
+        assert 'other' in self.gargoyle.get_snapshot()
+
+    def test_register_publishes_new_snapshot(self):
+        snapshot = self.gargoyle.get_snapshot()
+        registry = snapshot.registry
+
+        self.gargoyle.register(IPAddressConditionSet())
+        assert self.gargoyle._snapshot is not snapshot
+        assert snapshot.registry is registry
+        assert self.gargoyle._snapshot.switches is snapshot.switches
+        assert 'gargoyle.builtins.IPAddressConditionSet' not in registry
+
+    def test_clear_cache_keeps_switches_until_reloaded(self):
+        snapshot = self.gargoyle.get_snapshot()
+
+        self.gargoyle.clear_cache()
+        assert self.gargoyle._snapshot is snapshot
+        assert self.gargoyle.is_active('global')
+        assert self.gargoyle._snapshot is not snapshot
+
+    def test_is_active_in_snapshot(self):
+        snapshot = self.gargoyle.get_snapshot()
+        self.gargoyle._local_cache = self.make_switches(parent=DISABLED, child=GLOBAL)
+
+        # Earlier snapshots are still checked as they were
+        assert self.gargoyle.is_active_in(snapshot, 'global')
+        assert not self.gargoyle.is_active_in(snapshot, 'staff', User(is_staff=True))
+        assert not self.gargoyle.is_active_in(self.gargoyle._snapshot, self.child)
+        assert self.gargoyle.is_active_in(self.gargoyle._snapshot, 'staff', User(is_staff=True))
+
+    def test_concurrent_reloads(self):
+        # Every version of the switches agrees on each result, so a check
+        # mixing two versions, or seeing none, gives a wrong result
+        versions = [
+            self.make_switches(parent=GLOBAL, child=DISABLED),
+            self.make_switches(parent=DISABLED, child=GLOBAL),
+        ]
+        staff, user = User(is_staff=True), User(is_staff=False)
+        self.gargoyle._local_cache = versions[0]
+        self.gargoyle._local_last_updated = time.time()
+
+        errors = []
+        checked = []
+        stopped = threading.Event()
+
+        def check():
+            gargoyle = self.gargoyle
+            while not stopped.is_set():
+                results = (
+                    gargoyle.is_active('global'),
+                    gargoyle.is_active(self.child),
+                    gargoyle.is_active('staff', staff),
+                    gargoyle.is_active('staff', user),
+                )
+                checked.append(results)
+                if results != (True, False, True, False):
+                    errors.append(results)
+
+        threads = [threading.Thread(target=check) for _ in range(4)]
+        with switch_threads_often():
+            for thread in threads:
+                thread.start()
+            try:
+                deadline = time.time() + 0.5
+                index = 0
+                while time.time() < deadline:
+                    index += 1
+                    self.gargoyle._local_cache = versions[index % 2]
+                    if index % 10 == 0:
+                        self.gargoyle.register(IPAddressConditionSet())
+                        self.gargoyle.unregister(IPAddressConditionSet())
+                    if index % 50 == 0:
+                        self.gargoyle._clear_plans()
+                        versions[index % 2] = self.make_switches(
+                            parent=versions[index % 2]['parent'].status,
+                            child=versions[index % 2][self.child].status,
+                        )
+            finally:
+                stopped.set()
+                for thread in threads:
+                    thread.join()
+
+        assert checked
+        assert errors == []
+
+
+class DeferReloadsTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True)
+        for index in range(3):
+            Switch.objects.create(key='switch%d' % index, status=GLOBAL)
+
+    def test_reloads_once(self):
+        assert self.gargoyle.is_active('switch0')
+        reloads = self.gargoyle.metrics.reloads
+
+        with self.gargoyle.defer_reloads():
+            Switch.objects.filter(key__startswith='switch').delete()
+            assert self.gargoyle.metrics.reloads == reloads
+            assert 'switch0' in self.gargoyle._local_cache
+        assert self.gargoyle.metrics.reloads == reloads + 1
+        assert 'switch0' not in self.gargoyle._local_cache
+
+        # Saves after the block reload immediately again
+        Switch.objects.create(key='switch0', status=GLOBAL)
+        assert self.gargoyle.metrics.reloads == reloads + 2
+        assert 'switch0' in self.gargoyle._local_cache
+
+    def test_nested(self):
+        self.gargoyle.is_active('switch0')
+        reloads = self.gargoyle.metrics.reloads
+
+        with self.gargoyle.defer_reloads():
+            with self.gargoyle.defer_reloads():
+                Switch.objects.filter(key='switch0').delete()
+            Switch.objects.filter(key='switch1').delete()
+        assert self.gargoyle.metrics.reloads == reloads + 1
+
+
+class CountingUserConditionSet(UserConditionSet):
+    is_pure = True
+
+    def __init__(self, model):
+        super(CountingUserConditionSet, self).__init__(model)
+        self.evaluated = []
+
+    def is_active_compiled(self, instance, compiled):
+        self.evaluated.append(instance)
+        return super(CountingUserConditionSet, self).is_active_compiled(instance, compiled)
+
+
+class ImpureUserConditionSet(UserConditionSet):
+    pass
+
+
+class ResultCacheTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True)
+        self.condition_set = CountingUserConditionSet(User)
+        self.gargoyle.register(self.condition_set)
+        self.gargoyle.register(IPAddressConditionSet())
+        self.condition_set_id = self.condition_set.get_id()
+
+        switch = Switch.objects.create(key='staff', status=SELECTIVE)
+        switch.add_condition(self.gargoyle, self.condition_set_id, 'is_staff', '1')
+        switch.add_condition(self.gargoyle, self.condition_set_id, 'email_suffix', '@example.com')
+
+    def test_pure_condition_sets_declared(self):
+        assert UserConditionSet.is_pure
+        assert IPAddressConditionSet.is_pure
+        assert not ImpureUserConditionSet.is_pure
+
+    def test_cached_by_field_values(self):
+        staff = User(pk=1, is_staff=True, email='staff@example.com')
+        assert self.gargoyle.is_active('staff', staff)
+        # Only the fields with conditions are compared
+        assert self.gargoyle.is_active('staff', User(pk=2, is_staff=True, email='staff@example.com'))
+        assert len(self.condition_set.evaluated) == 1
+
+        assert self.gargoyle.is_active('staff', User(pk=3, is_staff=False, email='other@example.com'))
+        assert not self.gargoyle.is_active('staff', User(pk=4, is_staff=False, email='other@gmail.com'))
+        assert len(self.condition_set.evaluated) == 3
+
+        plan = self.gargoyle.get_plan(self.gargoyle['staff'])
+        assert len(plan.results) == 3
+
+    def test_anonymous(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        assert not self.gargoyle.is_active('staff', request)
+        assert not self.gargoyle.is_active('staff', request)
+        assert len(self.condition_set.evaluated) == 1
+
+    def test_new_snapshot(self):
+        self.gargoyle.is_active('staff', User(is_staff=True))
+        self.gargoyle.clear_cache()
+        self.gargoyle.is_active('staff', User(is_staff=True))
+        assert len(self.condition_set.evaluated) == 2
+
+    def test_impure_condition_sets_not_cached(self):
+        self.gargoyle.register(ImpureUserConditionSet(User))
+        plan = self.gargoyle.get_plan(self.gargoyle['staff'])
+        assert plan.results is None
+
+        self.gargoyle.is_active('staff', User(is_staff=True))
+        self.gargoyle.is_active('staff', User(is_staff=True))
+        assert len(self.condition_set.evaluated) == 2
+
+    def test_disabled(self):
+        self.gargoyle.result_cache_size = 0
+        plan = self.gargoyle.get_plan(self.gargoyle['staff'])
+        assert plan.results is None
+
+    def test_least_recently_used_evicted(self):
+        cache = ResultCache(2)
+        cache.set('a', True)
+        cache.set('b', False)
+        assert cache.get('a') is True
+        cache.set('c', True)
+        assert cache.get('b') is None
+        assert cache.get('a') is True
+        assert cache.get('c') is True
+
+    def test_unhashable_fingerprints(self):
+        cache = ResultCache(2)
+        cache.set(([],), True)
+        assert cache.get(([],)) is None
+        assert len(cache) == 0
@@ -0,0 +1,158 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import sys
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import six
+
+from gargoyle import gargoyle as global_gargoyle
+from gargoyle.builtins import IPAddressConditionSet, UserConditionSet
+from gargoyle.compat import tracemalloc
+from gargoyle.constants import INCLUDE
+from gargoyle.manager import SwitchManager
+from gargoyle.memory import format_size, get_size
+from gargoyle.models import GLOBAL, SELECTIVE, Switch
+
+
+class GetSizeTests(TestCase):
+
+    def test_containers(self):
+        value = ['a' * 100, 'b' * 100]
+        assert get_size(value) == sys.getsizeof(value) + sys.getsizeof(value[0]) + sys.getsizeof(value[1])
+
+    def test_seen(self):
+        shared = 'x' * 1000
+        seen = set()
+        assert get_size([shared], seen) > 1000
+        assert get_size([shared], seen) < 1000
+
+    def test_closure(self):
+        conditions = set('user%d' % (index,) for index in range(100))
+
+        def matcher(value):
+            return value in conditions
+
+        assert get_size(matcher) > get_size(conditions)
+
+    def test_shared_objects(self):
+        condition_set = UserConditionSet(User)
+        assert get_size([condition_set]) == sys.getsizeof([condition_set])
+
+    def test_format_size(self):
+        assert format_size(10) == '10 B'
+        assert format_size(2048) == '2.0 KiB'
+        assert format_size(3 * 1024 * 1024) == '3.0 MiB'
+        assert format_size(5 * 1024 ** 3) == '5.0 GiB'
+
+
+class MemoryReportTests(TestCase):
+
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True)
+        self.gargoyle.register(UserConditionSet(User))
+        self.gargoyle.register(IPAddressConditionSet())
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_report(self):
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='small', status=SELECTIVE, value={
+            'auth.user': {'username': [[INCLUDE, 'foo']]},
+        })
+        Switch.objects.create(key='large', status=SELECTIVE, value={
+            'auth.user': {
+                'username': [[INCLUDE, 'user%d' % (index,)] for index in range(500)],
+                'is_staff': [[INCLUDE, '1']],
+            },
+            'ip': {'ip_address': [[INCLUDE, '10.0.0.1']]},
+        })
+
+        report = self.gargoyle.memory_report(trace=False)
+        assert report.allocated is None
+        assert [footprint.key for footprint in report.switches] == ['large', 'small', 'global']
+        assert report.largest(1) == report.switches[:1]
+        assert report.size >= sum(footprint.size for footprint in report.switches)
+
+        large = report.switches[0]
+        assert large.conditions == 502
+        assert large.largest_field == ('auth.user', 'username', 500)
+        assert sorted(large.condition_sets) == ['auth.user', 'ip']
+        user = large.condition_sets['auth.user']
+        assert user.conditions == 501
+        assert user.value_size > 500 * sys.getsizeof('user0')
+        assert user.compiled_size > 0
+        assert large.plan_size >= user.compiled_size + large.condition_sets['ip'].compiled_size
+        assert large.switch_size > user.value_size
+
+        glob = report.switches[2]
+        assert (glob.conditions, glob.plan_size, glob.condition_sets, glob.largest_field) == (0, 0, {}, None)
+
+        namespaces = [footprint.namespace for footprint in report.condition_sets]
+        assert namespaces == ['auth.user', 'ip']
+        assert (report.condition_sets[0].switches, report.condition_sets[0].conditions) == (2, 502)
+
+        data = json.loads(json.dumps(report.as_dict()))
+        assert data['switches'][0]['key'] == 'large'
+        assert data['switches'][0]['condition_sets']['ip']['conditions'] == 1
+
+    def test_report_compiles_plans(self):
+        switch = Switch.objects.create(key='small', status=SELECTIVE, value={
+            'auth.user': {'username': [[INCLUDE, 'foo']]},
+        })
+        snapshot = self.gargoyle.get_snapshot()
+        assert not snapshot.plans
+
+        self.gargoyle.memory_report(trace=False)
+        assert ('small', 'f') in snapshot.plans
+        assert snapshot.plans[('small', 'f')][0] is snapshot['small'].value
+        assert switch.key in snapshot
+
+    @pytest.mark.skipif(tracemalloc is None, reason='tracemalloc is not available')
+    def test_tracemalloc(self):
+        Switch.objects.create(key='large', status=SELECTIVE, value={
+            'auth.user': {'username': [[INCLUDE, 'user%d' % (index,)] for index in range(500)]},
+        })
+
+        report = self.gargoyle.memory_report()
+        assert report.allocated['switches'] > 500 * sys.getsizeof('user0')
+        assert report.allocated['plans'] > 0
+        assert not tracemalloc.is_tracing()
+
+
+class CommandGargoyleMemoryTestCase(TestCase):
+
+    def setUp(self):
+        Switch.objects.create(key='large', status=SELECTIVE, value={
+            'auth.user': {'username': [[INCLUDE, 'user%d' % (index,)] for index in range(50)]},
+        })
+        Switch.objects.create(key='global', status=GLOBAL)
+
+    def tearDown(self):
+        cache.clear()
+        global_gargoyle.clear_cache()
+
+    def test_table(self):
+        out = six.StringIO()
+        call_command('gargoyle_memory', '--no-tracemalloc', '--limit', '1', stdout=out)
+        lines = out.getvalue().splitlines()
+        assert lines[0].startswith('2 switches take ')
+        assert lines[2].split() == ['Switch', 'Conditions', 'Switch', 'size', 'Plan', 'size', 'Total', '%', 'Largest',
+                                    'field']
+        assert lines[3].startswith('large ')
+        assert lines[3].endswith('auth.user.username (50)')
+        assert 'global' not in out.getvalue()
+        assert lines[5].startswith('Condition set')
+        assert lines[6].startswith('auth.user ')
+
+    def test_json(self):
+        out = six.StringIO()
+        call_command('gargoyle_memory', '--json', '--no-tracemalloc', stdout=out)
+        data = json.loads(out.getvalue())
+        assert [switch['key'] for switch in data['switches']] == ['large', 'global']
+        assert data['condition_sets'][0]['namespace'] == 'auth.user'
@@ -0,0 +1,112 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import TestCase
+
+from gargoyle import gargoyle
+from gargoyle.decorators import switch_is_active
+from gargoyle.middleware import SwitchMemoMiddleware
+from gargoyle.models import DISABLED, GLOBAL, INHERIT, SELECTIVE, Switch
+from gargoyle.testutils import switches
+from testapp.utils import RequestFactory
+
+
+class SwitchMemoTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='foo', email='foo@example.com')
+        switch = Switch.objects.create(key='staff', status=SELECTIVE)
+        switch.add_condition(
+            gargoyle,
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='foo',
+        )
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='global:child', status=INHERIT)
+        self.request = RequestFactory().get('/', user=self.user)
+
+        self.checked = []
+        is_active_in = gargoyle.is_active_in
+
+        def counting_is_active_in(switches, key, *instances, **kwargs):
+            self.checked.append(key)
+            return is_active_in(switches, key, *instances, **kwargs)
+        gargoyle.is_active_in = counting_is_active_in
+
+    def tearDown(self):
+        del gargoyle.is_active_in
+        gargoyle.stop_memo()
+
+    def test_memoized(self):
+        with gargoyle.memoize():
+            assert gargoyle.is_active('staff', self.request)
+            assert gargoyle.is_active('staff', self.request)
+            assert not gargoyle.is_active('staff', self.request, switch_type='x')
+        assert self.checked == ['staff', 'staff']
+
+    def test_not_memoized_outside_block(self):
+        with gargoyle.memoize():
+            gargoyle.is_active('staff', self.request)
+        gargoyle.is_active('staff', self.request)
+        assert self.checked == ['staff', 'staff']
+
+    def test_nested(self):
+        with gargoyle.memoize():
+            gargoyle.is_active('staff', self.request)
+            with gargoyle.memoize():
+                gargoyle.is_active('staff', self.request)
+            gargoyle.is_active('staff', self.request)
+        assert self.checked == ['staff']
+
+    def test_keyed_on_instances(self):
+        other = RequestFactory().get('/', user=User(username='bar'))
+        with gargoyle.memoize():
+            assert gargoyle.is_active('staff', self.request)
+            assert not gargoyle.is_active('staff', other)
+            assert not gargoyle.is_active('staff')
+            assert not gargoyle.is_active('staff', default=None)
+
+            # request.user is replaced on login and logout
+            self.request.user = other.user
+            assert not gargoyle.is_active('staff', self.request)
+        assert self.checked == ['staff'] * 5
+
+    def test_new_snapshot(self):
+        with gargoyle.memoize():
+            assert gargoyle.is_active('global')
+
+            switch = gargoyle['global']
+            switch.status = DISABLED
+            switch.save()
+            assert not gargoyle.is_active('global')
+
+    def test_switches_override(self):
+        with gargoyle.memoize():
+            assert gargoyle.is_active('global:child')
+            with switches(gargoyle, **{'global': False}):
+                assert not gargoyle.is_active('global:child')
+            assert gargoyle.is_active('global:child')
+
+    def test_shared_with_decorator_and_template_tag(self):
+        @switch_is_active('staff', gargoyle=gargoyle)
+        def view(request):
+            template = Template("""
+                {% load gargoyle_tags %}
+                {% ifswitch staff %}hello{% endifswitch %}
+                {% ifswitch staff %}world{% endifswitch %}
+            """)
+            return HttpResponse(template.render(Context({'request': request})))
+
+        middleware = SwitchMemoMiddleware()
+        assert middleware.process_request(self.request) is None
+        response = middleware.process_response(self.request, view(self.request))
+
+        assert b'hello' in response.content
+        assert b'world' in response.content
+        assert self.checked == ['staff']
+
+        gargoyle.is_active('staff', self.request)
+        assert self.checked == ['staff', 'staff']
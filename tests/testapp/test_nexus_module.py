@@ -7,6 +7,7 @@ from django.test import TestCase
 
 from gargoyle import gargoyle
 from gargoyle.models import DISABLED, GLOBAL, Switch
+from gargoyle.testutils import budget
 
 
 class NexusModuleTestCase(TestCase):
@@ -22,6 +23,14 @@ class NexusModuleTestCase(TestCase):
         assert resp.status_code == 200
         assert "Gargoyle" in resp.content.decode('utf-8')
 
+    def test_index_budget(self):
+        Switch.objects.create(key='key1')
+        self.client.get('/nexus/gargoyle/')
+        # The session, the user and the switches
+        with budget(queries=3, cache_reads=0, cache_writes=0):
+            resp = self.client.get('/nexus/gargoyle/')
+        assert resp.status_code == 200
+
     def test_add(self):
         resp = self.client.post('/nexus/gargoyle/add/', {'key': 'key1'})
         assert resp.status_code == 200
@@ -0,0 +1,264 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import six
+
+from gargoyle import gargoyle as global_gargoyle
+from gargoyle.builtins import HTTPConditionSet, IPAddressConditionSet, UserConditionSet
+from gargoyle.conditions import Boolean, KeyValue, OnOrAfterDate, Percent, Prefix, Regex, String, Suffix
+from gargoyle.constants import EXCLUDE, INCLUDE
+from gargoyle.manager import SwitchManager
+from gargoyle.models import GLOBAL, INHERIT, SELECTIVE, Switch
+from gargoyle.replay import (
+    OMIT, CaptureSink, dump_switches, hash_value, load_capture, load_switches, reduce_value, replay,
+)
+from testapp.utils import RequestFactory
+
+USER_ID = 'gargoyle.builtins.UserConditionSet(auth.user)'
+
+
+class ReduceValueTests(TestCase):
+
+    def test_numbers(self):
+        assert reduce_value(Percent(), 12345, []) == 45
+        assert reduce_value(Percent(), 'x', []) is None
+        assert reduce_value(Boolean(), 'yes', []) is True
+        assert reduce_value(OnOrAfterDate(), datetime.datetime(2018, 8, 5, 12), []) == '2018-08-05'
+        assert reduce_value(String(), None, []) is None
+
+    def test_strings(self):
+        assert reduce_value(String(), 'foo', []) == hash_value('foo')
+        assert reduce_value(String(), 'foo', [], anonymize=False) == 'foo'
+        assert reduce_value(String(), 5, []) == 5
+        assert reduce_value(Prefix(), 'foobar', ['fo', 'abc']) == 'foo'
+        assert reduce_value(Suffix(), 'foo@example.com', ['.com']) == '.com'
+        assert reduce_value(Suffix(), 'foo@example.com', []) == ''
+        assert reduce_value(Suffix(), 'abc', ['abc', 'zzzzz']) == 'abc'
+        assert reduce_value(Prefix(), 'foobar', ['fo'], anonymize=False) == 'foobar'
+        assert reduce_value(Regex(), 'foobar', ['^foo']) is OMIT
+        assert reduce_value(Regex(), 'foobar', ['^foo'], anonymize=False) == 'foobar'
+
+    def test_key_value(self):
+        mapping = {'beta': '1', 'session': 'secret'}
+        assert reduce_value(KeyValue(), mapping, ['beta=1', 'missing']) == {'beta': hash_value('1')}
+        assert reduce_value(KeyValue(), mapping, ['beta'], anonymize=False) == {'beta': '1'}
+
+
+class ReplayTests(TestCase):
+
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True)
+        self.gargoyle.register(UserConditionSet(User))
+        self.gargoyle.register(IPAddressConditionSet())
+        self.gargoyle.register(HTTPConditionSet())
+        self.stream = six.StringIO()
+
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='users', status=SELECTIVE, value={
+            'auth.user': {
+                'username': [[INCLUDE, 'foo']],
+                'percent': [[INCLUDE, '0-10']],
+                'email_suffix': [[INCLUDE, '@example.com']],
+            },
+        })
+        Switch.objects.create(key='users:child', status=INHERIT)
+        Switch.objects.create(key='requests', status=SELECTIVE, value={
+            'ip': {'ip_address': [[INCLUDE, '10.0.0.1']]},
+            'http': {'cookie': [[INCLUDE, 'beta=1']]},
+        })
+        Switch.objects.create(key='excluded', status=SELECTIVE, value={
+            'auth.user': {'is_staff': [[EXCLUDE, '1']]},
+        })
+
+        self.requests = [
+            RequestFactory().get('/', user=User(id=5, username='foo', email='foo@example.org'),
+                                 REMOTE_ADDR='10.0.0.1'),
+            RequestFactory().get('/', user=User(id=250, username='bar', email='bar@example.org'),
+                                 REMOTE_ADDR='10.0.0.2'),
+            RequestFactory().get('/', user=User(id=13, username='baz', email='baz@example.com', is_staff=True),
+                                 REMOTE_ADDR='10.0.0.3', HTTP_COOKIE='beta=1'),
+        ]
+
+    def tearDown(self):
+        cache.clear()
+
+    def capture(self, anonymize=True):
+        self.gargoyle.add_evaluation_hook(CaptureSink(self.stream, manager=self.gargoyle, anonymize=anonymize))
+        results = []
+        for key in ('global', 'users', 'users:child', 'requests', 'excluded', 'missing'):
+            for request in self.requests:
+                results.append(self.gargoyle.is_active(key, request))
+        self.gargoyle.remove_evaluation_hook(self.gargoyle._evaluation_hooks[0][0])
+        self.stream.seek(0)
+        return results, load_capture(self.stream)
+
+    def test_capture(self):
+        results, records = self.capture()
+        assert [record['result'] for record in records] == results
+        record = records[3]
+        assert (record['key'], record['result'], record['switch_type']) == ('users', True, 'f')
+        assert record['anonymized'] is True
+        request, user = record['instances']
+        assert (request['type'], request['condition_sets']) == ('WSGIRequest', {})
+        assert user['type'] == 'User'
+        assert user['condition_sets'] == {
+            USER_ID: {'username': hash_value('foo'), 'percent': 5, 'email_suffix': '@example.org'},
+        }
+
+        fields = records[5]['instances'][1]['condition_sets'][USER_ID]
+        assert fields == {'username': hash_value('baz'), 'percent': 13, 'email_suffix': '@example.com'}
+
+        record = records[11]
+        assert record['key'] == 'requests'
+        request = record['instances'][0]['condition_sets']
+        assert request['gargoyle.builtins.IPAddressConditionSet'] == {'ip_address': hash_value('10.0.0.3')}
+        assert request['gargoyle.builtins.HTTPConditionSet'] == {'cookie': {'beta': hash_value('1')}}
+
+        # Nothing identifying is written
+        serialized = json.dumps(records)
+        for value in ('foo', 'bar', 'baz', '10.0.0', '250'):
+            assert value not in serialized
+
+    def test_capture_raw(self):
+        _, records = self.capture(anonymize=False)
+        assert records[3]['instances'][1]['condition_sets'] == {
+            USER_ID: {'username': 'foo', 'percent': 5, 'email_suffix': 'foo@example.org'},
+        }
+
+    def test_replay_matches(self):
+        for anonymize in (True, False):
+            results, records = self.capture(anonymize=anonymize)
+            report = replay(self.gargoyle, records, self.gargoyle.get_snapshot().switches, repeat=3)
+            assert report.errors == []
+            assert report.differences == []
+            assert report.calls == 3 * len(results)
+            assert len(report.latencies) == report.calls
+            assert report.keys == {
+                'global': 3, 'users': 3, 'users:child': 3, 'requests': 3, 'excluded': 3, 'missing': 3,
+            }
+            assert 0 < report.percentile(50) <= report.percentile(99) <= report.percentile(100)
+            assert report.throughput > 0
+            self.stream = six.StringIO()
+
+    def test_replay_edited(self):
+        _, records = self.capture()
+        switches = dict(self.gargoyle.get_snapshot().switches)
+        edited = switches['users'] = Switch(key='users', status=SELECTIVE, value={
+            'auth.user': {'username': [[INCLUDE, 'bar']]},
+        })
+        switches['users:child'] = Switch(key='users:child', status=SELECTIVE, value={
+            'auth.user': {'percent': [[INCLUDE, '0-9']]},
+        })
+
+        report = replay(self.gargoyle, records, switches)
+        assert [(d.key, d.captured, d.result) for d in report.differences] == [
+            ('users', True, False),
+            ('users', False, True),
+            ('users', True, False),
+            ('users:child', True, False),
+            ('users:child', True, False),
+        ]
+        assert [d.line for d in report.differences] == [4, 5, 6, 7, 9]
+        assert list(report.get_differences_by_key()) == ['users', 'users:child']
+        assert edited.value['auth.user']['username'] == [[INCLUDE, 'bar']]
+
+        data = json.loads(json.dumps(report.as_dict()))
+        assert data['differences'][0] == {'line': 4, 'key': 'users', 'captured': True, 'result': False}
+
+    def test_replay_no_calls(self):
+        report = replay(self.gargoyle, [], {})
+        assert (report.calls, report.throughput, report.percentile(50)) == (0, None, None)
+
+    def test_load_switches(self):
+        stream = six.StringIO()
+        dump_switches(stream)
+        data = json.loads(stream.getvalue())
+        assert [switch['key'] for switch in data] == ['excluded', 'global', 'requests', 'users', 'users:child']
+        assert sorted(data[0]) == ['key', 'status', 'value']
+
+        stream.seek(0)
+        switches = load_switches(stream)
+        assert sorted(switches) == ['excluded', 'global', 'requests', 'users', 'users:child']
+        assert switches['users'].status == SELECTIVE
+        assert switches['users'].value['auth.user']['username'] == [['i', 'foo']]
+
+    def test_load_switches_invalid(self):
+        for data in ('{}', '[1]', '[{"status": 3}]', '[{"key": "a", "status": 9}]',
+                     '[{"key": "a", "status": 2, "value": []}]', 'not json'):
+            with pytest.raises(ValueError):
+                load_switches(six.StringIO(data))
+
+
+class CommandGargoyleReplayTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.capture_path = os.path.join(self.tmpdir, 'capture.jsonl')
+        self.snapshot_path = os.path.join(self.tmpdir, 'switches.json')
+
+        Switch.objects.create(key='users', status=SELECTIVE, value={
+            'auth.user': {'username': [[INCLUDE, 'foo']]},
+        })
+        with io.open(self.capture_path, 'w', encoding='utf-8') as stream:
+            sink = CaptureSink(stream)
+            global_gargoyle.add_evaluation_hook(sink)
+            try:
+                for username in ('foo', 'bar', 'foo'):
+                    global_gargoyle.is_active('users', User(id=1, username=username))
+            finally:
+                global_gargoyle.remove_evaluation_hook(sink)
+
+        Switch.objects.filter(key='users').update(value={'auth.user': {'username': [[INCLUDE, 'bar']]}})
+        out = six.StringIO()
+        call_command('gargoyle_snapshot', stdout=out)
+        with io.open(self.snapshot_path, 'w', encoding='utf-8') as stream:
+            stream.write(six.text_type(out.getvalue()))
+        Switch.objects.filter(key='users').update(value={'auth.user': {'username': [[INCLUDE, 'foo']]}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        cache.clear()
+        global_gargoyle.clear_cache()
+
+    def test_current_switches(self):
+        out = six.StringIO()
+        call_command('gargoyle_replay', self.capture_path, '--repeat', '2', stdout=out)
+        lines = out.getvalue().splitlines()
+        assert lines[0].startswith('Replayed 6 calls to 1 switches in ')
+        assert lines[1].startswith('Latency (ms): p50 ')
+        assert lines[2] == 'No results differ.'
+
+    def test_snapshot(self):
+        out = six.StringIO()
+        call_command('gargoyle_replay', self.capture_path, '--snapshot', self.snapshot_path, stdout=out)
+        lines = out.getvalue().splitlines()
+        assert lines[2] == '3 results differ:'
+        assert lines[3].split() == ['Switch', 'Calls', 'Differ', 'True', 'to', 'False', 'False', 'to', 'True', 'Lines']
+        assert lines[4].split() == ['users', '3', '3', '2', '1', '1,', '2,', '3']
+
+    def test_json(self):
+        out = six.StringIO()
+        call_command('gargoyle_replay', self.capture_path, '--snapshot', self.snapshot_path, '--json', stdout=out)
+        data = json.loads(out.getvalue())
+        assert data['calls'] == 3
+        assert [difference['line'] for difference in data['differences']] == [1, 2, 3]
+
+    def test_missing_files(self):
+        with pytest.raises(CommandError):
+            call_command('gargoyle_replay', os.path.join(self.tmpdir, 'missing.jsonl'))
+        with pytest.raises(CommandError):
+            call_command('gargoyle_replay', self.capture_path, '--snapshot', os.path.join(self.tmpdir, 'missing'))
+        with pytest.raises(CommandError):
+            call_command('gargoyle_replay', self.capture_path, '--repeat', '0')
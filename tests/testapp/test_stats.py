@@ -0,0 +1,221 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from six import StringIO
+
+from gargoyle import gargoyle as global_gargoyle
+from gargoyle.builtins import UserConditionSet
+from gargoyle.manager import SwitchManager
+from gargoyle.models import DISABLED, GLOBAL, INHERIT, SELECTIVE, Switch
+from gargoyle.stats import LATENCY_BUCKETS, KeyStats, ManagerMetrics, SwitchStats
+
+
+class SwitchStatsTests(TestCase):
+
+    def test_record(self):
+        stats = SwitchStats()
+        stats.record('a', True, 0.0000015)
+        stats.record('a', False, 0.003, defaulted=True, missing=True)
+        stats.record('a', False, 10)
+        stats.record('b', True, 0)
+
+        collected = stats.collect()
+        assert sorted(collected) == ['a', 'b']
+        key_stats = collected['a']
+        assert (key_stats.calls, key_stats.true, key_stats.false) == (3, 1, 2)
+        assert (key_stats.defaults, key_stats.missing) == (1, 1)
+        assert abs(key_stats.total_time - 10.0030015) < 1e-9
+        assert len(key_stats.buckets) == len(LATENCY_BUCKETS) + 1
+        assert key_stats.buckets[1] == 1  # up to 2us
+        assert key_stats.buckets[12] == 1  # up to 4.096ms
+        assert key_stats.buckets[-1] == 1
+        assert collected['b'].buckets[0] == 1
+
+    def test_merged_from_threads(self):
+        stats = SwitchStats()
+
+        def check():
+            for _ in range(100):
+                stats.record('a', True, 0.001)
+
+        threads = [threading.Thread(target=check) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats.record('a', False, 0.001)
+
+        assert len(stats._accumulators) == 5
+        key_stats = stats.collect()['a']
+        assert (key_stats.calls, key_stats.true, key_stats.false) == (401, 400, 1)
+
+        # The ended threads' counters are kept, without their accumulators
+        assert len(stats._accumulators) == 1
+        stats.record('a', False, 0.001)
+        key_stats = stats.collect()['a']
+        assert (key_stats.calls, key_stats.true, key_stats.false) == (402, 400, 2)
+
+    def test_reset(self):
+        stats = SwitchStats()
+        stats.record('a', True, 0.001)
+        thread = threading.Thread(target=stats.record, args=('b', True, 0.001))
+        thread.start()
+        thread.join()
+        stats.collect()
+        stats.reset()
+        assert stats.collect() == {}
+
+    def test_percentile(self):
+        key_stats = KeyStats('a')
+        assert key_stats.percentile(50) is None
+        assert key_stats.mean is None
+
+        key_stats.buckets[0] = 98
+        key_stats.buckets[10] = 1
+        key_stats.buckets[-1] = 1
+        assert key_stats.percentile(50) == LATENCY_BUCKETS[0]
+        assert key_stats.percentile(99) == LATENCY_BUCKETS[10]
+        assert key_stats.percentile(100) == float('inf')
+
+
+class ManagerMetricsTests(TestCase):
+
+    def test_empty(self):
+        metrics = ManagerMetrics()
+        assert metrics.reloads == 0
+        assert metrics.reload_time == 0.0
+
+    def test_summed_from_threads(self):
+        metrics = ManagerMetrics()
+
+        def compile_plans():
+            for _ in range(100):
+                metrics.add(compiles=1, compile_time=0.5)
+
+        threads = [threading.Thread(target=compile_plans) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics.add(reloads=1)
+
+        assert len(metrics._accumulators) == 5
+        assert metrics.compiles == 400
+        assert metrics.compile_time == 200.0
+        assert metrics.reloads == 1
+
+        # The ended threads' counts are kept, without their accumulators
+        assert len(metrics._accumulators) == 1
+        metrics.add(compiles=1)
+        assert metrics.compiles == 401
+
+
+class ManagerStatsTests(TestCase):
+
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True)
+        self.gargoyle.register(UserConditionSet(User))
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='disabled', status=DISABLED)
+        Switch.objects.create(key='global:inherit', status=INHERIT)
+        Switch.objects.create(key='selective', status=SELECTIVE)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_disabled_by_default(self):
+        assert self.gargoyle.stats is None
+        assert self.gargoyle.is_active('global')
+        assert self.gargoyle.get_stats() == {}
+
+    def test_is_active_counted(self):
+        self.gargoyle.enable_stats()
+        assert self.gargoyle.is_active('global')
+        assert self.gargoyle.is_active('global')
+        assert not self.gargoyle.is_active('disabled')
+        assert self.gargoyle.is_active('global:inherit')
+        assert not self.gargoyle.is_active('selective')
+        assert not self.gargoyle.is_active('missing')
+
+        stats = self.gargoyle.get_stats()
+        assert (stats['global'].calls, stats['global'].true, stats['global'].defaults) == (2, 2, 0)
+        assert (stats['disabled'].calls, stats['disabled'].false, stats['disabled'].defaults) == (1, 1, 0)
+        assert (stats['global:inherit'].defaults, stats['global:inherit'].missing) == (1, 0)
+        assert stats['selective'].defaults == 1
+        assert (stats['missing'].defaults, stats['missing'].missing) == (1, 1)
+        assert sum(stats['global'].buckets) == 2
+
+        self.gargoyle.disable_stats()
+        assert self.gargoyle.get_stats() == {}
+
+    def test_published(self):
+        self.gargoyle.enable_stats()
+        self.gargoyle.is_active('global')
+        assert self.gargoyle.get_published_stats() == {}
+
+        self.gargoyle.publish_stats()
+        published = self.gargoyle.get_published_stats()
+        assert published['global'].calls == 1
+
+        # Only republished at the end of a request after the interval
+        self.gargoyle.is_active('global')
+        self.gargoyle._cleanup()
+        assert self.gargoyle.get_published_stats()['global'].calls == 1
+
+        self.gargoyle.stats.published_at = 0.0
+        self.gargoyle._cleanup()
+        assert self.gargoyle.get_published_stats()['global'].calls == 2
+
+    def test_published_by_processes_summed(self):
+        self.gargoyle.enable_stats()
+        self.gargoyle.is_active('global')
+        self.gargoyle.publish_stats()
+
+        other_key = self.gargoyle.get_stats_key('otherhost:1')
+        other_stats = KeyStats('global')
+        other_stats.calls = 5
+        cache.set(other_key, {'global': other_stats.get_counters()})
+        processes = cache.get(self.gargoyle.get_stats_key())
+        processes['otherhost:1'] = max(processes.values())
+        cache.set(self.gargoyle.get_stats_key(), processes)
+
+        assert self.gargoyle.get_published_stats()['global'].calls == 6
+
+
+class StatsCommandTests(TestCase):
+
+    def setUp(self):
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='disabled', status=DISABLED)
+
+    def tearDown(self):
+        global_gargoyle.disable_stats()
+        cache.clear()
+
+    def call_command(self, *args, **kwargs):
+        out = StringIO()
+        call_command('gargoyle_stats', *args, stdout=out, **kwargs)
+        return out.getvalue()
+
+    def test_nothing_published(self):
+        assert self.call_command() == 'No stats have been published.\n'
+
+    def test_table(self):
+        global_gargoyle.enable_stats()
+        global_gargoyle.is_active('global')
+        global_gargoyle.is_active('disabled')
+        global_gargoyle.is_active('disabled')
+        global_gargoyle.publish_stats()
+
+        lines = self.call_command().splitlines()
+        assert lines[0].split() == ['Switch', 'Calls', 'True', 'False', 'Defaults', 'Mean', 'p50', 'p99']
+        assert lines[1].split()[:5] == ['disabled', '2', '0', '2', '0']
+        assert lines[2].split()[:5] == ['global', '1', '1', '0', '0']
+
+        lines = self.call_command(limit=1)
+        assert len(lines.splitlines()) == 2
@@ -1,11 +1,18 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import pytest
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.template import Context, Template
 from django.test import TestCase
 
 from gargoyle import gargoyle
+from gargoyle.builtins import UserConditionSet
 from gargoyle.manager import SwitchManager
-from gargoyle.models import DISABLED, GLOBAL, Switch
-from gargoyle.testutils import switches
+from gargoyle.models import DISABLED, GLOBAL, INHERIT, SELECTIVE, Switch
+from gargoyle.testutils import CountingLocMemCache, budget, switches
 
 
 class SwitchContextManagerTest(TestCase):
@@ -67,3 +74,101 @@ class SwitchContextManagerClassTest(TestCase):
         assert self.suc_switch_value
         assert self.su_switch_value
         assert gargoyle['my_switch_name']
+
+
+class CountingLocMemCacheTest(TestCase):
+
+    def test_calls_counted(self):
+        counting = CountingLocMemCache('counting', {})
+        counting.set('a', 1)
+        counting.set_many({'b': 2, 'c': 3})
+        assert counting.get('a') == 1
+        assert counting.get_many(['a', 'b']) == {'a': 1, 'b': 2}
+        counting.incr('a')
+        # Methods implemented with others only count once
+        assert counting.calls == {'set': 1, 'set_many': 1, 'get': 1, 'get_many': 1, 'incr': 1}
+
+
+class BudgetTest(TestCase):
+
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        self.gargoyle.register(UserConditionSet(User))
+        self.user = User.objects.create(username='foo', email='foo@example.com')
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='global:child', status=INHERIT)
+        switch = Switch.objects.create(key='selective', status=SELECTIVE)
+        switch.add_condition(
+            self.gargoyle,
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='foo',
+        )
+
+    def tearDown(self):
+        cache.clear()
+
+    def check_switches(self):
+        assert self.gargoyle.is_active('global')
+        assert self.gargoyle.is_active('global:child')
+        assert self.gargoyle.is_active('selective', self.user)
+        assert not self.gargoyle.is_active('missing')
+
+    def test_steady_state_is_active(self):
+        self.check_switches()
+        with budget(queries=0, cache_reads=0, cache_writes=0, cache=self.gargoyle.remote_cache):
+            self.check_switches()
+
+    def test_steady_state_template(self):
+        template = Template("""
+            {% load gargoyle_tags %}
+            {% ifswitch global %}on{% endifswitch %}
+            {% ifswitch selective user %}on{% endifswitch %}
+        """)
+        context = Context({'user': self.user})
+        template.render(context)
+        with budget(queries=0, cache_reads=0, cache_writes=0):
+            template.render(context)
+
+    def test_counts(self):
+        context = budget(cache=self.gargoyle.remote_cache, cache_writes=10)
+        with context:
+            # Creates the missing switch, and reloads the switches
+            self.check_switches()
+        assert len(context.captured_queries) > 0
+        assert context.cache_calls['set_many'] > 0
+        assert context.cache_calls['get'] == 0
+
+    def test_exceeded(self):
+        with pytest.raises(AssertionError) as excinfo:
+            with budget(queries=0, cache_reads=0, cache_writes=0, cache=self.gargoyle.remote_cache):
+                self.check_switches()
+        message = str(excinfo.value)
+        assert message.startswith('Budget exceeded: ')
+        assert 'cache reads' not in message
+        assert ' cache writes, over the budget of 0; ' in message
+        assert ' queries, over the budget of 0\n' in message
+        assert 'FROM "gargoyle_switch"' in message
+        assert 'cache.set_many() x' in message
+
+    def test_decorator(self):
+        @budget(queries=0)
+        def check():
+            Switch.objects.count()
+
+        with pytest.raises(AssertionError):
+            check()
+
+    def test_requires_counting_cache(self):
+        with pytest.raises(ImproperlyConfigured):
+            with budget(cache_reads=0, cache=LocMemCache('plain', {})):
+                pass
+        # Query budgets work with any cache
+        with budget(queries=0, cache=LocMemCache('plain', {})):
+            pass
+
+    def test_exception_not_masked(self):
+        with pytest.raises(ValueError):
+            with budget(queries=0):
+                Switch.objects.count()
+                raise ValueError()
@@ -0,0 +1,275 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import logging
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+
+from gargoyle import compat, tracing
+from gargoyle.builtins import UserConditionSet
+from gargoyle.constants import AB_TEST, FEATURE
+from gargoyle.manager import SwitchManager
+from gargoyle.models import GLOBAL, SELECTIVE, Switch
+from gargoyle.tracing import LoggingSink, TracingSink, get_default_sink
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        super(RecordingHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class FakeSpan(object):
+
+    def __init__(self, name, start_time, attributes):
+        self.name = name
+        self.start_time = start_time
+        self.attributes = attributes
+        self.end_time = None
+
+    def end(self, end_time=None):
+        self.end_time = end_time
+
+
+class FakeTracer(object):
+
+    def __init__(self):
+        self.spans = []
+
+    def start_span(self, name, start_time=None, attributes=None):
+        span = FakeSpan(name, start_time, attributes)
+        self.spans.append(span)
+        return span
+
+
+class EvaluationHookTests(TestCase):
+
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True)
+        self.gargoyle.register(UserConditionSet(User))
+        Switch.objects.create(key='global', status=GLOBAL)
+        switch = Switch.objects.create(key='selective', status=SELECTIVE)
+        switch.add_condition(
+            self.gargoyle,
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='foo',
+        )
+        self.evaluations = []
+        self.condition_set_id = UserConditionSet(User).get_id()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_hook_called(self):
+        self.gargoyle.add_evaluation_hook(self.evaluations.append)
+
+        assert self.gargoyle.is_active('global')
+        assert self.gargoyle.is_active('selective', User(username='foo'))
+        assert not self.gargoyle.is_active('selective', User(username='bar'))
+
+        global_evaluation, match, no_match = self.evaluations
+        assert (global_evaluation.key, global_evaluation.result) == ('global', True)
+        assert global_evaluation.duration >= 0
+        assert global_evaluation.condition_sets == []
+        assert (match.key, match.result, match.condition_sets) == ('selective', True, [self.condition_set_id])
+        assert no_match.condition_sets == []
+        assert [condition_set for condition_set, _ in no_match.timings] == [self.condition_set_id]
+
+    def test_hook_arguments(self):
+        self.gargoyle.add_evaluation_hook(self.evaluations.append)
+        user = User(username='foo')
+
+        self.gargoyle.is_active('selective', user)
+        self.gargoyle.is_active('missing', user, default=True, switch_type=AB_TEST)
+
+        evaluation, defaulted = self.evaluations
+        assert (evaluation.instances, evaluation.switch_type, evaluation.default) == ((user,), FEATURE, False)
+        assert (defaulted.instances, defaulted.switch_type, defaulted.default) == ((user,), AB_TEST, True)
+
+    def test_not_sampled(self):
+        self.gargoyle.add_evaluation_hook(self.evaluations.append, sample_rate=0)
+        assert self.gargoyle.is_active('selective', User(username='foo'))
+        assert self.evaluations == []
+
+    def test_invalid_sample_rate(self):
+        with pytest.raises(ValueError):
+            self.gargoyle.add_evaluation_hook(self.evaluations.append, sample_rate=2)
+
+    def test_add_twice_replaces(self):
+        self.gargoyle.add_evaluation_hook(self.evaluations.append, sample_rate=0)
+        self.gargoyle.add_evaluation_hook(self.evaluations.append)
+        self.gargoyle.is_active('global')
+        assert len(self.evaluations) == 1
+
+    def test_remove(self):
+        self.gargoyle.add_evaluation_hook(self.evaluations.append)
+        assert self.gargoyle.remove_evaluation_hook(self.evaluations.append)
+        assert not self.gargoyle.remove_evaluation_hook(self.evaluations.append)
+        self.gargoyle.is_active('global')
+        assert self.evaluations == []
+
+    def test_hook_errors_logged(self):
+        def hook(evaluation):
+            raise ValueError()
+        self.gargoyle.add_evaluation_hook(hook)
+        self.gargoyle.add_evaluation_hook(self.evaluations.append)
+
+        handler = RecordingHandler()
+        logger = logging.getLogger('gargoyle')
+        logger.addHandler(handler)
+        try:
+            assert self.gargoyle.is_active('global')
+        finally:
+            logger.removeHandler(handler)
+        assert len(self.evaluations) == 1
+        assert handler.records[0].getMessage().startswith('Error in evaluation hook')
+
+    def test_with_stats(self):
+        self.gargoyle.enable_stats()
+        self.gargoyle.add_evaluation_hook(self.evaluations.append, sample_rate=0)
+        assert self.gargoyle.is_active('global')
+        assert self.gargoyle.get_stats()['global'].calls == 1
+
+    def test_logging_sink(self):
+        handler = RecordingHandler()
+        logger = logging.getLogger('gargoyle.test_tracing')
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        self.gargoyle.add_evaluation_hook(LoggingSink(logger=logger))
+
+        assert self.gargoyle.is_active('selective', User(username='foo'))
+        record, = handler.records
+        fields = json.loads(record.getMessage())
+        assert fields['key'] == 'selective'
+        assert fields['result'] is True
+        assert fields['condition_sets'] == [self.condition_set_id]
+        assert record.evaluation == fields
+
+    def test_tracing_sink(self):
+        tracer = FakeTracer()
+        self.gargoyle.add_evaluation_hook(TracingSink(tracer=tracer))
+
+        assert self.gargoyle.is_active('selective', User(username='foo'))
+        span, = tracer.spans
+        assert span.name == 'gargoyle.is_active'
+        assert span.attributes == {
+            'gargoyle.switch': 'selective',
+            'gargoyle.result': True,
+            'gargoyle.condition_sets': [self.condition_set_id],
+        }
+        assert span.start_time <= span.end_time
+
+    def test_tracing_sink_requires_opentelemetry(self):
+        if compat.opentelemetry_trace is not None:
+            pytest.skip('opentelemetry-api is installed')
+        with pytest.raises(ImproperlyConfigured):
+            TracingSink()
+        assert isinstance(get_default_sink(), LoggingSink)
+
+    def test_default_sink_with_opentelemetry(self):
+        if tracing.opentelemetry_trace is None:
+            pytest.skip('opentelemetry-api is not installed')
+        assert isinstance(get_default_sink(), TracingSink)
+
+
+class SlowEvaluationTests(TestCase):
+
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True)
+        self.gargoyle.register(UserConditionSet(User))
+        Switch.objects.create(key='global', status=GLOBAL)
+        switch = Switch.objects.create(key='selective', status=SELECTIVE)
+        switch.add_condition(
+            self.gargoyle,
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='foo',
+        )
+        self.handler = RecordingHandler()
+        logging.getLogger('gargoyle').addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger('gargoyle').removeHandler(self.handler)
+        cache.clear()
+
+    def test_disabled_by_default(self):
+        assert self.gargoyle.slow_evaluation_threshold is None
+        assert self.gargoyle.is_active('global')
+        assert self.handler.records == []
+
+    def test_fast_not_logged(self):
+        self.gargoyle.set_slow_evaluation_threshold(60 * 1000)
+        assert self.gargoyle.is_active('global')
+        assert self.handler.records == []
+
+    def test_slow_logged(self):
+        self.gargoyle.set_slow_evaluation_threshold(0)
+        assert self.gargoyle.is_active('selective', User(username='foo'))
+
+        record, = self.handler.records
+        assert record.levelno == logging.WARNING
+        message = record.getMessage()
+        assert message.startswith("Slow evaluation of switch 'selective' took ")
+        assert ' for User; ' in message
+        condition_set_id = UserConditionSet(User).get_id()
+        assert record.switch == 'selective'
+        assert record.instance_types == ['User']
+        assert record.condition_sets == [condition_set_id]
+        assert list(record.condition_set_timings) == [condition_set_id]
+
+    def test_only_logged_calls_explained(self):
+        explained = []
+        explain = self.gargoyle.explain
+
+        def count_explain(key, *instances, **kwargs):
+            explained.append(key)
+            return explain(key, *instances, **kwargs)
+
+        self.gargoyle.explain = count_explain
+        self.gargoyle.set_slow_evaluation_threshold(0)
+        for _ in range(3):
+            assert self.gargoyle.is_active('selective', User(username='foo'))
+        assert explained == ['selective']
+        assert getattr(self.gargoyle._trace, 'current', None) is None
+
+        record, = self.handler.records
+        assert list(record.condition_set_timings) == [UserConditionSet(User).get_id()]
+
+    def test_explain_error_logged(self):
+        def explain(*args, **kwargs):
+            raise ValueError()
+
+        self.gargoyle.explain = explain
+        self.gargoyle.set_slow_evaluation_threshold(0)
+        assert self.gargoyle.is_active('global')
+
+        error, record = self.handler.records
+        assert error.getMessage() == "Error explaining slow evaluation of switch 'global'"
+        assert record.condition_sets == []
+
+    def test_rate_limited_per_key(self):
+        self.gargoyle.set_slow_evaluation_threshold(0)
+        self.gargoyle.is_active('global')
+        self.gargoyle.is_active('global')
+        self.gargoyle.is_active('selective')
+        assert [record.switch for record in self.handler.records] == ['global', 'selective']
+
+        self.gargoyle.slow_evaluation_log_interval = 0
+        self.gargoyle.is_active('global')
+        assert len(self.handler.records) == 3
+
+    def test_setting(self):
+        from gargoyle.manager import make_gargoyle
+
+        with self.settings(GARGOYLE_SLOW_EVALUATION_MS=50):
+            manager = make_gargoyle()
+        assert manager.slow_evaluation_threshold == 0.05
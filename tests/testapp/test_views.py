@@ -0,0 +1,111 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+
+from gargoyle import gargoyle as global_gargoyle
+from gargoyle.builtins import UserConditionSet
+from gargoyle.manager import SwitchManager
+from gargoyle.models import DISABLED, GLOBAL, SELECTIVE, Switch
+from gargoyle.testutils import budget
+from gargoyle.views import format_labels, render_metrics
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        self.gargoyle.register(UserConditionSet(User))
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='disabled', status=DISABLED)
+        switch = Switch.objects.create(key='selective', status=SELECTIVE)
+        switch.add_condition(
+            self.gargoyle,
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='foo',
+        )
+
+    def tearDown(self):
+        cache.clear()
+
+    def get_samples(self, text):
+        return dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+
+    def test_manager_metrics(self):
+        assert self.gargoyle.is_active('global')
+        assert not self.gargoyle.is_active('selective', User(username='bar'))
+        assert not self.gargoyle.is_active('missing')
+
+        metrics = self.gargoyle.metrics
+        assert metrics.reloads >= 1
+        assert metrics.database_loads >= 1
+        assert metrics.auto_creates == 1
+        assert metrics.compiles >= 1
+
+        with budget(queries=0, cache_reads=0, cache_writes=0, cache=self.gargoyle.remote_cache):
+            text = render_metrics(self.gargoyle, now=self.gargoyle._local_last_updated + 5)
+        samples = self.get_samples(text)
+        assert samples['gargoyle_snapshot_version'] == str(self.gargoyle._snapshot.version)
+        assert samples['gargoyle_snapshot_switches'] == str(len(self.gargoyle._snapshot.switches))
+        assert float(samples['gargoyle_snapshot_age_seconds']) == 5.0
+        assert samples['gargoyle_reloads_total{source="database"}'] == str(metrics.database_loads)
+        assert samples['gargoyle_auto_creates_total'] == '1'
+        assert samples['gargoyle_compiles_total'] == str(metrics.compiles)
+        assert '# TYPE gargoyle_compile_seconds_total counter' in text
+        # Per-switch metrics need stats
+        assert 'gargoyle_switch_evaluations_total' not in text
+
+    def test_cache_loads(self):
+        self.gargoyle.is_active('global')
+        # Another process loads the switches cached by the first
+        other = SwitchManager(Switch, key='key', value='value', instances=True)
+        other.is_active('global')
+        other.refresh()
+
+        assert (other.metrics.cache_loads, other.metrics.database_loads) == (1, 0)
+        samples = self.get_samples(render_metrics(other))
+        assert samples['gargoyle_reloads_total{source="cache"}'] == '1'
+        assert samples['gargoyle_reloads_total{source="database"}'] == '0'
+
+    def test_snapshot_version(self):
+        self.gargoyle.is_active('global')
+        version = self.gargoyle._snapshot.version
+        self.gargoyle.is_active('global')
+        assert self.gargoyle._snapshot.version == version
+
+        self.gargoyle._populate(reset=True)
+        assert self.gargoyle._snapshot.version == version + 1
+
+    def test_switch_metrics(self):
+        self.gargoyle.enable_stats()
+        assert self.gargoyle.is_active('global')
+        assert self.gargoyle.is_active('global')
+        assert not self.gargoyle.is_active('disabled')
+        assert not self.gargoyle.is_active('missing')
+
+        with budget(queries=0, cache_reads=0, cache_writes=0, cache=self.gargoyle.remote_cache):
+            text = render_metrics(self.gargoyle)
+        samples = self.get_samples(text)
+        assert samples['gargoyle_switch_lookups_total{result="hit"}'] == '3'
+        assert samples['gargoyle_switch_lookups_total{result="miss"}'] == '1'
+        assert samples['gargoyle_switch_evaluations_total{switch="global",result="true"}'] == '2'
+        assert samples['gargoyle_switch_evaluations_total{switch="global",result="false"}'] == '0'
+        assert samples['gargoyle_switch_evaluations_total{switch="disabled",result="false"}'] == '1'
+        assert samples['gargoyle_switch_defaults_total{switch="missing"}'] == '1'
+        assert samples['gargoyle_switch_evaluation_seconds_count{switch="global"}'] == '2'
+        assert samples['gargoyle_switch_evaluation_seconds_bucket{switch="global",le="+Inf"}'] == '2'
+        assert '# TYPE gargoyle_switch_evaluation_seconds histogram' in text
+
+    def test_format_labels(self):
+        assert format_labels(()) == ''
+        assert format_labels((('switch', 'a"b\\c\nd'),)) == '{switch="a\\"b\\\\c\\nd"}'
+
+    def test_view(self):
+        global_gargoyle.is_active('global')
+        with budget(queries=0, cache_reads=0, cache_writes=0):
+            response = self.client.get('/gargoyle/metrics/')
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'text/plain; version=0.0.4; charset=utf-8'
+        assert b'# TYPE gargoyle_reloads_total counter' in response.content
@@ -11,12 +11,14 @@ from django.http import HttpResponse
 from django.views.generic.base import RedirectView
 
 from gargoyle.compat import subinclude
+from gargoyle.views import metrics
 
 admin.autodiscover()
 nexus.autodiscover()
 
 urlpatterns = [
     url(r'^nexus/', include(nexus.site.urls)),
+    url(r'^gargoyle/metrics/$', metrics),
     url(r'^admin/', subinclude(admin.site.urls)),
     url(r'^foo/$', lambda request: HttpResponse(), name='gargoyle_test_foo'),
     url(r'^/?$', RedirectView.as_view(url='/nexus/', permanent=False)),